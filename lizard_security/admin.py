@@ -10,20 +10,52 @@ Lizard-security's ``admin.py`` contains two kinds of model admins:
   lizard-security's data set mechanism.
 
 """
+import csv
+
+from django.conf.urls import patterns
+from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.auth.models import Permission
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import EmptyPage
+from django.core.paginator import PageNotAnInteger
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import HttpResponse
+from django.shortcuts import render
 from tls import request as tls_request
 from django.forms import ModelForm
-
+from django.forms import ValidationError
+from django.utils.translation import ugettext_lazy as _
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5: a plain response with an iterator streams, too.
+    StreamingHttpResponse = HttpResponse
+
+from lizard_security.backends import data_set_ids_by_object
+from lizard_security.backends import data_set_permissions
+from lizard_security.backends import object_data_set_ids
+from lizard_security.backends import permitted_data_sets
+from lizard_security.models import APIToken
+from lizard_security.models import AccessLog
 from lizard_security.models import DataSet
+from lizard_security.models import IPRange
 from lizard_security.models import PermissionMapper
 from lizard_security.models import UserGroup
+from lizard_security.models import UserGroupAncestor
+from lizard_security.models import data_sets_field
+from lizard_security.models import valid_mappers
 from lizard_security.middleware import USER_GROUP_IDS
 
 
 class DataSetAdmin(admin.ModelAdmin):
-    """Unmodified admin for data sets."""
+    """Admin for data sets, showing their place in the hierarchy."""
     model = DataSet
+    list_display = ('name', 'parent', 'is_public')
+    list_filter = ('is_public', 'parent')
+    search_fields = ('name', )
 
 
 class UserGroupAdminForm(ModelForm):
@@ -37,12 +69,24 @@ class UserGroupAdminForm(ModelForm):
         model = UserGroup
 
     def clean(self):
-        """Make sure all managers are also members."""
+        """Make sure all managers are also members.
+
+        Also refuse member groups that already contain this user group, as
+        that would make the nesting circular.
+
+        """
         members = list(self.cleaned_data['members'])
         for manager in self.cleaned_data['managers']:
             if manager not in members:
                 members.append(manager)
         self.cleaned_data['members'] = members
+        member_groups = self.cleaned_data.get('member_groups', [])
+        if self.instance.pk and member_groups:
+            if UserGroupAncestor.objects.filter(
+                    descendant=self.instance.pk,
+                    ancestor__in=member_groups).exists():
+                raise ValidationError(
+                    _('A user group cannot contain a group it is part of.'))
         return self.cleaned_data
 
 
@@ -56,7 +100,7 @@ class UserGroupAdmin(admin.ModelAdmin):
     form = UserGroupAdminForm
     list_display = ('name', 'manager_info', 'number_of_members')
     search_fields = ('name', )
-    filter_horizontal = ('managers', 'members')
+    filter_horizontal = ('managers', 'members', 'member_groups')
 
     def queryset(self, request):
         """Limit user groups to those you manage.
@@ -70,6 +114,48 @@ class UserGroupAdmin(admin.ModelAdmin):
         return qs.filter(id__in=request.user.managed_user_groups.all())
 
 
+MATRIX_FIELDS = (
+    'user_group__descendant_links__descendant__name',
+    'data_set__descendant_links__descendant__name',
+    'permission_group__permissions__content_type__app_label',
+    'permission_group__permissions__codename',
+    )
+
+
+def effective_permissions(user_group='', data_set='', permission=''):
+    """Return the effective user group x data set x permission matrix.
+
+    Permission mappers apply to their user group's member groups (nested
+    ones, too) and to their data set's descendants. Both closure tables are
+    joined in one query that returns distinct ``(user group, data set,
+    app label, codename)`` rows of names, sorted. The data set is None for
+    mappers without one.
+
+    The optional arguments filter on (parts of) the user group name, data set
+    name and permission codename.
+
+    """
+    conditions = Q(permission_group__permissions__isnull=False)
+    if user_group:
+        conditions &= Q(**{MATRIX_FIELDS[0] + '__icontains': user_group})
+    if data_set:
+        conditions &= Q(**{MATRIX_FIELDS[1] + '__icontains': data_set})
+    if permission:
+        conditions &= Q(**{MATRIX_FIELDS[3] + '__icontains': permission})
+    # One filter() call, so that the conditions and the values share their
+    # joins.
+    return PermissionMapper.objects.filter(
+        conditions & valid_mappers()).values_list(
+        *MATRIX_FIELDS).order_by(*MATRIX_FIELDS).distinct()
+
+
+class _Echo(object):
+    """File-like object that returns what's written, for streaming CSV."""
+
+    def write(self, value):
+        return value
+
+
 class PermissionMapperAdmin(admin.ModelAdmin):
     """Custom admin for permission mapper: editable in the list display.
 
@@ -80,10 +166,94 @@ class PermissionMapperAdmin(admin.ModelAdmin):
 
     """
     model = PermissionMapper
-    list_display = ('name', 'user_group', 'data_set', 'permission_group')
+    list_display = ('name', 'user_group', 'data_set', 'permission_group',
+                    'valid_from', 'valid_until')
     list_editable = ('user_group', 'data_set', 'permission_group')
-    list_filter = ('user_group', 'data_set', 'permission_group')
+    list_filter = ('user_group', 'data_set', 'permission_group',
+                   'valid_until')
     search_fields = ('name', 'data_set__name')
+    matrix_per_page = 100
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.module_name
+        return patterns(
+            '',
+            url(r'^matrix/$',
+                self.admin_site.admin_view(self.matrix_view),
+                name='%s_%s_matrix' % info),
+            ) + super(PermissionMapperAdmin, self).get_urls()
+
+    def matrix_view(self, request):
+        """Show the effective permissions, paginated, or stream them as CSV.
+
+        The ``user_group``, ``data_set`` and ``permission`` GET parameters
+        filter the matrix; ``format=csv`` exports all matching rows.
+
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        filters = dict((key, request.GET.get(key, '').strip())
+                       for key in ('user_group', 'data_set', 'permission'))
+        rows = effective_permissions(**filters)
+        if request.GET.get('format') == 'csv':
+            writer = csv.writer(_Echo())
+            lines = (writer.writerow(
+                    [(value or u'').encode('utf-8') for value in row])
+                     for row in rows.iterator())
+            response = StreamingHttpResponse(lines, content_type='text/csv')
+            response['Content-Disposition'] = (
+                'attachment; filename="effective-permissions.csv"')
+            return response
+        paginator = Paginator(rows, self.matrix_per_page)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+        query = request.GET.copy()
+        query.pop('page', None)
+        return render(request,
+                      'admin/lizard_security/permissionmapper/matrix.html',
+                      {'title': _('Effective permissions'),
+                       'opts': self.model._meta,
+                       'app_label': self.model._meta.app_label,
+                       'filters': filters,
+                       'page': page,
+                       'query': query.urlencode()})
+
+
+class IPRangeAdmin(admin.ModelAdmin):
+    """Admin for IP ranges, editable in the list display."""
+    model = IPRange
+    list_display = ('network', 'name', 'user_group')
+    list_editable = ('user_group', )
+    list_filter = ('user_group', )
+    search_fields = ('network', 'name')
+
+
+class APITokenAdmin(admin.ModelAdmin):
+    """Admin for API tokens. The key is generated when saving."""
+    model = APIToken
+    list_display = ('name', 'user', 'is_active', 'created')
+    list_filter = ('is_active', )
+    search_fields = ('name', 'user__username')
+    filter_horizontal = ('user_groups', )
+    readonly_fields = ('key', 'created')
+
+
+class AccessLogAdmin(admin.ModelAdmin):
+    """Read-only admin for the audit log."""
+    model = AccessLog
+    list_display = ('timestamp', 'username', 'model', 'perm', 'data_set_ids',
+                    'allowed')
+    list_filter = ('allowed', 'model')
+    search_fields = ('username', )
+    date_hierarchy = 'timestamp'
+    readonly_fields = list_display
+
+    def has_add_permission(self, request):
+        return False
 
 
 class SecurityFilteredAdmin(admin.ModelAdmin):
@@ -93,7 +263,43 @@ class SecurityFilteredAdmin(admin.ModelAdmin):
     even view a certain model in the admin. SecurityFilteredAdmin takes
     lizard-security's permission mapper into account.
 
+    With ``actionable_only = True``, the change list only shows objects in
+    data sets where we have the change permission, instead of everything we
+    can view.
+
     """
+    actionable_only = False
+
+    def queryset(self, request):
+        """Limit the objects to those we may change, if so configured."""
+        qs = super(SecurityFilteredAdmin, self).queryset(request)
+        opts = self.opts
+        field = data_sets_field(self.model)
+        if (not self.actionable_only or
+            ('data_set' not in opts.get_all_field_names() and
+             field is None)):
+            return qs
+        perm = opts.app_label + '.' + opts.get_change_permission()
+        if request.user.has_perm(perm):
+            return qs
+        user_group_ids = getattr(request, USER_GROUP_IDS, None) or []
+        data_set_ids = permitted_data_sets(user_group_ids, perm)
+        # Permission mappers without a data set.
+        unlinked = perm in data_set_permissions(request).get(None, ())
+        if field is None:
+            permitted = Q(data_set__in=data_set_ids)
+            if unlinked:
+                permitted |= Q(data_set=None)
+            return qs.filter(permitted)
+        # Through the link table, so objects aren't duplicated by the join.
+        links = field.rel.through.objects
+        object_column = field.m2m_field_name()
+        permitted = Q(pk__in=links.filter(**{
+                    field.m2m_reverse_field_name() + '__in': data_set_ids
+                    }).values(object_column))
+        if unlinked:
+            permitted |= ~Q(pk__in=links.values(object_column))
+        return qs.filter(permitted)
 
     def _available_permissions(self):
         """Return all permissions we have through user group membership.
@@ -108,7 +314,8 @@ class SecurityFilteredAdmin(admin.ModelAdmin):
         user_group_ids = getattr(tls_request, USER_GROUP_IDS, None)
         if user_group_ids:
             permissions = Permission.objects.filter(
-                group__permissionmapper__user_group__id__in=user_group_ids)
+                Q(group__permissionmapper__user_group__id__in=user_group_ids) &
+                valid_mappers(prefix='group__permissionmapper__'))
             permissions = [(perm.content_type.app_label + '.' + perm.codename)
                            for perm in permissions]
             return permissions
@@ -123,41 +330,83 @@ class SecurityFilteredAdmin(admin.ModelAdmin):
             return True
         return perm in self._available_permissions()
 
+    def _has_object_permission(self, request, perm, obj):
+        """Return True if we have the permission on the object's data set.
+
+        Objects without a data set field only get the model level check.
+        Objects with several data sets need the permission on one of them.
+        The permissions per data set are looked up once per request.
+
+        """
+        if obj is None or (not hasattr(obj, 'data_set_id') and
+                           data_sets_field(obj) is None):
+            return perm in self._available_permissions()
+        permissions = data_set_permissions(request)
+        for data_set_id in object_data_set_ids(obj):
+            if perm in permissions.get(data_set_id, ()):
+                return True
+        return False
+
     def has_change_permission(self, request, obj=None):
         """Return True if we have permission to change the object.
 
         If ``obj`` is None, we just have to check if we have global
         permissions or if we have the permission through a permission mapper.
-
-        TODO: specific check for object permissions.
+        Otherwise the permission mapper must apply to the object's data set.
 
         """
         opts = self.opts
         perm = opts.app_label + '.' + opts.get_change_permission()
-        # TODO: object permissions
         if request.user.has_perm(perm):
             return True
-        result = perm in self._available_permissions()
-        print "%r in %s: %s" % (perm, self._available_permissions(), result)
-        return result
+        return self._has_object_permission(request, perm, obj)
 
     def has_delete_permission(self, request, obj=None):
         """Return True if we have permission to delete the object.
 
         If ``obj`` is None, we just have to check if we have global
         permissions or if we have the permission through a permission mapper.
-
-        TODO: specific check for object permissions.
+        Otherwise the permission mapper must apply to the object's data set.
 
         """
         opts = self.opts
         perm = opts.app_label + '.' + opts.get_delete_permission()
-        # TODO: object permissions
         if request.user.has_perm(perm):
             return True
-        return perm in self._available_permissions()
+        return self._has_object_permission(request, perm, obj)
+
+    def get_actions(self, request):
+        """Check the data sets of the selected objects before bulk deletes."""
+        actions = super(SecurityFilteredAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            (function, name, description) = actions['delete_selected']
+            actions['delete_selected'] = (
+                self._checked_delete_action(function), name, description)
+        return actions
+
+    def _checked_delete_action(self, delete_selected):
+
+        def checked_delete_selected(modeladmin, request, queryset):
+            opts = modeladmin.opts
+            perm = opts.app_label + '.' + opts.get_delete_permission()
+            if (not request.user.has_perm(perm) and
+                ('data_set' in opts.get_all_field_names() or
+                 data_sets_field(modeladmin.model) is not None)):
+                allowed = data_set_permissions(request)
+                # Objects with several data sets need the permission on one
+                # of them.
+                for data_set_ids in data_set_ids_by_object(queryset).values():
+                    if not [data_set_id for data_set_id in data_set_ids
+                            if perm in allowed.get(data_set_id, ())]:
+                        raise PermissionDenied
+            return delete_selected(modeladmin, request, queryset)
+
+        return checked_delete_selected
 
 
 admin.site.register(DataSet, DataSetAdmin)
 admin.site.register(UserGroup, UserGroupAdmin)
 admin.site.register(PermissionMapper, PermissionMapperAdmin)
+admin.site.register(IPRange, IPRangeAdmin)
+admin.site.register(APIToken, APITokenAdmin)
+admin.site.register(AccessLog, AccessLogAdmin)
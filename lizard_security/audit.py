@@ -0,0 +1,224 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Optional audit log of access decisions: who got access to which data sets.
+
+Recording a decision only puts a small dictionary on an in-memory queue; a
+background thread writes the queue out in batches, so requests don't wait
+for the audit log. Enable it with ``LIZARD_SECURITY_AUDIT = True``.
+Decisions are recorded by ``data_set_filter()`` (the data sets a query was
+limited to) and by the permission backend (object permission checks).
+
+Settings:
+
+- ``LIZARD_SECURITY_AUDIT_FILE``: append JSON lines to this file instead of
+  storing ``AccessLog`` objects in the database.
+
+- ``LIZARD_SECURITY_AUDIT_QUEUE_SIZE``: maximum number of waiting records,
+  default 10000. This bounds the memory use.
+
+- ``LIZARD_SECURITY_AUDIT_OVERFLOW``: what to do when the queue is full.
+  ``'drop'`` (the default) drops the new record and counts it in
+  ``dropped``; ``'block'`` makes the request wait for the worker for at
+  most ``LIZARD_SECURITY_AUDIT_BLOCK_TIMEOUT`` seconds (default 1) before
+  dropping it.
+
+- ``LIZARD_SECURITY_AUDIT_BATCH_SIZE``: records per write, default 500.
+
+- ``LIZARD_SECURITY_AUDIT_INTERVAL``: maximum number of seconds a record
+  waits for its batch to fill up, default 5.
+
+What's still queued is written when the process exits.
+
+"""
+import Queue
+import atexit
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+DROP = 'drop'
+BLOCK = 'block'
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseSink(object):
+    """Store records as ``AccessLog`` objects."""
+
+    def write(self, records):
+        from lizard_security.models import AccessLog
+        AccessLog.objects.bulk_create(
+            [AccessLog(**record) for record in records])
+
+
+class FileSink(object):
+    """Append records to a file as JSON lines."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        with open(self.path, 'a') as log_file:
+            for record in records:
+                record = dict(record,
+                              timestamp=record['timestamp'].isoformat())
+                log_file.write(json.dumps(record) + '\n')
+
+
+def _formatted(record):
+    """Return the queued record with its data sets as a sorted id list."""
+    return dict(record, data_set_ids=','.join(
+            [str(data_set_id) for data_set_id in sorted(record['data_set_ids'])
+             if data_set_id is not None]))
+
+
+class AuditLog(object):
+    """Bounded queue of records, written to a sink by a worker thread."""
+
+    def __init__(self, sink, max_size=10000, batch_size=500, interval=5.0,
+                 overflow=DROP, block_timeout=1.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._queue = Queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+
+    def record(self, user, data_set_ids, model='', perm='', allowed=True):
+        """Queue an access decision; never raises or waits long."""
+        if user is None or user.is_anonymous():
+            username = ''
+        else:
+            username = user.username
+        record = {'timestamp': timezone.now(),
+                  'username': username,
+                  'model': model,
+                  'perm': perm,
+                  # Formatted by the worker, see _write(). A frozenset
+                  # isn't copied, and can't change while it's queued.
+                  'data_set_ids': frozenset(data_set_ids),
+                  'allowed': allowed}
+        try:
+            if self.overflow == BLOCK:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        self._start_worker()
+
+    def _start_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run,
+                                            name='lizard-security-audit')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _batch(self, wait):
+        """Return up to ``batch_size`` records.
+
+        With ``wait``, wait for the first record and then at most
+        ``interval`` seconds for the batch to fill up.
+
+        """
+        batch = []
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if not wait or timeout <= 0 or self._stopping.is_set():
+                timeout = 0
+            try:
+                if timeout:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                if batch or not timeout:
+                    break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.sink.write([_formatted(record) for record in batch])
+        except Exception:
+            # Losing audit records shouldn't take the worker down.
+            logger.exception("Could not write %s audit records", len(batch))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._batch(wait=True)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Write everything that's queued now, in this thread."""
+        while True:
+            batch = self._batch(wait=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self, timeout=None):
+        """Stop the worker and write what's left."""
+        self._stopping.set()
+        worker = self._worker
+        if worker is not None:
+            worker.join(self.interval if timeout is None else timeout)
+        self.flush()
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+
+
+def audit_log():
+    """Return the configured audit log, or None if auditing is off."""
+    global _audit_log
+    if not getattr(settings, 'LIZARD_SECURITY_AUDIT', False):
+        return None
+    if _audit_log is None:
+        with _audit_log_lock:
+            if _audit_log is None:
+                path = getattr(settings, 'LIZARD_SECURITY_AUDIT_FILE', None)
+                if path:
+                    sink = FileSink(path)
+                else:
+                    sink = DatabaseSink()
+                _audit_log = AuditLog(
+                    sink,
+                    max_size=getattr(
+                        settings, 'LIZARD_SECURITY_AUDIT_QUEUE_SIZE', 10000),
+                    batch_size=getattr(
+                        settings, 'LIZARD_SECURITY_AUDIT_BATCH_SIZE', 500),
+                    interval=getattr(
+                        settings, 'LIZARD_SECURITY_AUDIT_INTERVAL', 5.0),
+                    overflow=getattr(
+                        settings, 'LIZARD_SECURITY_AUDIT_OVERFLOW', DROP),
+                    block_timeout=getattr(
+                        settings, 'LIZARD_SECURITY_AUDIT_BLOCK_TIMEOUT', 1.0))
+                atexit.register(_audit_log.close)
+    return _audit_log
+
+
+def record(user, data_set_ids, model='', perm='', allowed=True):
+    """Record an access decision, if auditing is enabled."""
+    log = audit_log()
+    if log is not None:
+        log.record(user, data_set_ids, model=model, perm=perm,
+                   allowed=allowed)
@@ -10,12 +10,106 @@ from django.contrib.auth.models import Permission
 from django.db.models import Q
 from tls import request
 
+from lizard_security import audit
 from lizard_security.middleware import ALLOWED_DATA_SET_IDS
 from lizard_security.middleware import USER_GROUP_IDS
+from lizard_security.models import DataSetAncestor
 from lizard_security.models import PermissionMapper
 from lizard_security.models import CAN_VIEW_LIZARD_DATA
+from lizard_security.models import data_sets_field
+from lizard_security.models import valid_mappers
 
 VIEW_PERMISSION = 'lizard_security.' + CAN_VIEW_LIZARD_DATA
+# Request attribute with the cached result of data_set_permissions().
+DATA_SET_PERMISSIONS = '_lizard_security_data_set_permissions'
+
+
+def object_data_set_ids(obj):
+    """Return the ids of the object's data sets, as a list.
+
+    That's ``[None]`` for objects without data set: those are governed by
+    permission mappers without data set.
+
+    """
+    field = data_sets_field(obj)
+    if field is None:
+        return [obj.data_set_id]
+    data_set_ids = list(getattr(obj, field.name).values_list('id', flat=True))
+    return data_set_ids or [None]
+
+
+def data_set_ids_by_object(query_set):
+    """Return a dict of object id to ``object_data_set_ids()``.
+
+    For all objects of the query set at once, in one query.
+
+    """
+    field = data_sets_field(query_set.model)
+    if field is None:
+        return dict([(object_id, [data_set_id]) for (object_id, data_set_id)
+                     in query_set.order_by().values_list('pk', 'data_set')])
+    result = {}
+    for (object_id, data_set_id) in query_set.order_by().values_list(
+            'pk', field.name):
+        data_set_ids = result.setdefault(object_id, [])
+        if data_set_id is not None:
+            data_set_ids.append(data_set_id)
+    for (object_id, data_set_ids) in result.items():
+        if not data_set_ids:
+            result[object_id] = [None]
+    return result
+
+
+def data_set_permissions(request):
+    """Return a dict of data set id to the permissions we have on it.
+
+    Permissions are strings like ``'testcontent.change_content'``. Data sets
+    that are in the dict, even with an empty set of permissions, carry the
+    implicit view permission. Permission mappers without a data set are
+    listed under None.
+
+    The dict is computed with one query and cached on the request for as
+    long as its user groups stay the same, so object level checks don't need
+    queries of their own.
+
+    """
+    user_group_ids = getattr(request, USER_GROUP_IDS, None)
+    cached = getattr(request, DATA_SET_PERMISSIONS, None)
+    if cached is not None and cached[0] is user_group_ids:
+        return cached[1]
+    permissions = {}
+    if user_group_ids:
+        for (data_set_id, app_label, codename) in (
+            PermissionMapper.objects.filter(
+                Q(user_group__id__in=user_group_ids) &
+                valid_mappers()).values_list(
+                'data_set__descendant_links__descendant',
+                'permission_group__permissions__content_type__app_label',
+                'permission_group__permissions__codename').distinct()):
+            granted = permissions.setdefault(data_set_id, set())
+            if codename is not None:
+                granted.add(app_label + '.' + codename)
+    setattr(request, DATA_SET_PERMISSIONS, (user_group_ids, permissions))
+    return permissions
+
+
+def permitted_data_sets(user_group_ids, perm):
+    """Return a subquery of the ids of data sets where we have ``perm``.
+
+    ``perm`` is a string like ``'testcontent.change_content'``. A permission
+    mapper on a data set gives the permission on its descendants, too. Use
+    the result as a ``data_set__in`` filter value.
+
+    """
+    app_label, codename = perm.split('.', 1)
+    mapper_prefix = 'ancestor__permission_mappers__'
+    return DataSetAncestor.objects.filter(
+        Q(**{mapper_prefix + 'user_group__id__in': user_group_ids,
+             mapper_prefix + 'permission_group__permissions__codename':
+                 codename,
+             mapper_prefix + ('permission_group__permissions__content_type'
+                              '__app_label'): app_label}) &
+        valid_mappers(prefix=mapper_prefix)).values('descendant')
 
 
 class LizardPermissionBackend(object):
@@ -42,7 +136,7 @@ class LizardPermissionBackend(object):
             # We' interested in a global permissions by definition. We only
             # deal with object-level permissions.
             return False
-        if not hasattr(obj, 'data_set'):
+        if not hasattr(obj, 'data_set') and data_sets_field(obj) is None:
             # We only manage objects with a data set attached.
             return False
         try:
@@ -51,11 +145,26 @@ class LizardPermissionBackend(object):
         except RuntimeError:
             # No tread-local request object.
             return False
+        data_set_ids = object_data_set_ids(obj)
+        allowed = self._has_mapped_perm(user_group_ids, perm, data_set_ids)
+        audit.record(user, data_set_ids,
+                     model=obj._meta.app_label + '.' + obj._meta.module_name,
+                     perm=perm,
+                     allowed=allowed)
+        return allowed
+
+    def _has_mapped_perm(self, user_group_ids, perm, data_set_ids):
+        """Return if a mapper gives us the permission on any of the data sets.
+        """
         user_group_query = Q(user_group__id__in=user_group_ids)
-        relevant_data_set = obj.data_set
-        data_set_query = Q(data_set=relevant_data_set)
+        if data_set_ids == [None]:
+            data_set_query = Q(data_set=None)
+        else:
+            # Mappers on the data sets or on any of their ancestors.
+            data_set_query = Q(
+                data_set__descendant_links__descendant__in=data_set_ids)
         relevant_permission_mappers = PermissionMapper.objects.filter(
-            user_group_query & data_set_query)
+            user_group_query & data_set_query & valid_mappers())
         if not relevant_permission_mappers:
             # No, we cannot say anything about it.
             return False
@@ -91,7 +200,8 @@ class LizardPermissionBackend(object):
             return False
         if user_group_ids:
             permissions = Permission.objects.filter(
-                group__permissionmapper__user_group__id__in=user_group_ids)
+                Q(group__permissionmapper__user_group__id__in=user_group_ids) &
+                valid_mappers(prefix='group__permissionmapper__'))
             for perm in permissions:
                 if perm.content_type.app_label == app_label:
                     return True
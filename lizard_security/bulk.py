@@ -0,0 +1,323 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Bulk synchronization of user group memberships and permission mappers, for
+instance from an HR or LDAP export.
+
+The functions here compare a desired state with what's in the database and
+only apply the difference: ``bulk_create()`` for additions and set-based
+deletes for removals, all in one transaction. Caches are invalidated once
+for the whole batch instead of once per changed row.
+
+Everything is referenced by name: user groups, data sets and permission
+groups by their ``name``, users by their ``username``. User groups that don't
+exist yet are created. Unknown users, data sets and permission groups are
+skipped and reported back.
+
+``assign_public_data_set()`` moves objects without a data set into a public
+data set, in chunks.
+
+"""
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from lizard_security import epoch
+from lizard_security import replicas
+from lizard_security import resultcache
+from lizard_security.manager import secured_models
+from lizard_security.models import DataSet
+from lizard_security.models import PermissionMapper
+from lizard_security.models import UserGroup
+from lizard_security.models import data_sets_field
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    # Django < 1.6
+    atomic = transaction.commit_on_success
+
+# Stay below SQLite's limit of 999 query parameters.
+CHUNK_SIZE = 500
+# Primary key range per transaction when assigning a public data set.
+ASSIGN_CHUNK_SIZE = 10000
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def _bulk_create(model, objects):
+    """``bulk_create()`` in chunks: ``batch_size`` needs Django 1.5."""
+    for chunk in _chunks(objects):
+        model.objects.bulk_create(chunk)
+
+
+def _ids_by_name(model, field, names):
+    """Return dict of name to id for the names that exist."""
+    result = {}
+    for chunk in _chunks(set(names)):
+        result.update(model.objects.filter(
+                **{field + '__in': chunk}).values_list(field, 'id'))
+    return result
+
+
+def _user_group_ids(names):
+    """Return dict of user group name to id, creating missing user groups.
+
+    User group names aren't unique: we use the first one.
+
+    """
+    ids = {}
+    for chunk in _chunks(set(names)):
+        for (name, user_group_id) in UserGroup.objects.filter(
+                name__in=chunk).order_by('-id').values_list('name', 'id'):
+            ids[name] = user_group_id
+    for name in set(names) - set(ids):
+        # Created one by one so that the signal handlers set up the nesting
+        # closure table; new user groups are rare.
+        ids[name] = UserGroup.objects.create(name=name).id
+    return ids
+
+
+def _moment(value):
+    """Return value as datetime; strings are parsed (ISO 8601)."""
+    if not value:
+        return None
+    if isinstance(value, basestring):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError("Invalid date/time: %r" % value)
+        value = parsed
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+
+class SyncResult(object):
+    """Counts of what a synchronization changed, plus what it skipped."""
+
+    def __init__(self):
+        self.added = 0
+        self.removed = 0
+        self.unknown = set()
+
+    def __repr__(self):
+        return '<SyncResult: %s added, %s removed, %s unknown>' % (
+            self.added, self.removed, len(self.unknown))
+
+
+def _sync_relation(field_name, desired, result):
+    """Synchronize the ``members`` or ``managers`` relation of user groups.
+
+    ``desired`` maps user group ids to sets of user ids. User groups that
+    aren't mentioned are left alone.
+
+    """
+    through = getattr(UserGroup, field_name).through
+    current = set()
+    for chunk in _chunks(desired):
+        current.update(through.objects.filter(
+                usergroup__in=chunk).values_list('usergroup', 'user'))
+    wanted = set((user_group_id, user_id)
+                 for (user_group_id, user_ids) in desired.items()
+                 for user_id in user_ids)
+    to_add = wanted - current
+    to_remove = current - wanted
+    _bulk_create(through,
+                 [through(usergroup_id=user_group_id, user_id=user_id)
+                  for (user_group_id, user_id) in to_add])
+    removals = {}
+    for (user_group_id, user_id) in to_remove:
+        removals.setdefault(user_group_id, []).append(user_id)
+    for (user_group_id, user_ids) in removals.items():
+        for chunk in _chunks(user_ids):
+            through.objects.filter(usergroup=user_group_id,
+                                   user__in=chunk).delete()
+    result.added += len(to_add)
+    result.removed += len(to_remove)
+
+
+def sync_memberships(desired):
+    """Make user group members and managers match ``desired``.
+
+    ``desired`` maps user group names to dictionaries with ``members`` and
+    optionally ``managers``, both lists of usernames. Managers are always
+    members, too. User groups that aren't mentioned are left alone.
+
+    Returns a ``SyncResult``.
+
+    """
+    result = SyncResult()
+    # The replica might not have the latest changes to compare with.
+    with replicas.primary():
+        with epoch.coalesced():
+            with atomic():
+                usernames = set()
+                for wanted in desired.values():
+                    usernames.update(wanted.get('members', []))
+                    usernames.update(wanted.get('managers', []))
+                user_ids = _ids_by_name(User, 'username', usernames)
+                result.unknown.update(usernames - set(user_ids))
+                user_group_ids = _user_group_ids(desired.keys())
+                members = {}
+                managers = {}
+                for (name, wanted) in desired.items():
+                    user_group_id = user_group_ids[name]
+                    manager_ids = set(
+                        [user_ids[username]
+                         for username in wanted.get('managers', [])
+                         if username in user_ids])
+                    managers[user_group_id] = manager_ids
+                    members[user_group_id] = manager_ids.union(
+                        [user_ids[username]
+                         for username in wanted.get('members', [])
+                         if username in user_ids])
+                _sync_relation('members', members, result)
+                _sync_relation('managers', managers, result)
+            epoch.bump()
+            replicas.security_written()
+    return result
+
+
+def sync_permission_mappers(desired):
+    """Make the permission mappers of user groups match ``desired``.
+
+    ``desired`` is a list of dictionaries with ``user_group`` and optionally
+    ``data_set``, ``permission_group``, ``name``, ``valid_from`` and
+    ``valid_until``. Permission mappers are identified by user group, data
+    set, permission group and validity. Only the permission mappers of the
+    mentioned user groups are synchronized.
+
+    Returns a ``SyncResult``.
+
+    """
+    result = SyncResult()
+    # The replica might not have the latest changes to compare with.
+    with replicas.primary():
+        with epoch.coalesced():
+            with atomic():
+                user_group_ids = _user_group_ids(
+                    set([mapper['user_group'] for mapper in desired]))
+                data_set_ids = _ids_by_name(
+                    DataSet, 'name', [mapper['data_set'] for mapper in desired
+                                      if mapper.get('data_set')])
+                group_ids = _ids_by_name(
+                    Group, 'name', [mapper['permission_group']
+                                    for mapper in desired
+                                    if mapper.get('permission_group')])
+                wanted = {}
+                for mapper in desired:
+                    data_set_id = group_id = None
+                    if mapper.get('data_set'):
+                        data_set_id = data_set_ids.get(mapper['data_set'])
+                        if data_set_id is None:
+                            result.unknown.add(mapper['data_set'])
+                            continue
+                    if mapper.get('permission_group'):
+                        group_id = group_ids.get(mapper['permission_group'])
+                        if group_id is None:
+                            result.unknown.add(mapper['permission_group'])
+                            continue
+                    key = (user_group_ids[mapper['user_group']],
+                           data_set_id,
+                           group_id,
+                           _moment(mapper.get('valid_from')),
+                           _moment(mapper.get('valid_until')))
+                    wanted[key] = mapper.get('name', '')
+                current = {}
+                for chunk in _chunks(user_group_ids.values()):
+                    for row in PermissionMapper.objects.filter(
+                            user_group__in=chunk).values_list(
+                            'user_group', 'data_set', 'permission_group',
+                            'valid_from', 'valid_until', 'id'):
+                        current.setdefault(row[:5], []).append(row[5])
+                new_keys = set(wanted) - set(current)
+                _bulk_create(
+                    PermissionMapper,
+                    [PermissionMapper(name=wanted[new_key],
+                                      user_group_id=new_key[0],
+                                      data_set_id=new_key[1],
+                                      permission_group_id=new_key[2],
+                                      valid_from=new_key[3],
+                                      valid_until=new_key[4])
+                     for new_key in new_keys])
+                result.added += len(new_keys)
+                obsolete_ids = [mapper_id
+                                for current_key in set(current) - set(wanted)
+                                for mapper_id in current[current_key]]
+                # Duplicates of wanted permission mappers are obsolete, too.
+                obsolete_ids += [mapper_id
+                                 for current_key in set(current) & set(wanted)
+                                 for mapper_id in current[current_key][1:]]
+                for chunk in _chunks(obsolete_ids):
+                    PermissionMapper.objects.filter(id__in=chunk).delete()
+                result.removed += len(obsolete_ids)
+            epoch.bump()
+            replicas.security_written()
+    return result
+
+
+def _assign_range(model, field, objects, data_set):
+    """Put the objects without a data set into the data set."""
+    if field is None:
+        return objects.filter(data_set=None).update(data_set=data_set)
+    object_ids = list(objects.filter(data_sets=None).values_list(
+            'pk', flat=True))
+    through = field.rel.through
+    _bulk_create(through,
+                 [through(**{field.m2m_column_name(): object_id,
+                             field.m2m_reverse_name(): data_set.id})
+                  for object_id in object_ids])
+    return len(object_ids)
+
+
+def assign_public_data_set(data_set, models=None):
+    """Move objects without a data set into ``data_set``, made public.
+
+    This is the migration path to ``LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC
+    = False``: the objects stay accessible to everybody, but through a
+    public data set, so the query filter doesn't need ``data_set IS NULL``
+    anymore. Objects with a ``data_sets`` field get a link to the data set.
+
+    Big tables are handled in primary key ranges of ``ASSIGN_CHUNK_SIZE``,
+    each in its own transaction, so rows aren't locked for long. Running it
+    again only handles what's still (or again) without a data set.
+
+    Returns a dict of model label (``app_label.model``) to the number of
+    objects that were assigned.
+
+    """
+    if models is None:
+        models = secured_models()
+    if not data_set.is_public:
+        data_set.is_public = True
+        data_set.save()
+    result = {}
+    for model in models:
+        label = model._meta.app_label + '.' + model._meta.module_name
+        field = data_sets_field(model)
+        manager = model._base_manager
+        bounds = manager.aggregate(low=Min('pk'), high=Max('pk'))
+        result[label] = 0
+        if bounds['low'] is None:
+            continue
+        for start in range(bounds['low'], bounds['high'] + 1,
+                           ASSIGN_CHUNK_SIZE):
+            with atomic():
+                result[label] += _assign_range(
+                    model, field,
+                    manager.filter(pk__gte=start,
+                                   pk__lt=start + ASSIGN_CHUNK_SIZE),
+                    data_set)
+        if result[label]:
+            # update() doesn't send signals.
+            resultcache.bump_data_version(model)
+    return result
@@ -0,0 +1,193 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Lizard-security normally filters in Python, through ``FilteredManager``. That
+doesn't protect raw SQL, reporting tools working on the database directly or
+everything else that bypasses the manager. For that, we can push the data set
+filtering into the database itself:
+
+- On PostgreSQL, every secured model's table gets a *row level security*
+  policy. It compares the ``data_set_id`` column (or the linked data sets,
+  for models with a ``data_sets`` many-to-many field) with the
+  per-connection ``lizard_security.allowed_data_set_ids`` setting.
+
+- On SQLite/SpatiaLite, which lack row level security, every secured model
+  gets a filtered ``secured_<table>`` view instead. Those views are
+  temporary, per connection, just like the list of allowed data sets they
+  read from.
+
+The ``create_security_policies`` management command installs the PostgreSQL
+policies. The ``DatabaseSecurityMiddleware`` fills in the allowed data sets
+for the duration of a request (and creates the SQLite views, once per
+connection). Superusers are unrestricted, explicitly.
+
+Connections that were never given their data sets (raw SQL outside of
+requests, reporting tools, management commands) only see the rows without a
+data set, if those are public. Everything else is denied. Run maintenance
+as a PostgreSQL role with ``BYPASSRLS``, or call ``set_access(connection,
+None)`` first.
+
+"""
+from django.db import DatabaseError
+
+from lizard_security.models import data_sets_field
+from lizard_security.models import null_data_set_is_public
+
+SESSION_VARIABLE = 'lizard_security.allowed_data_set_ids'
+POLICY_NAME = 'lizard_security'
+VIEW_PREFIX = 'secured_'
+ACCESS_TABLE = 'lizard_security_access'
+UNRESTRICTED_TABLE = 'lizard_security_unrestricted'
+# The setting's value for unrestricted connections.
+UNRESTRICTED = '*'
+
+
+def _secured_models():
+    # Imported here as the manager module imports the middleware, which
+    # imports us.
+    from lizard_security.manager import secured_models
+    return secured_models()
+
+
+def _access_condition(model, quote_name, allowed):
+    """Return the SQL condition for rows of the model we may access.
+
+    ``allowed`` is a template for the check of a data set id column, like
+    ``'%s IN (...)'``. Models with a ``data_sets`` many-to-many field are
+    checked through their link table. Rows without a data set are only
+    included while ``LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC`` is on.
+
+    """
+    table = quote_name(model._meta.db_table)
+    field = data_sets_field(model)
+    if field is None:
+        column = '%s.%s' % (table, quote_name(
+                model._meta.get_field('data_set').column))
+        if not null_data_set_is_public():
+            return allowed % column
+        return '%s IS NULL OR %s' % (column, allowed % column)
+    link_table = quote_name(field.rel.through._meta.db_table)
+    links = 'SELECT 1 FROM %s link WHERE link.%s = %s.%s' % (
+        link_table, quote_name(field.m2m_column_name()), table,
+        quote_name(model._meta.pk.column))
+    linked = 'EXISTS (%s AND %s)' % (
+        links, allowed % ('link.' + quote_name(field.m2m_reverse_name())))
+    if not null_data_set_is_public():
+        return linked
+    return 'NOT EXISTS (%s) OR %s' % (links, linked)
+
+
+def create_statements(connection, models=None):
+    """Return SQL statements creating the policies or views."""
+    if models is None:
+        models = _secured_models()
+    quote_name = connection.ops.quote_name
+    statements = []
+    if connection.vendor == 'postgresql':
+        setting = "current_setting('%s', true)" % SESSION_VARIABLE
+        # Unset (NULL or empty) means no data sets at all.
+        data_set_ids = "COALESCE(NULLIF(NULLIF(%s, ''), '%s'), '{}')" % (
+            setting, UNRESTRICTED)
+        for model in models:
+            table = quote_name(model._meta.db_table)
+            condition = _access_condition(
+                model, quote_name, '%%s = ANY (%s::integer[])' % data_set_ids)
+            statements += [
+                'ALTER TABLE %s ENABLE ROW LEVEL SECURITY' % table,
+                # Otherwise the table's owner (likely Django's own database
+                # user) isn't filtered.
+                'ALTER TABLE %s FORCE ROW LEVEL SECURITY' % table,
+                'DROP POLICY IF EXISTS %s ON %s' % (POLICY_NAME, table),
+                ('CREATE POLICY %s ON %s USING ('
+                 "COALESCE(%s, '') = '%s' OR %s)") % (
+                    POLICY_NAME, table, setting, UNRESTRICTED, condition),
+                ]
+    elif connection.vendor == 'sqlite':
+        statements += [
+            ('CREATE TEMP TABLE IF NOT EXISTS %s '
+             '(data_set_id INTEGER PRIMARY KEY)') % ACCESS_TABLE,
+            ('CREATE TEMP TABLE IF NOT EXISTS %s '
+             '(unrestricted INTEGER)') % UNRESTRICTED_TABLE,
+            ]
+        for model in models:
+            condition = _access_condition(
+                model, quote_name,
+                '%%s IN (SELECT data_set_id FROM temp.%s)' % ACCESS_TABLE)
+            statements.append(
+                ('CREATE TEMP VIEW IF NOT EXISTS %s AS SELECT * FROM %s '
+                 'WHERE EXISTS (SELECT 1 FROM temp.%s) OR %s') % (
+                    quote_name(VIEW_PREFIX + model._meta.db_table),
+                    quote_name(model._meta.db_table),
+                    UNRESTRICTED_TABLE, condition))
+    return statements
+
+
+def drop_statements(connection, models=None):
+    """Return SQL statements removing the policies or views."""
+    if models is None:
+        models = _secured_models()
+    quote_name = connection.ops.quote_name
+    statements = []
+    for model in models:
+        table = quote_name(model._meta.db_table)
+        if connection.vendor == 'postgresql':
+            statements += [
+                'DROP POLICY IF EXISTS %s ON %s' % (POLICY_NAME, table),
+                'ALTER TABLE %s NO FORCE ROW LEVEL SECURITY' % table,
+                'ALTER TABLE %s DISABLE ROW LEVEL SECURITY' % table,
+                ]
+        elif connection.vendor == 'sqlite':
+            statements.append('DROP VIEW IF EXISTS %s' % quote_name(
+                    VIEW_PREFIX + model._meta.db_table))
+    return statements
+
+
+def set_access(connection, data_set_ids):
+    """Restrict the connection to the data sets (None means: unrestricted).
+
+    With PostgreSQL, mind that the setting is transactional: a rollback
+    also rolls back the setting. Django 1.6's autocommit mode is fine.
+
+    """
+    connection._lizard_security_data_set_ids = data_set_ids
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        if data_set_ids is None:
+            value = UNRESTRICTED
+        else:
+            value = '{%s}' % ','.join(
+                [str(int(data_set_id)) for data_set_id in data_set_ids])
+        cursor.execute('SELECT set_config(%s, %s, false)',
+                       [SESSION_VARIABLE, value])
+    elif connection.vendor == 'sqlite':
+        # Temporary views and tables live as long as the database
+        # connection, so they're only created when they aren't there (yet,
+        # or anymore after a rollback).
+        try:
+            cursor.execute('DELETE FROM temp.%s' % ACCESS_TABLE)
+        except DatabaseError:
+            for statement in create_statements(connection):
+                cursor.execute(statement)
+        cursor.execute('DELETE FROM temp.%s' % UNRESTRICTED_TABLE)
+        if data_set_ids is None:
+            cursor.execute(
+                'INSERT INTO temp.%s VALUES (1)' % UNRESTRICTED_TABLE)
+        else:
+            cursor.executemany(
+                'INSERT INTO temp.%s VALUES (%%s)' % ACCESS_TABLE,
+                [(int(data_set_id), ) for data_set_id in data_set_ids])
+
+
+def get_access(connection):
+    """Return the data sets ``set_access()`` restricted the connection to.
+
+    That's None for unrestricted connections and no data sets at all for
+    connections that were never set up.
+
+    """
+    return getattr(connection, '_lizard_security_data_set_ids', ())
+
+
+def reset_access(connection):
+    """Deny all data sets again, for instance at the end of a request."""
+    set_access(connection, ())
@@ -0,0 +1,90 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+In-process copies of security information (lookup trees, access snapshots)
+need to know when the database changed underneath them. For that we keep
+*epochs*: counters in Django's cache that are bumped on every change. A copy
+remembers the epoch it was built for and is rebuilt when the epoch differs.
+
+With more than one process, the cache must be shared between them
+(memcached, for instance) for the epochs to be seen by all. The cache alias
+can be set with ``LIZARD_SECURITY_CACHE``, it defaults to ``'default'``.
+
+Bulk changes can wrap their work in ``coalesced()``: all bumps inside it are
+combined into one bump per epoch at the end.
+
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+SECURITY_EPOCH = 'security'
+IP_RANGES_EPOCH = 'ip_ranges'
+
+KEY_TEMPLATE = 'lizard_security.epoch.%s'
+# Epochs shouldn't expire from the cache on their own.
+TIMEOUT = 60 * 60 * 24 * 365
+# Names of epochs bumped inside a coalesced() block, per thread.
+_pending = threading.local()
+
+
+def _cache():
+    return get_cache(getattr(settings, 'LIZARD_SECURITY_CACHE', 'default'))
+
+
+def current(name=SECURITY_EPOCH):
+    """Return the current value of the epoch.
+
+    A missing epoch (cold or flushed cache) is initialized with the current
+    time in milliseconds, so that it never returns to a value that was seen
+    before.
+
+    """
+    cache = _cache()
+    key = KEY_TEMPLATE % name
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, int(time.time() * 1000), TIMEOUT)
+        value = cache.get(key)
+    return value
+
+
+def bump(name=SECURITY_EPOCH):
+    """Move the epoch forward, invalidating everything built for it."""
+    pending = getattr(_pending, 'names', None)
+    if pending is not None:
+        pending.add(name)
+        return
+    cache = _cache()
+    key = KEY_TEMPLATE % name
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Not in the cache (anymore).
+        return current(name)
+
+
+@contextmanager
+def coalesced():
+    """Postpone all bumps in this thread until the end of the block.
+
+    Every epoch that was bumped at least once inside the block is bumped
+    exactly once afterwards, also when an exception occurred (the changes
+    might have been partially made). Nested blocks are combined with the
+    outer one.
+
+    """
+    if getattr(_pending, 'names', None) is not None:
+        yield
+        return
+    _pending.names = set()
+    try:
+        yield
+    finally:
+        names = _pending.names
+        _pending.names = None
+        for name in sorted(names):
+            bump(name)
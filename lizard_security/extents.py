@@ -0,0 +1,310 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Map tiles query geo models with a bounding box, across all allowed data
+sets, while most of those data sets have nothing in the tile. We keep the
+bounding box (*extent*) of every data set's objects per model, so that such
+queries only need to filter on the data sets that can have objects in the
+box::
+
+    class Measurement(models.Model):
+        ...
+        objects = FilteredGeoManager(track_extents=True)
+
+    Measurement.objects.in_bbox((4.1, 52.0, 4.2, 52.1))
+
+The extents are stored in ``DataSetExtent`` and kept up to date on save and
+delete: saving grows the extent of the object's data set, deleting an
+object on the edge of its data set's extent computes that extent again. An
+extent can thus be larger than needed, but never too small. Changes that
+don't send signals (``update()``, ``bulk_create()``, raw SQL) aren't
+noticed: run the ``rebuild_extents`` management command afterwards, and
+once after enabling ``track_extents`` for existing objects.
+
+Every process keeps a copy of the extents of a model in memory, until the
+model's extents epoch is bumped.
+
+Note that the ``post_delete`` handler keeps Django from deleting the objects
+of a deleted data set without fetching them first.
+
+"""
+from contextlib import contextmanager
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.db.models.query import GeoQuerySet
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import Polygon
+from django.db import DEFAULT_DB_ALIAS
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from lizard_security import epoch
+from lizard_security import sharding
+from lizard_security.models import DataSetExtent
+
+# Models whose extents we keep, by label.
+tracked = {}
+# Per model label: the epoch and the extents by data set id.
+_extents = {}
+_extents_lock = threading.Lock()
+
+
+@contextmanager
+def _savepoint():
+    """Undo the block's changes on errors, but not those of the caller.
+
+    Like Django 1.6's ``atomic()`` inside a transaction. Older versions'
+    ``commit_on_success()`` would roll back the caller's transaction.
+
+    """
+    savepoint = transaction.savepoint()
+    try:
+        yield
+    except Exception:
+        transaction.savepoint_rollback(savepoint)
+        raise
+    else:
+        transaction.savepoint_commit(savepoint)
+
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    # Django < 1.6
+    atomic = _savepoint
+
+
+def _label(model):
+    return model._meta.app_label + '.' + model._meta.module_name
+
+
+def _epoch_name(model):
+    return 'extents.' + _label(model)
+
+
+def geometry_field(model):
+    """Return the model's (first) geometry field, None if it has none."""
+    for field in model._meta.fields:
+        if isinstance(field, GeometryField):
+            return field
+    return None
+
+
+def track(model):
+    """Keep the extents of the model's objects up to date."""
+    tracked[_label(model)] = model
+    dispatch_uid = 'lizard_security_extents'
+    post_save.connect(object_saved, sender=model, weak=False,
+                      dispatch_uid=dispatch_uid)
+    post_delete.connect(object_deleted, sender=model, weak=False,
+                        dispatch_uid=dispatch_uid)
+
+
+def untrack(model):
+    """Stop keeping the extents of the model's objects."""
+    tracked.pop(_label(model), None)
+    dispatch_uid = 'lizard_security_extents'
+    post_save.disconnect(sender=model, dispatch_uid=dispatch_uid)
+    post_delete.disconnect(sender=model, dispatch_uid=dispatch_uid)
+
+
+def is_tracked(model):
+    return _label(model) in tracked
+
+
+def _box(model, geometry):
+    """Return ``(xmin, ymin, xmax, ymax)`` of the geometry, None if empty.
+
+    Geometries in another SRID than the model's field are transformed.
+
+    """
+    if geometry is None:
+        return None
+    if not isinstance(geometry, GEOSGeometry):
+        # A bounding box already.
+        return tuple([float(value) for value in geometry])
+    if geometry.empty:
+        return None
+    srid = geometry_field(model).srid
+    if geometry.srid and srid and geometry.srid != srid:
+        geometry = geometry.transform(srid, clone=True)
+    return geometry.extent
+
+
+def _object_box(model, instance):
+    if getattr(instance, 'data_set_id', None) is None:
+        return None
+    return _box(model, getattr(instance, geometry_field(model).attname))
+
+
+def intersects(box, other):
+    """Return whether two boxes overlap or touch."""
+    return not (box[2] < other[0] or box[0] > other[2] or
+                box[3] < other[1] or box[1] > other[3])
+
+
+def contains(box, other):
+    """Return whether the first box contains the second one."""
+    return (box[0] <= other[0] and box[1] <= other[1] and
+            box[2] >= other[2] and box[3] >= other[3])
+
+
+def _rows(model):
+    """Return the model's ``DataSetExtent`` rows, on the primary database.
+
+    A replica might not have our latest growth yet.
+
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    return DataSetExtent.objects.using(DEFAULT_DB_ALIAS).filter(
+        content_type=content_type)
+
+
+def extents(model):
+    """Return a dict of data set id to extent of the model's objects.
+
+    Data sets without (geometries of) objects aren't in there.
+
+    """
+    label = _label(model)
+    current_epoch = epoch.current(_epoch_name(model))
+    cached = _extents.get(label)
+    if cached is None or cached[0] != current_epoch:
+        with _extents_lock:
+            cached = _extents.get(label)
+            if cached is None or cached[0] != current_epoch:
+                rows = _rows(model).values_list(
+                    'data_set', 'xmin', 'ymin', 'xmax', 'ymax')
+                cached = (current_epoch,
+                          dict([(row[0], row[1:]) for row in rows]))
+                _extents[label] = cached
+    return cached[1]
+
+
+def grow(model, data_set_id, box):
+    """Make the data set's extent include the box."""
+    existing = _rows(model).filter(data_set=data_set_id)
+    if not existing.exists():
+        try:
+            with atomic():
+                DataSetExtent.objects.create(
+                    content_type=ContentType.objects.get_for_model(model),
+                    data_set_id=data_set_id,
+                    xmin=box[0], ymin=box[1], xmax=box[2], ymax=box[3])
+        except IntegrityError:
+            # Somebody else was first; grow theirs below.
+            pass
+        else:
+            epoch.bump(_epoch_name(model))
+            return
+    # Every update only moves an edge outwards, so concurrent growth of the
+    # same extent doesn't get lost.
+    changed = (existing.filter(xmin__gt=box[0]).update(xmin=box[0]) +
+               existing.filter(ymin__gt=box[1]).update(ymin=box[1]) +
+               existing.filter(xmax__lt=box[2]).update(xmax=box[2]) +
+               existing.filter(ymax__lt=box[3]).update(ymax=box[3]))
+    if changed:
+        epoch.bump(_epoch_name(model))
+
+
+def recompute(model, data_set_ids):
+    """Compute the extents of the data sets from the objects."""
+    content_type = ContentType.objects.get_for_model(model)
+    field_name = geometry_field(model).name
+    for data_set_id in data_set_ids:
+        box = GeoQuerySet(model).using(
+            sharding.shard_for_data_set(data_set_id)).filter(
+            data_set=data_set_id).extent(field_name=field_name)
+        existing = _rows(model).filter(data_set=data_set_id)
+        if box is None:
+            existing.delete()
+        elif not existing.update(xmin=box[0], ymin=box[1],
+                                 xmax=box[2], ymax=box[3]):
+            DataSetExtent.objects.create(
+                content_type=content_type, data_set_id=data_set_id,
+                xmin=box[0], ymin=box[1], xmax=box[2], ymax=box[3])
+    epoch.bump(_epoch_name(model))
+
+
+def rebuild(model):
+    """Compute all extents of the model again; return the data set count."""
+    data_set_ids = set()
+    for alias in sharding.configured_shards():
+        data_set_ids.update(
+            GeoQuerySet(model).using(alias).exclude(data_set=None).values_list(
+                'data_set', flat=True).distinct())
+    _rows(model).exclude(data_set__in=data_set_ids).delete()
+    recompute(model, sorted(data_set_ids))
+    return len(data_set_ids)
+
+
+def object_saved(sender, instance, raw=False, **kwargs):
+    """Grow the extent of the object's data set, a ``post_save`` handler.
+
+    Moving an object to another place or data set leaves the old extent as
+    it is: too large doesn't hurt.
+
+    """
+    if raw:
+        return
+    box = _object_box(sender, instance)
+    if box is None:
+        return
+    extent = extents(sender).get(instance.data_set_id)
+    if extent is not None and contains(extent, box):
+        # Nothing to do, without a query.
+        return
+    grow(sender, instance.data_set_id, box)
+
+
+def object_deleted(sender, instance, **kwargs):
+    """Shrink the extent of the object's data set, a ``post_delete`` handler.
+
+    Only objects on the edge of the extent matter.
+
+    """
+    box = _object_box(sender, instance)
+    if box is None:
+        return
+    extent = extents(sender).get(instance.data_set_id)
+    if extent is None:
+        return
+    if (box[0] > extent[0] and box[1] > extent[1] and
+        box[2] < extent[2] and box[3] < extent[3]):
+        return
+    recompute(sender, [instance.data_set_id])
+
+
+def bounding_box(model, bbox):
+    """Return the bbox (a geometry or a tuple) as box and as polygon."""
+    box = _box(model, bbox)
+    polygon = Polygon.from_bbox(box)
+    polygon.srid = geometry_field(model).srid
+    return box, polygon
+
+
+def prune(model, bbox, data_set_ids):
+    """Return the data sets, without those whose extent misses the bbox.
+
+    Pass the data sets including their descendants, the objects are in
+    those. Data sets without an extent are kept: their objects might have
+    been added without signals, before a ``rebuild_extents``.
+
+    """
+    box = bounding_box(model, bbox)[0]
+    model_extents = extents(model)
+    return sorted([data_set_id for data_set_id in data_set_ids
+                   if data_set_id not in model_extents or
+                   intersects(model_extents[data_set_id], box)])
+
+
+def filter_bbox(query_set, bbox, lookup='intersects'):
+    """Return the query set limited to geometries matching the bbox."""
+    model = query_set.model
+    polygon = bounding_box(model, bbox)[1]
+    return query_set.filter(
+        **{'%s__%s' % (geometry_field(model).name, lookup): polygon})
@@ -0,0 +1,104 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Lookup of IP addresses in a collection of network ranges.
+
+``PrefixTree`` is a binary trie (radix tree) on the bits of the network
+address. Looking up an address walks at most 32 (IPv4) or 128 (IPv6) steps,
+however many ranges there are. That's what the ``IPRangeMiddleware`` needs to
+map client addresses to user groups on every request.
+
+"""
+import socket
+
+IPV4_BITS = 32
+IPV6_BITS = 128
+# IPv4 addresses as seen by an IPv6 socket look like ``::ffff:10.0.0.1``.
+IPV4_MAPPED_PREFIX = 0xffff << 32
+
+
+def parse_address(address):
+    """Return ``(number of bits, address as integer)`` for an IP address.
+
+    IPv4-mapped IPv6 addresses are returned as IPv4. Raises ValueError for
+    anything that isn't an IP address.
+
+    """
+    address = address.strip()
+    for family, bits in ((socket.AF_INET, IPV4_BITS),
+                         (socket.AF_INET6, IPV6_BITS)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        number = int(packed.encode('hex'), 16)
+        if bits == IPV6_BITS and number >> 32 == IPV4_MAPPED_PREFIX >> 32:
+            return (IPV4_BITS, number & 0xffffffff)
+        return (bits, number)
+    raise ValueError("%r is not an IP address" % address)
+
+
+def parse_network(network):
+    """Return ``(number of bits, address, prefix length)`` for a CIDR range.
+
+    A plain address counts as a range of one. Raises ValueError for invalid
+    input.
+
+    """
+    if '/' in network:
+        address, prefix_length = network.split('/', 1)
+        try:
+            prefix_length = int(prefix_length)
+        except ValueError:
+            raise ValueError("%r has an invalid prefix length" % network)
+    else:
+        address, prefix_length = network, None
+    bits, number = parse_address(address)
+    if prefix_length is None:
+        prefix_length = bits
+    if not 0 <= prefix_length <= bits:
+        raise ValueError("%r has an invalid prefix length" % network)
+    return (bits, number, prefix_length)
+
+
+class PrefixTree(object):
+    """Binary trie mapping network ranges to sets of values.
+
+    Each node is a list ``[zero child, one child, values]``. There is a
+    separate root for IPv4 and IPv6.
+
+    """
+
+    def __init__(self):
+        self._roots = {IPV4_BITS: [None, None, set()],
+                       IPV6_BITS: [None, None, set()]}
+
+    def add(self, network, value):
+        """Add ``value`` for all addresses in ``network``."""
+        bits, number, prefix_length = parse_network(network)
+        node = self._roots[bits]
+        for position in range(prefix_length):
+            bit = (number >> (bits - 1 - position)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, set()]
+            node = node[bit]
+        node[2].add(value)
+
+    def lookup(self, address):
+        """Return the set of values of all ranges containing ``address``.
+
+        An invalid address matches nothing.
+
+        """
+        try:
+            bits, number = parse_address(address)
+        except ValueError:
+            return set()
+        node = self._roots[bits]
+        result = set(node[2])
+        for position in range(bits):
+            node = node[(number >> (bits - 1 - position)) & 1]
+            if node is None:
+                break
+            result.update(node[2])
+        return result
@@ -0,0 +1,32 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_security import bulk
+from lizard_security.models import DataSet
+
+
+class Command(BaseCommand):
+    """Move objects without a data set into a public data set.
+
+    The data set is created when no data set has that name yet. Afterwards,
+    set ``LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC = False`` for index
+    friendly filtering. See ``bulk.assign_public_data_set()``.
+
+    """
+    args = '<data set name>'
+    help = ("Put all secured objects without a data set into the given "
+            "(public) data set.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Pass exactly one data set name.")
+        data_set = DataSet.objects.filter(name=args[0]).order_by('id')[:1]
+        if data_set:
+            data_set = data_set[0]
+        else:
+            data_set = DataSet.objects.create(name=args[0], is_public=True)
+        result = bulk.assign_public_data_set(data_set)
+        for label in sorted(result):
+            self.stdout.write("%s: %s objects assigned." % (
+                    label, result[label]))
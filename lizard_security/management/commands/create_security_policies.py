@@ -0,0 +1,57 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+from lizard_security import dbpolicies
+
+
+class Command(BaseCommand):
+    """Install (or remove) database level filtering of secured models.
+
+    See ``lizard_security.dbpolicies``. On SQLite the views are temporary and
+    created per connection by ``DatabaseSecurityMiddleware``, so there we
+    only print them.
+
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Database to use. Default is "default".'),
+        make_option('--drop',
+                    action='store_true',
+                    dest='drop',
+                    default=False,
+                    help='Remove the policies instead of creating them.'),
+        make_option('--print-sql',
+                    action='store_true',
+                    dest='print_sql',
+                    default=False,
+                    help='Only print the SQL statements.'),
+        )
+    help = ("Create row level security policies for models secured by "
+            "lizard-security.")
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError(
+                "Database policies are only supported on PostgreSQL and "
+                "SQLite, not on %s." % connection.vendor)
+        if options['drop']:
+            statements = dbpolicies.drop_statements(connection)
+        else:
+            statements = dbpolicies.create_statements(connection)
+        if options['print_sql'] or connection.vendor == 'sqlite':
+            for statement in statements:
+                self.stdout.write(statement + ';')
+            return
+        cursor = connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        self.stdout.write("Executed %s statements." % len(statements))
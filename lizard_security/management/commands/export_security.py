@@ -0,0 +1,38 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_security import transfer
+
+
+class Command(BaseCommand):
+    """Export the security configuration, streaming, with natural keys.
+
+    See ``lizard_security.transfer``. Without a file argument, the records
+    are written to standard output.
+
+    """
+    args = '[output file]'
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    action='store',
+                    dest='format',
+                    default=transfer.JSON_LINES,
+                    choices=[transfer.JSON_LINES, transfer.CSV],
+                    help='Output format: jsonl (default) or csv.'),
+        )
+    help = ("Export data sets, user groups and permission mappers as JSON "
+            "lines or CSV.")
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Pass at most one output file.")
+        if not args:
+            transfer.export(sys.stdout, format=options['format'])
+            return
+        with open(args[0], 'wb') as output:
+            count = transfer.export(output, format=options['format'])
+        self.stdout.write("Exported %s records." % count)
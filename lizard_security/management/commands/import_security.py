@@ -0,0 +1,42 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_security import transfer
+
+
+class Command(BaseCommand):
+    """Import a security configuration written by ``export_security``.
+
+    Existing objects with the same natural keys are re-used, nothing is
+    removed. See ``lizard_security.transfer``.
+
+    """
+    args = '<input file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    action='store',
+                    dest='format',
+                    default=transfer.JSON_LINES,
+                    choices=[transfer.JSON_LINES, transfer.CSV],
+                    help='Input format: jsonl (default) or csv.'),
+        )
+    help = ("Import data sets, user groups and permission mappers from JSON "
+            "lines or CSV.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Pass exactly one input file.")
+        try:
+            with open(args[0], 'rb') as input:
+                importer = transfer.import_records(
+                    transfer.read(input, format=options['format']))
+        except (IOError, ValueError, KeyError), e:
+            raise CommandError("Cannot import %s: %s" % (args[0], e))
+        for record_type in sorted(importer.created):
+            self.stdout.write("%s: %s created." % (
+                    record_type, importer.created[record_type]))
+        for name in sorted(importer.unknown):
+            self.stderr.write("Unknown, skipped: %s" % name)
@@ -0,0 +1,30 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_security import extents
+from lizard_security.manager import secured_models
+
+
+class Command(BaseCommand):
+    """Compute the extents per data set of geo models again.
+
+    Run it once after enabling ``track_extents`` and after changes that don't
+    send signals. See ``lizard_security.extents``.
+
+    """
+    args = '[<app_label.model> ...]'
+    help = ("Compute the data set extents of the given models, or of all "
+            "models with track_extents.")
+
+    def handle(self, *args, **options):
+        # Loads all models, so that they're tracked.
+        secured_models()
+        labels = [label.lower() for label in args] or sorted(extents.tracked)
+        for label in labels:
+            if label not in extents.tracked:
+                raise CommandError(
+                    "%s doesn't keep extents (track_extents)." % label)
+        for label in labels:
+            count = extents.rebuild(extents.tracked[label])
+            self.stdout.write("%s: extents of %s data sets." % (label, count))
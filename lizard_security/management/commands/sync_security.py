@@ -0,0 +1,51 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+import json
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_security import bulk
+
+
+class Command(BaseCommand):
+    """Synchronize user groups and permission mappers from a JSON file.
+
+    The file looks like this (both keys are optional)::
+
+        {"user_groups": {
+             "editors": {"members": ["piet", "klaas"],
+                         "managers": ["jan"]}},
+         "permission_mappers": [
+             {"user_group": "editors",
+              "data_set": "Noord",
+              "permission_group": "edit-something",
+              "valid_until": "2015-01-01T00:00:00"}]}
+
+    See ``lizard_security.bulk`` for the details.
+
+    """
+    args = '<json file>'
+    help = ("Synchronize user group memberships and permission mappers with "
+            "a JSON file, applying only the differences.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Pass exactly one JSON file.")
+        try:
+            with open(args[0]) as json_file:
+                desired = json.load(json_file)
+        except (IOError, ValueError), e:
+            raise CommandError("Cannot read %s: %s" % (args[0], e))
+        if 'user_groups' in desired:
+            result = bulk.sync_memberships(desired['user_groups'])
+            self.report('Memberships', result)
+        if 'permission_mappers' in desired:
+            result = bulk.sync_permission_mappers(
+                desired['permission_mappers'])
+            self.report('Permission mappers', result)
+
+    def report(self, what, result):
+        self.stdout.write("%s: %s added, %s removed." % (
+                what, result.added, result.removed))
+        for name in sorted(result.unknown):
+            self.stderr.write("Unknown, skipped: %s" % name)
@@ -5,36 +5,313 @@ To securely filter our objects we don't have access to, we use a custom Django
 object manager: ``FilteredManager``. We have to set that object manager on our
 models.
 
+Models without a data set of their own can use ``SecuredJoinManager``: when
+their queries join secured models, those joined models are filtered, too.
+
 """
+from django.conf import settings
 from django.contrib.gis.db.models import GeoManager
-from django.db.models.manager import Manager
+from django.contrib.gis.db.models.sql.query import GeoQuery
+from django.db import connection
 from django.db.models import Q
+from django.db.models import get_models
+from django.db.models.manager import Manager
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.sql.query import Query
+from django.db.models.sql.subqueries import DateQuery
+from django.db.models.sql.subqueries import UpdateQuery
+from django.db.models.sql.where import AND
 from tls import request
 
+from lizard_security import audit
+from lizard_security import extents
+from lizard_security import resultcache
+from lizard_security import sharding
+from lizard_security import strategies
+from lizard_security.backends import VIEW_PERMISSION
 from lizard_security.middleware import ALLOWED_DATA_SET_IDS
+from lizard_security.middleware import DATABASE_FILTERED
+from lizard_security.models import DataSetAncestor
+from lizard_security.models import data_sets_field
+from lizard_security.models import null_data_set_is_public
+
+
+def _allowed_data_set_ids(model_class):
+    """Return the data sets to filter on, or None if we don't filter."""
+    try:
+        user = request.user
+    except RuntimeError:
+        # We don't have a local request object.
+        return
+    if user is not None and user.is_superuser:
+        return
+    if (getattr(settings, 'LIZARD_SECURITY_SKIP_QUERY_FILTER', False) and
+        getattr(request, DATABASE_FILTERED, False)):
+        # The database's row level security policies take care of it.
+        return
+    data_set_ids = getattr(request, ALLOWED_DATA_SET_IDS, None) or ()
+    audit.record(user, data_set_ids,
+                 model=model_class._meta.app_label + '.' +
+                 model_class._meta.module_name,
+                 perm=VIEW_PERMISSION)
+    # Sorted, so equal sets of data sets result in identical SQL.
+    return sorted(data_set_ids)
 
 
 def data_set_filter(model_class):
     """Filter that checks if we're properly allowed via the dataset.
 
     If data set is empty, that counts as "everybody has access". Otherwise we
-    only have access to data sets available to us as user.
+    only have access to data sets available to us as user, including their
+    descendants. Those are looked up in the data set closure table in a
+    subquery, so the database resolves the hierarchy in the same statement.
+
+    The ``data_set IS NULL OR data_set IN (...)`` combination often keeps
+    databases from using the data set index. With
+    ``LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC = False``, objects without a
+    data set aren't public anymore and the filter is only the ``IN``: public
+    objects belong to a public data set instead, which is in our allowed
+    data sets already.
+
+    This is the ``'subquery'`` strategy as a Q object. ``FilteredManager``
+    can be configured to use other shapes, see ``lizard_security.strategies``.
 
     """
-    empty_data_set = Q(data_set=None)
-    try:
-        user = request.user
-    except RuntimeError:
-        # We don't have a local request object.
+    data_set_ids = _allowed_data_set_ids(model_class)
+    if data_set_ids is None:
         return
-    if user is not None and user.is_superuser:
+    return strategies.SUBQUERY.condition(data_set_ids,
+                                         null_data_set_is_public())
+
+
+def data_sets_where(model_class):
+    """Return ``(where, params)`` for models with a ``data_sets`` field.
+
+    The same rules as ``data_set_filter()``, for use with ``extra()``.
+    Objects without data sets are accessible to everybody (unless
+    ``LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC`` is False), others through
+    any of their data sets. Both are correlated ``EXISTS`` subqueries on the
+    link table, so the objects aren't joined with (and duplicated by) their
+    data sets.
+
+    """
+    data_set_ids = _allowed_data_set_ids(model_class)
+    if data_set_ids is None:
         return
-    data_set_ids = getattr(request, ALLOWED_DATA_SET_IDS, None)
-    if data_set_ids:
-        match_with_data_set = Q(data_set__in=data_set_ids)
-        return empty_data_set | match_with_data_set
+    where, params = _data_sets_condition(
+        model_class, connection.ops.quote_name(model_class._meta.db_table),
+        data_set_ids, connection)
+    return [where], params
+
+
+def _data_sets_condition(model_class, table, data_set_ids, connection):
+    """Return ``(sql, params)`` for objects with a ``data_sets`` field.
+
+    ``table`` is the (quoted) table name or alias of the objects.
+
+    """
+    quote_name = connection.ops.quote_name
+    field = data_sets_field(model_class)
+    links = 'SELECT 1 FROM %s link WHERE link.%s = %s.%s' % (
+        quote_name(field.rel.through._meta.db_table),
+        quote_name(field.m2m_column_name()),
+        table,
+        quote_name(model_class._meta.pk.column))
+    if null_data_set_is_public():
+        unlinked = 'NOT EXISTS (%s)' % links
+    else:
+        unlinked = None
+    if not data_set_ids:
+        return unlinked or '1 = 0', []
+    allowed = 'EXISTS (%s AND link.%s IN (%s))' % (
+        links,
+        quote_name(field.m2m_reverse_name()),
+        _descendants_sql(data_set_ids, connection))
+    if unlinked is None:
+        return allowed, list(data_set_ids)
+    return '(%s OR %s)' % (unlinked, allowed), list(data_set_ids)
+
+
+def _descendants_sql(data_set_ids, connection):
+    """Return a subquery selecting the data sets and their descendants."""
+    quote_name = connection.ops.quote_name
+    closure = DataSetAncestor._meta
+    return 'SELECT %s FROM %s WHERE %s IN (%s)' % (
+        quote_name(closure.get_field('descendant').column),
+        quote_name(closure.db_table),
+        quote_name(closure.get_field('ancestor').column),
+        ', '.join(['%s'] * len(data_set_ids)))
+
+
+def _data_set_condition(model_class, table, data_set_ids, connection):
+    """Return ``(sql, params)`` for objects with a ``data_set`` field.
+
+    ``table`` is the (quoted) table name or alias of the objects.
+
+    """
+    column = '%s.%s' % (table, connection.ops.quote_name(
+            model_class._meta.get_field('data_set').column))
+    if null_data_set_is_public():
+        empty = '%s IS NULL' % column
     else:
-        return empty_data_set
+        empty = None
+    if not data_set_ids:
+        return empty or '1 = 0', []
+    allowed = '%s IN (%s)' % (column,
+                              _descendants_sql(data_set_ids, connection))
+    if empty is None:
+        return allowed, list(data_set_ids)
+    return '(%s OR %s)' % (empty, allowed), list(data_set_ids)
+
+
+def join_conditions(query, connection, quote_alias):
+    """Return ``(sql, params)`` restricting the query's joined secured models.
+
+    Every table of a secured model that the query joins (for a filter like
+    ``content__name='x'`` or an ordering on ``content__name``, for instance)
+    gets the same data set restriction as the model's own manager would
+    add. Rows of an outer join that didn't find a related object are kept;
+    rows whose related object we may not see are left out, also when the
+    join is only there for ``select_related()``. The query's own model isn't
+    looked at: that's up to its manager.
+
+    ``quote_alias`` is the compiler's function for quoting table aliases.
+    Returns None when there's nothing to restrict.
+
+    """
+    secured = dict([(model._meta.db_table, model)
+                    for model in secured_models()])
+    conditions = []
+    params = []
+    for alias, join in sorted(query.alias_map.items()):
+        # Index based, as the join information differs between Django
+        # versions: table name, right hand side alias, join type, ...
+        table_name, join_type = join[0], join[2]
+        model_class = secured.get(table_name)
+        if (model_class is None or join_type is None or
+            not query.alias_refcount.get(alias)):
+            continue
+        data_set_ids = _allowed_data_set_ids(model_class)
+        if data_set_ids is None:
+            continue
+        table = quote_alias(alias)
+        if data_sets_field(model_class) is None:
+            sql, condition_params = _data_set_condition(
+                model_class, table, data_set_ids, connection)
+        else:
+            sql, condition_params = _data_sets_condition(
+                model_class, table, data_set_ids, connection)
+        if join_type == query.LOUTER:
+            sql = '(%s.%s IS NULL OR %s)' % (
+                table, connection.ops.quote_name(model_class._meta.pk.column),
+                sql)
+        conditions.append(sql)
+        params += condition_params
+    if not conditions:
+        return None
+    return ' AND '.join(conditions), params
+
+
+class SecuredJoinsWhere(object):
+    """Where clause node with the restrictions of ``join_conditions()``.
+
+    The restrictions are determined while the SQL is compiled, after the
+    compiler added the joins for ordering and ``select_related()``.
+
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+    def as_sql(self, qn=None, connection=None):
+        result = join_conditions(self.query, connection, qn)
+        if result is None:
+            # Leaves the where clause alone.
+            return None, []
+        return result
+
+
+class SecuredJoinsMixin(object):
+    """Query that restricts its joins into secured models when compiled.
+
+    ``update()``, ``dates()`` and ``datetimes()`` clone the query into a
+    query class of their own: those clones get the mixin, too.
+
+    """
+
+    def clone(self, klass=None, **kwargs):
+        if klass is not None and not issubclass(klass, SecuredJoinsMixin):
+            klass = _secured_query_class(klass)
+        return super(SecuredJoinsMixin, self).clone(klass, **kwargs)
+
+    def get_compiler(self, using=None, connection=None):
+        query = self.clone()
+        query.where.add(SecuredJoinsWhere(query), AND)
+        return super(SecuredJoinsMixin, query).get_compiler(using, connection)
+
+
+class SecuredJoinQuery(SecuredJoinsMixin, Query):
+    pass
+
+
+class SecuredJoinGeoQuery(SecuredJoinsMixin, GeoQuery):
+    pass
+
+
+class SecuredJoinUpdateQuery(SecuredJoinsMixin, UpdateQuery):
+    """Update query whose joins are restricted in their own subquery.
+
+    The update compiler moves joins into a ``pk__in`` subquery, cloned
+    into a secured query. Cloning the update query itself would lose the
+    values to update.
+
+    """
+
+    def get_compiler(self, using=None, connection=None):
+        return super(SecuredJoinsMixin, self).get_compiler(using, connection)
+
+
+class SecuredJoinDateQuery(SecuredJoinsMixin, DateQuery):
+    pass
+
+
+_secured_query_classes = {
+    Query: SecuredJoinQuery,
+    GeoQuery: SecuredJoinGeoQuery,
+    UpdateQuery: SecuredJoinUpdateQuery,
+    DateQuery: SecuredJoinDateQuery,
+    }
+
+
+def _secured_query_class(klass):
+    """Return the query class with ``SecuredJoinsMixin`` for ``klass``."""
+    secured = _secured_query_classes.get(klass)
+    if secured is None:
+        # Django 1.6's DateTimeQuery, for instance.
+        secured = type('SecuredJoin' + klass.__name__,
+                       (SecuredJoinsMixin, klass), {})
+        _secured_query_classes[klass] = secured
+    return secured
+
+
+def secure_joins(query_set):
+    """Return a copy of the query set that restricts joined secured models.
+
+    See ``join_conditions()``. The data set restrictions end up in the same
+    SQL statement, so there's no need to fetch the ids of the allowed
+    related objects first.
+
+    """
+    if isinstance(query_set.query, SecuredJoinsMixin):
+        return query_set._clone()
+    if isinstance(query_set.query, GeoQuery):
+        klass = SecuredJoinGeoQuery
+    else:
+        klass = SecuredJoinQuery
+    clone = query_set._clone()
+    clone.query = clone.query.clone(klass=klass)
+    return clone
 
 
 class FilteredManagerMixin(object):
@@ -63,19 +340,110 @@ class FilteredManagerMixin(object):
     # access.
     use_for_related_fields = True
 
+    def __init__(self, *args, **kwargs):
+        """Optionally share query results between users, see ``resultcache``.
+        """
+        self.cache_results = kwargs.pop('cache_results', False)
+        super(FilteredManagerMixin, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, model, name):
+        super(FilteredManagerMixin, self).contribute_to_class(model, name)
+        if self.cache_results:
+            for signal in (post_save, post_delete):
+                signal.connect(resultcache.bump_data_version,
+                               sender=model,
+                               weak=False,
+                               dispatch_uid='lizard_security_data_version')
+
+    def _unfiltered_query_set(self):
+        query_set = super(FilteredManagerMixin, self).get_query_set()
+        if self.cache_results:
+            query_set = query_set._clone(klass=self.result_caching_class)
+        return query_set
+
     def get_query_set(self):
         """Return base queryset, filtered through lizard-security's mechanism.
+
+        The SQL shape of the filter is chosen by ``strategies.choose()``.
+
         """
-        query_set = super(FilteredManagerMixin, self).get_query_set()
-        extra_filter = data_set_filter(self.model)
-        if extra_filter is not None:
-            query_set = query_set.filter(extra_filter)
+        query_set = self._unfiltered_query_set()
+        if data_sets_field(self.model) is not None:
+            where = data_sets_where(self.model)
+            if where is not None:
+                query_set = query_set.extra(where=where[0], params=where[1])
+            return query_set
+        data_set_ids = _allowed_data_set_ids(self.model)
+        if data_set_ids is not None:
+            query_set = strategies.apply_filter(query_set, data_set_ids)
         return query_set
 
+    def sharded(self):
+        """Return a query set over the shards with our allowed data sets.
+
+        See ``lizard_security.sharding``.
+
+        """
+        return sharding.ShardedQuerySet(self)
+
 
 class FilteredManager(FilteredManagerMixin, Manager):
-    pass
+    result_caching_class = resultcache.ResultCachingQuerySet
 
 
 class FilteredGeoManager(FilteredManagerMixin, GeoManager):
-    pass
+    result_caching_class = resultcache.ResultCachingGeoQuerySet
+
+    def __init__(self, *args, **kwargs):
+        """Optionally keep extents per data set, see ``extents``."""
+        self.track_extents = kwargs.pop('track_extents', False)
+        super(FilteredGeoManager, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, model, name):
+        super(FilteredGeoManager, self).contribute_to_class(model, name)
+        if self.track_extents:
+            extents.track(model)
+
+    def in_bbox(self, bbox, lookup='intersects'):
+        """Return our objects whose geometry matches the bounding box.
+
+        ``bbox`` is a ``(xmin, ymin, xmax, ymax)`` tuple in the geometry
+        field's SRID, or a geometry. With ``track_extents``, the allowed data
+        sets are first pruned to those with objects near the box, which
+        keeps the ``IN`` list short.
+
+        """
+        if (not extents.is_tracked(self.model) or
+            data_sets_field(self.model) is not None):
+            return extents.filter_bbox(self.get_query_set(), bbox, lookup)
+        query_set = self._unfiltered_query_set()
+        data_set_ids = _allowed_data_set_ids(self.model)
+        if data_set_ids is not None:
+            if data_set_ids:
+                data_set_ids = extents.prune(
+                    self.model, bbox, strategies.descendant_ids(data_set_ids))
+            # Already including the descendants.
+            condition = Q(data_set__in=data_set_ids)
+            if null_data_set_is_public():
+                condition |= Q(data_set=None)
+            query_set = query_set.filter(condition)
+        return extents.filter_bbox(query_set, bbox, lookup)
+
+
+def secured_models():
+    """Return all models whose default manager is one of our managers."""
+    return [model for model in get_models()
+            if isinstance(model._default_manager, FilteredManagerMixin)]
+
+
+class SecuredJoinManager(Manager):
+    """Manager for models without data sets that refer to secured models.
+
+    Its query sets restrict the secured models they join with, see
+    ``secure_joins()``. So ``objects.filter(content__name='x')`` only finds
+    objects whose ``content`` we may see.
+
+    """
+
+    def get_query_set(self):
+        return secure_joins(super(SecuredJoinManager, self).get_query_set())
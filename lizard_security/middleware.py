@@ -4,11 +4,66 @@ Provides middleware that sets the user groups we're a member of (based on
 Django users) and that sets the data sets we have access to through the
 permission mapper mechanism.
 
+``IPRangeMiddleware`` additionally sets user groups based on the client's IP
+address. It must be placed *above* ``SecurityMiddleware``, as the data sets
+are determined from all user groups.
+
+``TokenMiddleware`` authenticates machine clients by API token and adds the
+token's user groups and data sets from a cached access snapshot. Place it
+*below* ``SecurityMiddleware``: for token requests without a session,
+``SecurityMiddleware`` then doesn't need any queries.
+
+``DatabaseSecurityMiddleware`` passes the allowed data sets on to the
+database, for the policies of ``lizard_security.dbpolicies``. Place it below
+all middleware that sets data sets.
+
+``ReplicaConsistencyMiddleware`` decides whether the request's security
+lookups may read from the replica (see ``lizard_security.replicas``). Place
+it below ``SessionMiddleware`` and above all other lizard-security
+middleware.
+
 """
-from lizard_security.models import DataSet
+import copy
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponseForbidden
+
+from lizard_security import dbpolicies
+from lizard_security import epoch
+from lizard_security import profiles
+from lizard_security import providers
+from lizard_security import replicas
+from lizard_security import snapshot
+from lizard_security import strategies
+from lizard_security.iptree import PrefixTree
+from lizard_security.models import APIToken
+from lizard_security.models import IPRange
+from lizard_security.models import UserGroupAncestor
 
 USER_GROUP_IDS = 'user_group_ids'
 ALLOWED_DATA_SET_IDS = 'allowed_data_set_ids'
+DATABASE_FILTERED = 'database_filtered'
+
+# Access snapshots of logged in users, by user id. Off unless
+# LIZARD_SECURITY_USER_CACHE_SIZE is set.
+user_snapshots = snapshot.LRUCache(
+    getattr(settings, 'LIZARD_SECURITY_USER_CACHE_SIZE', 0))
+
+
+def user_snapshot(user):
+    """Return the (cached) access snapshot of a logged in user.
+
+    The cached snapshot doesn't hold on to the user object itself.
+
+    """
+    cached = user_snapshots.get(user.id)
+    if cached is not None and snapshot.is_current(cached):
+        return cached
+    access = snapshot.resolve(user=user)._replace(user=None)
+    user_snapshots.set(user.id, access)
+    return access
 
 
 class SecurityMiddleware(object):
@@ -23,17 +78,72 @@ class SecurityMiddleware(object):
     to. So multiple middleware can be used to set user group membership, for
     instance.
 
+    The resulting sets are those of a shared, interned ``AccessProfile`` (see
+    ``lizard_security.profiles``), available as ``request.access_profile``.
+    They're frozensets: middleware below us must replace them (with
+    ``union()``, for instance) instead of changing them in place.
+
+    The policy providers of ``LIZARD_SECURITY_POLICY_PROVIDERS`` (see
+    ``lizard_security.providers``) add their user groups and data sets
+    before the data sets of all user groups are looked up, in one query.
+
+    Public data sets (see ``DataSet.is_public``) are added for everybody,
+    from an in-memory copy that's refreshed when the security epoch changes.
+
+    With ``LIZARD_SECURITY_USER_CACHE_SIZE`` set, the access snapshots of
+    that many recently seen users are kept in memory, like
+    ``TokenMiddleware`` does for tokens. See ``lizard_security.warmup`` for
+    filling that cache when the process starts.
+
+    With ``LIZARD_SECURITY_FILTER_CALIBRATE`` set, the query filter
+    strategies are calibrated when we're created, see
+    ``lizard_security.strategies``.
+
     """
+    def __init__(self):
+        # Imported here, as warmup needs us.
+        from lizard_security import warmup
+        warmup.start_configured()
+        strategies.calibrate_configured()
+        self.providers = providers.configured_providers()
+
     def process_request(self, request):
         """Set the allowed user group ids and data set ids on the request."""
         if not hasattr(request, USER_GROUP_IDS):
             request.user_group_ids = set()
         if not hasattr(request, ALLOWED_DATA_SET_IDS):
             request.allowed_data_set_ids = set()
-        request.user_group_ids = request.user_group_ids.union(
-            self._user_group_ids(request))
-        request.allowed_data_set_ids = request.allowed_data_set_ids.union(
-            self._data_sets(request))
+        extra_user_group_ids, extra_data_set_ids = providers.collect(
+            self.providers, request)
+        if extra_user_group_ids:
+            request.user_group_ids = request.user_group_ids.union(
+                extra_user_group_ids)
+        if user_snapshots.max_size and not request.user.is_anonymous():
+            access = user_snapshot(request.user)
+            if not (request.user_group_ids or request.allowed_data_set_ids or
+                    extra_data_set_ids):
+                # Just the user's own access, as most of the time.
+                profiles.use_profile(request, profiles.snapshot_profile(
+                        access, snapshot.public_data_set_ids()))
+                return
+            request.user_group_ids = request.user_group_ids.union(
+                access.user_group_ids)
+            if len(request.user_group_ids) == len(access.user_group_ids):
+                data_set_ids = access.data_set_ids
+            else:
+                # Other middleware added user groups, which might give
+                # access to more data sets.
+                data_set_ids = self._data_sets(request)
+        else:
+            request.user_group_ids = request.user_group_ids.union(
+                self._user_group_ids(request))
+            data_set_ids = self._data_sets(request)
+        profiles.set_access_profile(
+            request,
+            request.user_group_ids,
+            request.allowed_data_set_ids.union(
+                data_set_ids, extra_data_set_ids,
+                snapshot.public_data_set_ids()))
 
     def _user_group_ids(self, request):
         """Return user group ids based on Django users.
@@ -42,11 +152,14 @@ class SecurityMiddleware(object):
         for instance, but we only look at the user group's list of members
         (which are all Django user objects).
 
+        Membership of a user group also means membership of all user groups
+        that (indirectly) contain it. The precomputed user group closure
+        table gives us all of them in one query.
+
         """
         if request.user.is_anonymous():
             return []
-        return request.user.user_group_memberships.values_list('id',
-                                                               flat=True)
+        return snapshot.user_group_ids_for_user(request.user)
 
     def _data_sets(self, request):
         """Return data sets we have access to through user group membership.
@@ -55,9 +168,213 @@ class SecurityMiddleware(object):
         we look at links from user groups to data sets through permission
         mappers. Any link at all means we implicitly have view access.
 
+        Access to a data set includes its descendants. Through the data set
+        closure table, that's still a single query. Permission mappers
+        outside their validity period are ignored.
+
         """
         if not hasattr(request, 'user_group_ids'):
             return []
-        return DataSet.objects.filter(
-            permission_mappers__user_group__id__in=request.user_group_ids
-            ).values_list('id', flat=True)
+        return snapshot.data_set_ids_for_user_groups(request.user_group_ids)
+
+
+class IPRangeMiddleware(object):
+    """Add the user groups linked to the client's IP address to the request.
+
+    The ``IPRange`` objects are loaded into an in-memory prefix tree, so the
+    lookup per request only depends on the length of the address, not on the
+    number of ranges. The tree is rebuilt when the IP ranges (or the nesting
+    of user groups) change.
+
+    The address is taken from ``REMOTE_ADDR``. Behind a proxy, set
+    ``LIZARD_SECURITY_IP_HEADER`` to the ``request.META`` key the proxy fills
+    in, like ``'HTTP_X_REAL_IP'``. Only do that if clients cannot set that
+    header themselves. For ``X-Forwarded-For`` style lists, where every proxy
+    appends the address it got the request from, set
+    ``LIZARD_SECURITY_TRUSTED_PROXIES`` to the number of our own proxies
+    (default 1): the address that many entries from the right is used.
+    Entries further to the left come from the client and can't be trusted.
+
+    Like ``SecurityMiddleware``, we only add to ``user_group_ids``.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tree = None
+        self._tree_epoch = None
+
+    def process_request(self, request):
+        """Add the user group ids of our IP address to the request."""
+        if not hasattr(request, USER_GROUP_IDS):
+            request.user_group_ids = set()
+        header = getattr(settings, 'LIZARD_SECURITY_IP_HEADER', 'REMOTE_ADDR')
+        address = request.META.get(header)
+        if not address:
+            return
+        addresses = [part.strip() for part in address.split(',')]
+        trusted_proxies = max(
+            getattr(settings, 'LIZARD_SECURITY_TRUSTED_PROXIES', 1), 1)
+        address = addresses[-min(trusted_proxies, len(addresses))]
+        request.user_group_ids = request.user_group_ids.union(
+            self._ip_range_tree().lookup(address))
+
+    def _ip_range_tree(self):
+        """Return the prefix tree for the current IP ranges epoch."""
+        current_epoch = epoch.current(epoch.IP_RANGES_EPOCH)
+        if self._tree_epoch != current_epoch:
+            with self._lock:
+                if self._tree_epoch != current_epoch:
+                    self._tree = self._build_tree()
+                    self._tree_epoch = current_epoch
+        return self._tree
+
+    def _build_tree(self):
+        """Return a prefix tree of all IP ranges.
+
+        A range grants its user group and every user group containing it, so
+        we store all of those in the tree right away.
+
+        """
+        containing_ids = {}
+        for (descendant_id, ancestor_id) in UserGroupAncestor.objects.filter(
+                descendant__ip_ranges__isnull=False).values_list(
+                'descendant', 'ancestor'):
+            containing_ids.setdefault(descendant_id, set()).add(ancestor_id)
+        tree = PrefixTree()
+        for (network, user_group_id) in IPRange.objects.values_list(
+                'network', 'user_group'):
+            for ancestor_id in containing_ids.get(user_group_id,
+                                                  [user_group_id]):
+                try:
+                    tree.add(network, ancestor_id)
+                except ValueError:
+                    # Invalid range, added outside of the admin validation.
+                    continue
+        return tree
+
+
+class TokenMiddleware(object):
+    """Authenticate requests by API token, using cached access snapshots.
+
+    The token is read from an ``Authorization: Token <key>`` header. Its
+    access snapshot (user, effective user groups, data sets) is kept in a
+    bounded in-process LRU cache, sized by
+    ``LIZARD_SECURITY_TOKEN_CACHE_SIZE`` (default 1000 tokens). A snapshot is
+    dropped as soon as the security epoch changes or one of its permission
+    mappers starts or stops being valid.
+
+    Requests with an unknown or inactive token are refused. Like
+    ``SecurityMiddleware``, we only add to ``user_group_ids`` and
+    ``allowed_data_set_ids``, including the public data sets.
+
+    """
+    keyword = 'Token'
+
+    def __init__(self):
+        self._snapshots = snapshot.LRUCache(
+            getattr(settings, 'LIZARD_SECURITY_TOKEN_CACHE_SIZE', 1000))
+
+    def process_request(self, request):
+        """Set the token's user, user groups and data sets on the request."""
+        key = self._token_key(request)
+        if key is None:
+            return
+        access = self._snapshot(key)
+        if access is None:
+            return HttpResponseForbidden("Invalid API token")
+        if access.user is not None:
+            # A copy, as the cached user object is shared between threads.
+            request.user = copy.copy(access.user)
+        if not (getattr(request, USER_GROUP_IDS, None) or
+                getattr(request, ALLOWED_DATA_SET_IDS, None)):
+            # Just the token's access, as most of the time.
+            profiles.use_profile(request, profiles.snapshot_profile(
+                    access, snapshot.public_data_set_ids()))
+            return
+        if not hasattr(request, USER_GROUP_IDS):
+            request.user_group_ids = set()
+        if not hasattr(request, ALLOWED_DATA_SET_IDS):
+            request.allowed_data_set_ids = set()
+        profiles.set_access_profile(
+            request,
+            request.user_group_ids.union(access.user_group_ids),
+            request.allowed_data_set_ids.union(
+                access.data_set_ids, snapshot.public_data_set_ids()))
+
+    def _token_key(self, request):
+        """Return the token key from the request's headers, if any."""
+        parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+        if len(parts) != 2 or parts[0] != self.keyword:
+            return None
+        return parts[1]
+
+    def _snapshot(self, key):
+        """Return the (cached) access snapshot of the token, if valid."""
+        cached = self._snapshots.get(key)
+        if cached is not None and snapshot.is_current(cached):
+            return cached
+        try:
+            token = APIToken.objects.select_related('user').get(
+                key=key, is_active=True)
+        except APIToken.DoesNotExist:
+            self._snapshots.delete(key)
+            return None
+        if token.user is not None and not token.user.is_active:
+            self._snapshots.delete(key)
+            return None
+        access = snapshot.resolve(
+            user=token.user,
+            user_group_ids=list(token.user_groups.values_list('id',
+                                                              flat=True)))
+        self._snapshots.set(key, access)
+        return access
+
+
+class DatabaseSecurityMiddleware(object):
+    """Restrict the database connection to our allowed data sets.
+
+    This sets the data sets for the row level security policies or filtered
+    views of ``lizard_security.dbpolicies`` for the duration of the request.
+    Superusers are not restricted.
+
+    ``FilteredManager`` keeps filtering in Python, too. On PostgreSQL (with
+    Django's autocommit mode) you can set
+    ``LIZARD_SECURITY_SKIP_QUERY_FILTER = True`` to leave the filtering to
+    the database. Only do that once the policies are installed.
+
+    """
+
+    def process_request(self, request):
+        """Pass the allowed data sets on to the database connection."""
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_superuser:
+            data_set_ids = None
+        else:
+            data_set_ids = getattr(request, ALLOWED_DATA_SET_IDS, set())
+        dbpolicies.set_access(connection, data_set_ids)
+        if (connection.vendor == 'postgresql' and
+            getattr(settings, 'LIZARD_SECURITY_SKIP_QUERY_FILTER', False)):
+            setattr(request, DATABASE_FILTERED, True)
+
+    def process_response(self, request, response):
+        """Don't leave our access behind for others: deny everything."""
+        dbpolicies.reset_access(connection)
+        return response
+
+
+class ReplicaConsistencyMiddleware(object):
+    """Read from the primary until the replica has seen our own changes.
+
+    A request that changes security information leaves a consistency token
+    in the session; later requests of the session read security information
+    from the primary until the replica has caught up with it.
+
+    """
+
+    def process_request(self, request):
+        replicas.start_request(getattr(request, 'session', None))
+
+    def process_response(self, request, response):
+        replicas.finish_request(getattr(request, 'session', None))
+        return response
@@ -10,40 +10,200 @@ set ids based on IP numbers. Until then, everything works through the models
 in this file.
 
 """
+import binascii
+import os
+
+from django.conf import settings
 from django.contrib.auth.models import Group
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db import router
+from django.db.models import F
+from django.db.models import Min
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from lizard_security import epoch
+from lizard_security import iptree
+
 CAN_VIEW_LIZARD_DATA = 'can_view_lizard_data'
 
 
+def _closure(model):
+    """Return the rows of a closure table, from where they're written.
+
+    Updates of the closure build on its current rows: reading those from a
+    lagging replica would corrupt it for good.
+
+    """
+    return model.objects.using(router.db_for_write(model))
+
+
 class DataSet(models.Model):
     """Grouping of data.
 
     Other models can have a foreign key to DataSet to indicate they're part of
     this data set.
 
+    Data sets can optionally be nested through ``parent``: a province
+    containing water boards, which contain polders. Access to a data set
+    implies access to all its descendants. To avoid recursive queries, every
+    ancestor/descendant combination is stored in the ``DataSetAncestor``
+    closure table, which is kept up to date whenever a data set is saved.
+
+    Everybody has access to *public* data sets (``is_public``) and their
+    descendants. Objects without a data set are public, too, unless
+    ``LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC`` is False. Switching that off
+    (after moving those objects to a public data set with the
+    ``assign_public_data_set`` command) lets the query filter become a
+    single, index friendly ``data_set_id IN (...)``.
+
     """
     name = models.CharField(_('name'),
                             max_length=80,
                             blank=True)
+    parent = models.ForeignKey('self',
+                               verbose_name=_('parent'),
+                               related_name='children',
+                               null=True,
+                               blank=True,
+                               on_delete=models.SET_NULL)
+    is_public = models.BooleanField(
+        _('public'),
+        default=False,
+        db_index=True,
+        help_text=_('Everybody has access to public data sets and their '
+                    'descendants.'))
+
+    def __init__(self, *args, **kwargs):
+        super(DataSet, self).__init__(*args, **kwargs)
+        self._saved_parent_id = self.parent_id
 
     def __unicode__(self):
         return self.name
 
+    def clean(self):
+        """Refuse a parent that would make the hierarchy circular."""
+        if self._is_own_descendant(self.parent_id):
+            raise ValidationError(
+                _('A data set cannot be nested inside itself.'))
+
+    def save(self, *args, **kwargs):
+        """Save and keep the closure table in sync with ``parent``."""
+        created = self.pk is None
+        if not created and self.parent_id != self._saved_parent_id:
+            if self._is_own_descendant(self.parent_id):
+                raise ValueError(
+                    "Data set %s cannot be nested inside itself." % self.pk)
+        super(DataSet, self).save(*args, **kwargs)
+        if created or self.parent_id != self._saved_parent_id:
+            self._update_ancestors(created)
+        self._saved_parent_id = self.parent_id
+
+    def _is_own_descendant(self, data_set_id):
+        """Return True if ``data_set_id`` is us or one of our descendants."""
+        if self.pk is None or data_set_id is None:
+            return False
+        return DataSetAncestor.objects.filter(
+            ancestor=self.pk, descendant=data_set_id).exists()
+
+    def _update_ancestors(self, created):
+        """Re-attach our whole subtree below our (new) parent.
+
+        Links inside our subtree stay as they are. Links from our old
+        ancestors into the subtree are removed and links from our new
+        ancestors are added, all with set-based queries.
+
+        """
+        if created:
+            DataSetAncestor.objects.create(ancestor=self,
+                                           descendant=self,
+                                           depth=0)
+        subtree = list(_closure(DataSetAncestor).filter(
+                ancestor=self).values_list('descendant', 'depth'))
+        subtree_ids = [descendant_id for (descendant_id, depth) in subtree]
+        DataSetAncestor.objects.filter(
+            descendant__in=subtree_ids).exclude(
+            ancestor__in=subtree_ids).delete()
+        if self.parent_id is None:
+            return
+        ancestors = _closure(DataSetAncestor).filter(
+            descendant=self.parent_id).values_list('ancestor', 'depth')
+        DataSetAncestor.objects.bulk_create(
+            [DataSetAncestor(ancestor_id=ancestor_id,
+                             descendant_id=descendant_id,
+                             depth=ancestor_depth + descendant_depth + 1)
+             for (ancestor_id, ancestor_depth) in ancestors
+             for (descendant_id, descendant_depth) in subtree])
+
     class Meta:
         verbose_name = _('Data set')
         verbose_name_plural = _('Data sets')
         ordering = ['name']
 
 
+class DataSetAncestor(models.Model):
+    """Closure table of the data set hierarchy.
+
+    There is one row for every data set and each of its ancestors, including
+    a row linking every data set to itself (with depth 0). Looking up all
+    descendants of a set of data sets is thus a single indexed query, however
+    deep the nesting is.
+
+    The rows are maintained by ``DataSet.save()``, don't edit them by hand.
+
+    """
+    ancestor = models.ForeignKey(DataSet,
+                                 related_name='descendant_links')
+    descendant = models.ForeignKey(DataSet,
+                                   related_name='ancestor_links')
+    depth = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'), )
+
+
+class DataSetExtent(models.Model):
+    """Bounding box of the geometries of a model's objects in a data set.
+
+    Maintained by ``lizard_security.extents`` for models with a
+    ``FilteredGeoManager(track_extents=True)``. The box may be larger than
+    the objects' real extent, never smaller. Coordinates are in the SRID of
+    the model's geometry field.
+
+    """
+    content_type = models.ForeignKey(ContentType)
+    data_set = models.ForeignKey(DataSet,
+                                 related_name='extents')
+    xmin = models.FloatField()
+    ymin = models.FloatField()
+    xmax = models.FloatField()
+    ymax = models.FloatField()
+
+    class Meta:
+        unique_together = (('content_type', 'data_set'), )
+
+
 class UserGroup(models.Model):
     """Managed group of users.
 
     A user group has members and managers: managers can add/delete users from
     the user group.
 
+    User groups can also contain other user groups (``member_groups``): the
+    members of a member group are effectively members of the containing
+    group, too. The transitive closure of this nesting is precomputed in
+    ``UserGroupAncestor``, so resolving all effective user groups of a user is
+    one query regardless of nesting depth.
+
     """
     supports_object_permissions = True
     name = models.CharField(_('name'),
@@ -57,6 +217,11 @@ class UserGroup(models.Model):
                                      verbose_name=_('members'),
                                      related_name='user_group_memberships',
                                      blank=True)
+    member_groups = models.ManyToManyField('self',
+                                           verbose_name=_('member groups'),
+                                           related_name='parent_groups',
+                                           symmetrical=False,
+                                           blank=True)
 
     def number_of_members(self):
         """Return number of members (used for the admin)."""
@@ -91,6 +256,69 @@ class UserGroup(models.Model):
         verbose_name_plural = _('User groups')
 
 
+class UserGroupAncestor(models.Model):
+    """Transitive closure of user group nesting.
+
+    There is one row for every user group and every user group that
+    (directly or indirectly) contains it, including a row linking every user
+    group to itself. As user groups can be nested in several other groups,
+    ``path_count`` counts the distinct nesting paths: that way removing one
+    nesting link only touches the rows that it affects, without recomputing
+    the whole closure.
+
+    The rows are maintained by signal handlers on ``member_groups``, don't
+    edit them by hand.
+
+    """
+    ancestor = models.ForeignKey(UserGroup,
+                                 related_name='descendant_links')
+    descendant = models.ForeignKey(UserGroup,
+                                   related_name='ancestor_links')
+    path_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'), )
+
+    @classmethod
+    def update_paths(cls, parent_id, child_id, sign):
+        """Add (sign=1) or remove (sign=-1) the paths through one nesting.
+
+        Every ancestor of the parent gets ``ancestor paths * descendant
+        paths`` extra (or fewer) paths to every descendant of the child.
+
+        """
+        ancestors = list(_closure(cls).filter(
+                descendant=parent_id).values_list('ancestor', 'path_count'))
+        descendants = list(_closure(cls).filter(
+                ancestor=child_id).values_list('descendant', 'path_count'))
+        existing = dict(
+            ((ancestor_id, descendant_id), path_count)
+            for (ancestor_id, descendant_id, path_count)
+            in _closure(cls).filter(
+                ancestor__in=[ancestor_id for (ancestor_id, paths)
+                              in ancestors],
+                descendant__in=[descendant_id for (descendant_id, paths)
+                                in descendants]).values_list(
+                'ancestor', 'descendant', 'path_count'))
+        new_rows = []
+        for (ancestor_id, ancestor_paths) in ancestors:
+            for (descendant_id, descendant_paths) in descendants:
+                delta = sign * ancestor_paths * descendant_paths
+                key = (ancestor_id, descendant_id)
+                if key not in existing:
+                    new_rows.append(cls(ancestor_id=ancestor_id,
+                                        descendant_id=descendant_id,
+                                        path_count=delta))
+                    continue
+                link = cls.objects.filter(ancestor=ancestor_id,
+                                          descendant=descendant_id)
+                if existing[key] + delta <= 0:
+                    link.delete()
+                else:
+                    link.update(path_count=F('path_count') + delta)
+        cls.objects.bulk_create(new_rows)
+
+
 class PermissionMapper(models.Model):
     """Three-way mapper from user groups to data sets and permission groups.
 
@@ -103,6 +331,11 @@ class PermissionMapper(models.Model):
     that we want to grant the view permission to that data set/user group
     combination.
 
+    A permission mapper can be limited in time with ``valid_from`` and
+    ``valid_until``, for temporary access. Empty means "no limit". Use
+    ``valid_mappers()`` to filter on validity and ``next_validity_change()``
+    to know until when a cached access decision stays correct.
+
     """
     name = models.CharField(_('name'),
                             max_length=80,
@@ -118,6 +351,14 @@ class PermissionMapper(models.Model):
     permission_group = models.ForeignKey(Group,
                                          null=True,
                                          blank=True)
+    valid_from = models.DateTimeField(_('valid from'),
+                                      null=True,
+                                      blank=True,
+                                      db_index=True)
+    valid_until = models.DateTimeField(_('valid until'),
+                                       null=True,
+                                       blank=True,
+                                       db_index=True)
 
     def __unicode__(self):
         return self.name
@@ -129,3 +370,286 @@ class PermissionMapper(models.Model):
         permissions = (
             (CAN_VIEW_LIZARD_DATA, 'Can view lizard data'),
             )
+
+
+class IPRange(models.Model):
+    """Network range whose clients are members of a user group.
+
+    ``network`` is an IPv4 or IPv6 range in CIDR notation, like
+    ``10.0.0.0/8``, or a single address. The ``IPRangeMiddleware`` adds the
+    user group (and the user groups containing it) to requests from that
+    range.
+
+    """
+    name = models.CharField(_('name'),
+                            max_length=80,
+                            blank=True)
+    network = models.CharField(_('network'),
+                               max_length=43,
+                               help_text=_('For instance 10.0.0.0/8'))
+    user_group = models.ForeignKey(UserGroup,
+                                   verbose_name=_('user group'),
+                                   related_name='ip_ranges')
+
+    def __unicode__(self):
+        return self.name or self.network
+
+    def clean(self):
+        """Refuse anything that isn't an IP range."""
+        try:
+            iptree.parse_network(self.network)
+        except ValueError:
+            raise ValidationError(_('Enter a valid IP address or range.'))
+
+    class Meta:
+        verbose_name = _('IP range')
+        verbose_name_plural = _('IP ranges')
+        ordering = ['network']
+
+
+class APIToken(models.Model):
+    """Key for machine clients to authenticate with instead of a session.
+
+    The ``TokenMiddleware`` gives requests with a valid key (in an
+    ``Authorization: Token <key>`` header) the token's user (if any) and the
+    token's user groups. The key is generated on first save.
+
+    """
+    name = models.CharField(_('name'),
+                            max_length=80,
+                            blank=True)
+    key = models.CharField(_('key'),
+                           max_length=40,
+                           unique=True,
+                           blank=True)
+    user = models.ForeignKey(User,
+                             verbose_name=_('user'),
+                             related_name='api_tokens',
+                             null=True,
+                             blank=True)
+    user_groups = models.ManyToManyField(UserGroup,
+                                         verbose_name=_('user groups'),
+                                         related_name='api_tokens',
+                                         blank=True)
+    is_active = models.BooleanField(_('active'), default=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    def __unicode__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        if not self.key:
+            self.key = binascii.hexlify(os.urandom(20))
+        return super(APIToken, self).save(*args, **kwargs)
+
+    class Meta:
+        verbose_name = _('API token')
+        verbose_name_plural = _('API tokens')
+        ordering = ['name']
+
+
+class AccessLog(models.Model):
+    """Audit record of an access decision.
+
+    Written in batches by ``lizard_security.audit``, if enabled. The user is
+    stored by name, so records survive the user's removal.
+
+    """
+    timestamp = models.DateTimeField(_('timestamp'), db_index=True)
+    username = models.CharField(_('username'),
+                                max_length=75,
+                                blank=True,
+                                db_index=True)
+    model = models.CharField(_('model'),
+                             max_length=100,
+                             blank=True)
+    perm = models.CharField(_('permission'),
+                            max_length=100,
+                            blank=True)
+    data_set_ids = models.TextField(_('data set ids'),
+                                    blank=True)
+    allowed = models.BooleanField(_('allowed'), default=True)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.timestamp, self.username, self.model)
+
+    class Meta:
+        verbose_name = _('access log entry')
+        verbose_name_plural = _('access log')
+        ordering = ['-timestamp']
+
+
+def data_sets_field(model):
+    """Return the model's ``data_sets`` many-to-many field, if any.
+
+    Secured models normally have a ``data_set`` foreign key. Objects that
+    belong to several data sets can have a ``data_sets`` many-to-many field
+    to ``DataSet`` instead. They are accessible through any of their data
+    sets; without data sets, they're accessible to everybody.
+
+    """
+    if 'data_set' in model._meta.get_all_field_names():
+        return None
+    for field in model._meta.many_to_many:
+        if field.name == 'data_sets' and field.rel.to is DataSet:
+            return field
+    return None
+
+
+def null_data_set_is_public():
+    """Return whether objects without a data set are accessible to all."""
+    return getattr(settings, 'LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC', True)
+
+
+def valid_mappers(prefix='', now=None):
+    """Return a Q object matching permission mappers that are valid now.
+
+    Pass a ``prefix`` like ``'permission_mappers__'`` when filtering from a
+    related model. Combine the result with the other conditions on the
+    permission mapper in the *same* ``filter()`` call, otherwise Django
+    joins the permission mapper table twice.
+
+    """
+    if now is None:
+        now = timezone.now()
+    valid_from = (Q(**{prefix + 'valid_from__isnull': True}) |
+                  Q(**{prefix + 'valid_from__lte': now}))
+    valid_until = (Q(**{prefix + 'valid_until__isnull': True}) |
+                   Q(**{prefix + 'valid_until__gt': now}))
+    return valid_from & valid_until
+
+
+def next_validity_change(user_group_ids, now=None):
+    """Return when the permission mappers of the user groups next change.
+
+    That's the first upcoming ``valid_from`` or ``valid_until`` of the
+    permission mappers of the given user groups. Until then, access
+    information derived from those user groups stays correct, so it is the
+    exact moment a cached copy of it has to expire. Returns None if nothing
+    is scheduled.
+
+    """
+    if now is None:
+        now = timezone.now()
+    mappers = PermissionMapper.objects.filter(
+        user_group__id__in=user_group_ids)
+    moments = [
+        mappers.filter(valid_from__gt=now).aggregate(
+            moment=Min('valid_from'))['moment'],
+        mappers.filter(valid_until__gt=now).aggregate(
+            moment=Min('valid_until'))['moment'],
+        ]
+    moments = [moment for moment in moments if moment is not None]
+    if not moments:
+        return None
+    return min(moments)
+
+
+@receiver(pre_delete, sender=DataSet)
+def detach_child_data_sets(sender, instance, **kwargs):
+    """Turn the children of a deleted data set into top-level data sets.
+
+    The foreign key's ``SET_NULL`` alone would bypass ``save()`` and leave
+    the children linked to their former grandparents in the closure table.
+
+    """
+    for child in instance.children.all():
+        child.parent = None
+        child.save()
+
+
+@receiver(post_save, sender=UserGroup)
+def add_user_group_self_link(sender, instance, created, raw=False, **kwargs):
+    """Every new user group is its own (depth zero) ancestor."""
+    if created and not raw:
+        UserGroupAncestor.objects.create(ancestor=instance,
+                                         descendant=instance)
+
+
+@receiver(pre_delete, sender=UserGroup)
+def unlink_deleted_user_group(sender, instance, **kwargs):
+    """Remove the nesting links through the signal handlers first.
+
+    A cascading delete of the ``member_groups`` rows would bypass them and
+    leave stale paths behind.
+
+    """
+    instance.member_groups.clear()
+    instance.parent_groups.clear()
+
+
+@receiver(m2m_changed, sender=UserGroup.member_groups.through)
+def update_user_group_closure(sender, instance, action, reverse, pk_set,
+                              **kwargs):
+    """Keep ``UserGroupAncestor`` in sync with ``member_groups`` changes.
+
+    Only the rows affected by the added or removed nesting are touched.
+    ``reverse`` means the change was made through ``parent_groups``.
+
+    """
+    if action not in ('pre_add', 'post_add', 'pre_remove', 'pre_clear'):
+        return
+    database = router.db_for_write(UserGroupAncestor)
+    if reverse:
+        related = instance.parent_groups.using(database)
+    else:
+        related = instance.member_groups.using(database)
+    if action == 'pre_clear':
+        pk_set = related.values_list('id', flat=True)
+    elif action == 'pre_remove':
+        # Django doesn't filter out links that don't exist.
+        pk_set = related.filter(id__in=pk_set).values_list('id', flat=True)
+    if reverse:
+        links = [(other_id, instance.pk) for other_id in pk_set]
+    else:
+        links = [(instance.pk, other_id) for other_id in pk_set]
+    if action == 'pre_add':
+        for (parent_id, child_id) in links:
+            if _closure(UserGroupAncestor).filter(
+                    ancestor=child_id, descendant=parent_id).exists():
+                raise ValueError(
+                    "User group %s already contains user group %s." % (
+                        child_id, parent_id))
+        return
+    sign = (action == 'post_add') and 1 or -1
+    for (parent_id, child_id) in links:
+        UserGroupAncestor.update_paths(parent_id, child_id, sign)
+    # IP ranges also grant the user groups containing their user group.
+    epoch.bump(epoch.IP_RANGES_EPOCH)
+
+
+@receiver(post_save, sender=IPRange)
+@receiver(post_delete, sender=IPRange)
+def ip_ranges_changed(sender, **kwargs):
+    """Make the middleware rebuild its IP range lookup tree."""
+    epoch.bump(epoch.IP_RANGES_EPOCH)
+
+
+@receiver(post_save, sender=DataSet)
+@receiver(post_delete, sender=DataSet)
+@receiver(post_save, sender=UserGroup)
+@receiver(post_delete, sender=UserGroup)
+@receiver(post_save, sender=PermissionMapper)
+@receiver(post_delete, sender=PermissionMapper)
+@receiver(post_save, sender=APIToken)
+@receiver(post_delete, sender=APIToken)
+@receiver(m2m_changed, sender=UserGroup.members.through)
+@receiver(m2m_changed, sender=UserGroup.member_groups.through)
+@receiver(m2m_changed, sender=APIToken.user_groups.through)
+def security_changed(sender, **kwargs):
+    """Invalidate in-process copies of security information."""
+    action = kwargs.get('action')
+    if action is None or action.startswith('post_'):
+        epoch.bump()
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, update_fields=None, **kwargs):
+    """Invalidate cached access snapshots, which hold on to their user.
+
+    A deactivated user or former superuser must lose its access right
+    away. Saves of only ``last_login`` (on every login) are ignored.
+
+    """
+    if update_fields is None or set(update_fields) - set(['last_login']):
+        epoch.bump()
@@ -0,0 +1,127 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Thousands of users share identical sets of user groups and allowed data sets.
+Instead of giving every request fresh copies, the middleware maps every
+distinct combination to one shared, immutable ``AccessProfile``. Requests
+reference that profile as ``request.access_profile``, and
+``request.user_group_ids`` and ``request.allowed_data_set_ids`` become the
+profile's frozensets.
+
+A profile's ``fingerprint`` is stable across processes, which makes it a
+cheap key for caches of anything derived from the access sets.
+
+The most recently used profiles (``LIZARD_SECURITY_PROFILE_CACHE_SIZE``,
+default 10000) are kept around for re-use.
+
+"""
+import hashlib
+
+from django.conf import settings
+
+from lizard_security.snapshot import LRUCache
+
+ACCESS_PROFILE = 'access_profile'
+
+
+class AccessProfile(object):
+    """Immutable, hashable combination of user groups and data sets."""
+    __slots__ = ('user_group_ids', 'data_set_ids', 'fingerprint',
+                 'data_set_fingerprint')
+
+    def __init__(self, user_group_ids, data_set_ids):
+        self.user_group_ids = frozenset(user_group_ids)
+        self.data_set_ids = frozenset(data_set_ids)
+        # Query results only depend on the data sets, so those get their own
+        # fingerprint, too.
+        self.data_set_fingerprint = hashlib.sha1(','.join(
+                [str(data_set_id) for data_set_id
+                 in sorted(self.data_set_ids)])).hexdigest()
+        self.fingerprint = hashlib.sha1('%s|%s' % (
+                ','.join([str(user_group_id) for user_group_id
+                          in sorted(self.user_group_ids)]),
+                self.data_set_fingerprint)).hexdigest()
+
+    def __eq__(self, other):
+        return (isinstance(other, AccessProfile) and
+                self.fingerprint == other.fingerprint)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __repr__(self):
+        return '<AccessProfile %s>' % self.fingerprint
+
+
+_profiles = LRUCache(
+    getattr(settings, 'LIZARD_SECURITY_PROFILE_CACHE_SIZE', 10000))
+# By identity of the access snapshot and the public data sets, see
+# snapshot_profile().
+_snapshot_profiles = LRUCache(
+    getattr(settings, 'LIZARD_SECURITY_PROFILE_CACHE_SIZE', 10000))
+
+
+def intern_profile(user_group_ids, data_set_ids):
+    """Return the shared profile for these user groups and data sets."""
+    # Frozensets aren't copied.
+    key = (frozenset(user_group_ids), frozenset(data_set_ids))
+    profile = _profiles.get(key)
+    if profile is None:
+        profile = AccessProfile(*key)
+        _profiles.set(key, profile)
+    return profile
+
+
+def snapshot_profile(access, public_data_set_ids):
+    """Return the shared profile for a snapshot plus the public data sets.
+
+    Both are cached (and replaced, not changed) by ``lizard_security.
+    snapshot``, so we look them up by identity: the sets are only combined
+    the first time.
+
+    """
+    key = (id(access), id(public_data_set_ids))
+    cached = _snapshot_profiles.get(key)
+    # We keep both alive, but an id could have been re-used after the entry
+    # was dropped and set again by another thread.
+    if (cached is not None and cached[0] is access and
+        cached[1] is public_data_set_ids):
+        return cached[2]
+    profile = intern_profile(
+        access.user_group_ids,
+        access.data_set_ids.union(public_data_set_ids))
+    _snapshot_profiles.set(key, (access, public_data_set_ids, profile))
+    return profile
+
+
+def use_profile(request, profile):
+    """Put the profile and its access sets on the request."""
+    setattr(request, ACCESS_PROFILE, profile)
+    request.user_group_ids = profile.user_group_ids
+    request.allowed_data_set_ids = profile.data_set_ids
+    return profile
+
+
+def set_access_profile(request, user_group_ids, data_set_ids):
+    """Put the shared profile and its access sets on the request."""
+    return use_profile(request, intern_profile(user_group_ids, data_set_ids))
+
+
+def request_profile(request):
+    """Return the request's profile, if it still matches its access sets.
+
+    Middleware below ours might have replaced the sets since.
+
+    """
+    profile = getattr(request, ACCESS_PROFILE, None)
+    if profile is None:
+        return None
+    if (profile.data_set_ids is not getattr(request, 'allowed_data_set_ids',
+                                            None) or
+        profile.user_group_ids is not getattr(request, 'user_group_ids',
+                                              None)):
+        return None
+    return profile
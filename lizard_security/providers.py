@@ -0,0 +1,124 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Policy providers grant extra access based on anything in the request: the
+time of day, the client's network, attributes of the user. They're an
+alternative to writing middleware of your own, which would mean extra
+queries and extra copies of the access sets on every request.
+
+A provider subclasses ``PolicyProvider`` and is listed, by dotted path, in
+``LIZARD_SECURITY_POLICY_PROVIDERS``. ``SecurityMiddleware`` asks all
+providers for user groups and data sets and merges their answers with the
+user's own access in one go: one query for the data sets of all user
+groups, one shared access profile.
+
+Providers declare how their answers may be cached with ``cache_key()``:
+requests with the same key get the same answer, until the security epoch
+changes or ``cache_timeout`` seconds have passed. Cached providers don't
+cost queries on most requests. For example::
+
+    class OfficeHoursProvider(PolicyProvider):
+        cache_timeout = 60
+
+        def cache_key(self, request):
+            return datetime.datetime.now().hour
+
+        def access(self, request):
+            if 8 <= datetime.datetime.now().hour < 18:
+                return [OFFICE_USER_GROUP_ID], []
+            return [], []
+
+User groups from providers include the user groups that contain them, like
+all other user groups.
+
+"""
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from lizard_security import epoch
+from lizard_security import snapshot
+
+
+class PolicyProvider(object):
+    """Base class for providers of extra user groups and data sets."""
+    # Seconds that a cached answer stays valid, None means: until the
+    # security epoch changes.
+    cache_timeout = None
+    # Number of cached answers (distinct cache keys) to keep.
+    cache_size = 1000
+
+    def __init__(self):
+        self._answers = snapshot.LRUCache(self.cache_size)
+
+    def cache_key(self, request):
+        """Return a hashable key for caching the answer, None for no caching.
+
+        Requests with the same key must get the same answer from
+        ``access()``.
+
+        """
+        return None
+
+    def access(self, request):
+        """Return ``(user group ids, data set ids)`` to give the request."""
+        return (), ()
+
+    def resolve(self, request):
+        """Return ``access()`` as frozensets, with containing user groups."""
+        user_group_ids, data_set_ids = self.access(request)
+        user_group_ids = list(user_group_ids)
+        if user_group_ids:
+            user_group_ids = snapshot.containing_user_group_ids(
+                user_group_ids)
+        return frozenset(user_group_ids), frozenset(data_set_ids)
+
+    def cached_resolve(self, request, current_epoch):
+        """Return ``resolve()``, re-using a cached answer if allowed."""
+        key = self.cache_key(request)
+        if key is None:
+            return self.resolve(request)
+        cached = self._answers.get(key)
+        now = time.time()
+        if (cached is not None and cached[0] == current_epoch and
+            (cached[1] is None or cached[1] > now)):
+            return cached[2]
+        answer = self.resolve(request)
+        if self.cache_timeout is None:
+            expires = None
+        else:
+            expires = now + self.cache_timeout
+        self._answers.set(key, (current_epoch, expires, answer))
+        return answer
+
+
+def configured_providers():
+    """Return instances of the providers in the settings."""
+    providers = []
+    for path in getattr(settings, 'LIZARD_SECURITY_POLICY_PROVIDERS', []):
+        module_name, _, class_name = path.rpartition('.')
+        try:
+            provider_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError, ValueError), e:
+            raise ImproperlyConfigured(
+                "Cannot load policy provider %s: %s" % (path, e))
+        providers.append(provider_class())
+    return providers
+
+
+def collect(providers, request):
+    """Return the combined user group ids and data set ids of the providers.
+    """
+    user_group_ids = set()
+    data_set_ids = set()
+    if not providers:
+        return user_group_ids, data_set_ids
+    current_epoch = epoch.current()
+    for provider in providers:
+        extra_user_group_ids, extra_data_set_ids = provider.cached_resolve(
+            request, current_epoch)
+        user_group_ids.update(extra_user_group_ids)
+        data_set_ids.update(extra_data_set_ids)
+    return user_group_ids, data_set_ids
@@ -0,0 +1,248 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+The security lookups of the middleware and the permission backend only read,
+and they happen on every request. With a read replica, they can be sent
+there instead of to the primary database::
+
+    LIZARD_SECURITY_REPLICA = 'replica'
+    DATABASE_ROUTERS = ['lizard_security.replicas.ReplicaRouter']
+
+``ReplicaRouter`` sends reads of lizard-security's own models (user groups
+and their members, data sets, permission mappers) and of Django's
+``Permission`` and ``Group`` to the replica. Writes go to the primary.
+List it *before* ``DataSetRouter`` when sharding, too.
+
+A replica lags behind. To keep users from seeing their own changes
+disappear (an edited permission mapper in the admin, for instance), add
+``ReplicaConsistencyMiddleware`` below Django's ``SessionMiddleware`` and
+above all lizard-security middleware. A request that changes security
+information stores a *consistency token* in the session: the primary's
+write position (on PostgreSQL) or the time of the change. Until the replica
+has caught up with that token, the session's requests read from the
+primary.
+
+Other users might still build their (cached) access snapshots from old data
+while the replica lags. So for ``LIZARD_SECURITY_REPLICA_LAG`` seconds
+(default 10) after any change, everybody reads from the primary. Changes
+outside of models' signals (raw SQL, for instance) should call
+``security_written()`` themselves; ``lizard_security.bulk`` and
+``lizard_security.transfer`` already do.
+
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from lizard_security import epoch
+from lizard_security.models import APIToken
+from lizard_security.models import DataSet
+from lizard_security.models import IPRange
+from lizard_security.models import PermissionMapper
+from lizard_security.models import UserGroup
+
+SESSION_KEY = 'lizard_security_consistency_token'
+WRITTEN_KEY = 'lizard_security.replicas.written'
+ROUTED_MODELS = (Permission, Group)
+# Whether this thread reads from the primary and whether it changed
+# security information, per thread (so: per request).
+_state = threading.local()
+
+
+def replica_alias():
+    """Return the database alias of the replica, None when there's none."""
+    return getattr(settings, 'LIZARD_SECURITY_REPLICA', None)
+
+
+def replica_lag():
+    """Return the seconds we allow the replica to lag behind."""
+    return getattr(settings, 'LIZARD_SECURITY_REPLICA_LAG', 10)
+
+
+def is_routed(model):
+    """Return whether reads of the model may go to the replica."""
+    return (model._meta.app_label == 'lizard_security' or
+            issubclass(model, ROUTED_MODELS))
+
+
+def use_primary():
+    """Return whether this thread reads from the primary."""
+    return getattr(_state, 'primary', False)
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block."""
+    previous = use_primary()
+    _state.primary = True
+    try:
+        yield
+    finally:
+        # Changes made inside the block keep us on the primary.
+        _state.primary = previous or getattr(_state, 'written', False)
+
+
+def security_written(**kwargs):
+    """Record that security information changed.
+
+    This thread reads from the primary from now on, and so does everybody
+    for the next ``LIZARD_SECURITY_REPLICA_LAG`` seconds. Also a signal
+    handler.
+
+    """
+    action = kwargs.get('action')
+    if action is not None and not action.startswith('post_'):
+        return
+    _state.primary = True
+    _state.written = True
+    if replica_alias() is not None:
+        epoch._cache().set(WRITTEN_KEY, time.time(), epoch.TIMEOUT)
+
+
+def _lsn(value):
+    """Return a PostgreSQL write ahead log position like '0/16B3748' as int.
+    """
+    high, low = value.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def _log_function(connection, name):
+    """Return the name of the log position function for the server version.
+
+    PostgreSQL 10 renamed ``xlog`` to ``wal`` and ``location`` to ``lsn``.
+
+    """
+    if connection.pg_version >= 100000:
+        return {'current': 'pg_current_wal_lsn',
+                'replay': 'pg_last_wal_replay_lsn'}[name]
+    return {'current': 'pg_current_xlog_location',
+            'replay': 'pg_last_xlog_replay_location'}[name]
+
+
+def consistency_token():
+    """Return a token for the primary's current state."""
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s()' % _log_function(connection, 'current'))
+        return 'lsn:%s' % cursor.fetchone()[0]
+    return 'time:%r' % time.time()
+
+
+def caught_up(token):
+    """Return whether the replica has seen the state of the token.
+
+    Write positions are compared with the replica's replay position. For
+    time tokens, and when the replica is no standby server, we wait for
+    ``LIZARD_SECURITY_REPLICA_LAG`` seconds.
+
+    """
+    kind, _, value = token.partition(':')
+    if kind == 'lsn':
+        connection = connections[replica_alias()]
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s()' % _log_function(connection, 'replay'))
+        replayed = cursor.fetchone()[0]
+        if replayed is not None:
+            return _lsn(replayed) >= _lsn(value)
+        return True
+    try:
+        return time.time() - float(value) >= replica_lag()
+    except ValueError:
+        # Unknown token, probably from an older version.
+        return True
+
+
+def recently_written():
+    """Return whether security information changed within the lag."""
+    written = epoch._cache().get(WRITTEN_KEY)
+    return written is not None and time.time() - written < replica_lag()
+
+
+def start_request(session):
+    """Decide where the request reads from; return True for the primary.
+
+    ``session`` may be None, for requests without one.
+
+    """
+    _state.written = False
+    _state.primary = False
+    if replica_alias() is None:
+        return False
+    token = session.get(SESSION_KEY) if session is not None else None
+    if token is not None:
+        if caught_up(token):
+            del session[SESSION_KEY]
+        else:
+            _state.primary = True
+    if not _state.primary and recently_written():
+        _state.primary = True
+    return _state.primary
+
+
+def finish_request(session):
+    """Store a consistency token when the request changed something."""
+    if (getattr(_state, 'written', False) and session is not None and
+        replica_alias() is not None):
+        session[SESSION_KEY] = consistency_token()
+    _state.written = False
+    _state.primary = False
+
+
+class ReplicaRouter(object):
+    """Send reads of security information to the replica.
+
+    Add ``'lizard_security.replicas.ReplicaRouter'`` to
+    ``DATABASE_ROUTERS``.
+
+    """
+
+    def db_for_read(self, model, **hints):
+        if replica_alias() is None or not is_routed(model):
+            return None
+        if use_primary():
+            # Explicitly, otherwise related objects of replica objects would
+            # follow them to the replica.
+            return DEFAULT_DB_ALIAS
+        return replica_alias()
+
+    def db_for_write(self, model, **hints):
+        if replica_alias() is None or not is_routed(model):
+            return None
+        # Objects read from the replica are saved on the primary.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """The replica holds the same objects as the primary."""
+        aliases = set([DEFAULT_DB_ALIAS, replica_alias()])
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if replica_alias() is not None and db == replica_alias():
+            return False
+        return None
+
+
+# The same changes that bump the epochs, plus Django's permission groups.
+for sender in (DataSet, UserGroup, PermissionMapper, APIToken, IPRange,
+               Group):
+    post_save.connect(security_written, sender=sender,
+                      dispatch_uid='lizard_security.replicas')
+    post_delete.connect(security_written, sender=sender,
+                        dispatch_uid='lizard_security.replicas')
+for sender in (UserGroup.members.through, UserGroup.member_groups.through,
+               UserGroup.managers.through, APIToken.user_groups.through,
+               Group.permissions.through):
+    m2m_changed.connect(security_written, sender=sender,
+                        dispatch_uid='lizard_security.replicas')
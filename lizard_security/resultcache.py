@@ -0,0 +1,162 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Opt-in cache of secured query results, shared between users.
+
+Most users fall into a few distinct sets of allowed data sets. Users with the
+same set get the same results for the same query, so those can be cached
+once for all of them. Enable it per manager::
+
+    class Layer(models.Model):
+        ...
+        objects = FilteredManager()
+        cached_objects = FilteredManager(cache_results=True)
+
+The cache key combines:
+
+- a hash of the (sorted) allowed data sets, taken from the request's access
+  profile if possible, or a marker for "unfiltered",
+
+- the query's SQL and parameters,
+
+- the security epoch and the model's data version. The data version is
+  bumped whenever an object of the model is saved or deleted.
+
+Changes that don't send signals (``update()``, ``bulk_create()``, raw SQL)
+aren't noticed: call ``bump_data_version(Model)`` after those. Changes to
+related models used through ``select_related()`` aren't noticed either.
+
+Results are stored pickled in an in-process cache limited to
+``LIZARD_SECURITY_RESULT_CACHE_BYTES`` bytes (default 50MB). The least
+recently used results are evicted first.
+
+"""
+from collections import OrderedDict
+import cPickle as pickle
+import hashlib
+import threading
+
+from django.conf import settings
+from django.contrib.gis.db.models.query import GeoQuerySet
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from tls import request
+
+from lizard_security import epoch
+from lizard_security import profiles
+from lizard_security.middleware import ALLOWED_DATA_SET_IDS
+
+UNFILTERED = 'unfiltered'
+
+
+class SizeBoundedCache(object):
+    """Thread-safe LRU cache limited by the total size of its values.
+
+    Values must be strings; their length is their size.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old_value = self._items.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                key, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+results = SizeBoundedCache(
+    getattr(settings, 'LIZARD_SECURITY_RESULT_CACHE_BYTES', 50 * 1024 * 1024))
+
+
+def _data_version_name(model):
+    return 'data.%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def bump_data_version(sender, **kwargs):
+    """Invalidate the cached results of the model passed as ``sender``.
+
+    Also usable as a ``post_save``/``post_delete`` signal handler.
+
+    """
+    epoch.bump(_data_version_name(sender))
+
+
+def access_signature():
+    """Return a canonical string for the current request's access."""
+    try:
+        user = request.user
+    except RuntimeError:
+        # No request, so no filtering.
+        return UNFILTERED
+    if user is not None and user.is_superuser:
+        return UNFILTERED
+    profile = profiles.request_profile(request)
+    if profile is not None:
+        return profile.data_set_fingerprint
+    data_set_ids = getattr(request, ALLOWED_DATA_SET_IDS, None) or []
+    return hashlib.sha1(
+        ','.join([str(data_set_id) for data_set_id
+                  in sorted(data_set_ids)])).hexdigest()
+
+
+class ResultCachingMixin(object):
+    """Query set mixin that shares results through the result cache."""
+
+    def _result_cache_key(self):
+        """Return the key, or None if the query matches nothing anyway."""
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return None
+        return hashlib.sha1(repr(
+                (self.db,
+                 access_signature(),
+                 epoch.current(),
+                 epoch.current(_data_version_name(self.model)),
+                 sql,
+                 params))).hexdigest()
+
+    def iterator(self):
+        key = self._result_cache_key()
+        if key is None:
+            return super(ResultCachingMixin, self).iterator()
+        cached = results.get(key)
+        if cached is not None:
+            return iter(pickle.loads(cached))
+        objects = list(super(ResultCachingMixin, self).iterator())
+        results.set(key, pickle.dumps(objects, pickle.HIGHEST_PROTOCOL))
+        return iter(objects)
+
+
+class ResultCachingQuerySet(ResultCachingMixin, QuerySet):
+    pass
+
+
+class ResultCachingGeoQuerySet(ResultCachingMixin, GeoQuerySet):
+    pass
@@ -0,0 +1,327 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Secured objects of some data sets can live in databases of their own
+(*shards*), for instance one per tenant. ``LIZARD_SECURITY_SHARDS`` maps
+database aliases to the data sets they hold, including their descendants::
+
+    LIZARD_SECURITY_SHARDS = {'tenant_a': [3, 4], 'tenant_b': [7]}
+    DATABASE_ROUTERS = ['lizard_security.sharding.DataSetRouter']
+
+Objects of other data sets, and objects without a data set, stay in the
+default database. So do lizard-security's own models: user groups, data
+sets, permission mappers.
+
+``DataSetRouter`` saves objects in the database of their data set.
+``FilteredManager.sharded()`` returns a ``ShardedQuerySet`` that only
+queries the databases holding our allowed data sets, in parallel, and
+merges the results (in the query's ordering, for plain field orderings).
+
+Only models with a ``data_set`` foreign key can be sharded. The tables in
+the shards have no ``DataSet`` table to refer to, so define those foreign
+keys with ``db_constraint=False`` (Django 1.6) when the database enforces
+them.
+
+"""
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+from lizard_security import dbpolicies
+from lizard_security import epoch
+from lizard_security.models import DataSetAncestor
+from lizard_security.models import null_data_set_is_public
+
+_shard_map = {'epoch': None, 'map': {}}
+_shard_map_lock = threading.Lock()
+
+
+def configured_shards():
+    """Return the database aliases of all shards, including the default."""
+    return set(getattr(settings, 'LIZARD_SECURITY_SHARDS', {}).keys()) | set(
+        [DEFAULT_DB_ALIAS])
+
+
+def shard_map():
+    """Return a dict of data set id to the database alias holding it.
+
+    Data sets that aren't in there are in the default database. Nested data
+    sets are in the database of their nearest configured ancestor. Kept in
+    memory until the security epoch changes.
+
+    """
+    configured = getattr(settings, 'LIZARD_SECURITY_SHARDS', {})
+    if not configured:
+        return {}
+    current_epoch = epoch.current()
+    if _shard_map['epoch'] != current_epoch:
+        with _shard_map_lock:
+            if _shard_map['epoch'] != current_epoch:
+                aliases = {}
+                for (alias, data_set_ids) in configured.items():
+                    for data_set_id in data_set_ids:
+                        aliases[data_set_id] = alias
+                mapping = {}
+                # Deepest first, so the nearest ancestor wins.
+                for (ancestor_id, descendant_id) in (
+                    DataSetAncestor.objects.filter(
+                        ancestor__in=aliases.keys()).order_by(
+                        '-depth').values_list('ancestor', 'descendant')):
+                    mapping[descendant_id] = aliases[ancestor_id]
+                _shard_map['map'] = mapping
+                _shard_map['epoch'] = current_epoch
+    return _shard_map['map']
+
+
+def shard_for_data_set(data_set_id):
+    """Return the database alias holding the data set's objects."""
+    if data_set_id is None:
+        return DEFAULT_DB_ALIAS
+    return shard_map().get(data_set_id, DEFAULT_DB_ALIAS)
+
+
+def shards_for_data_sets(data_set_ids):
+    """Return the aliases of the databases we need for the data sets.
+
+    ``data_set_ids`` should include the descendants. None means all
+    shards.
+
+    """
+    if data_set_ids is None:
+        return configured_shards()
+    mapping = shard_map()
+    aliases = set([mapping.get(data_set_id, DEFAULT_DB_ALIAS)
+                   for data_set_id in data_set_ids])
+    if null_data_set_is_public():
+        aliases.add(DEFAULT_DB_ALIAS)
+    return aliases
+
+
+def _is_security_model(model):
+    return model._meta.app_label == 'lizard_security'
+
+
+class DataSetRouter(object):
+    """Route objects to the database of their data set.
+
+    Add ``'lizard_security.sharding.DataSetRouter'`` to
+    ``DATABASE_ROUTERS``.
+
+    """
+
+    def _db_for_instance(self, model, **hints):
+        if _is_security_model(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None or not hasattr(instance, 'data_set_id'):
+            return None
+        return shard_for_data_set(instance.data_set_id)
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_instance(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_instance(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Objects in the shards refer to data sets in the default database.
+        """
+        if _is_security_model(obj1.__class__) or _is_security_model(
+            obj2.__class__):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if _is_security_model(model):
+            return db == DEFAULT_DB_ALIAS
+        return None
+
+
+def _in_parallel(function, items):
+    """Return ``[function(item) for item in items]``, using threads.
+
+    Every thread closes its database connections afterwards. Exceptions are
+    raised again in the calling thread.
+
+    """
+    items = list(items)
+    if len(items) == 1:
+        return [function(items[0])]
+    results = [None] * len(items)
+    errors = []
+
+    def work(index, item):
+        try:
+            results[index] = function(item)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    threads = [threading.Thread(target=work, args=(index, item))
+               for (index, item) in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _sort(objects, ordering):
+    """Sort model instances by plain field names like ``'-name'``.
+
+    Orderings we cannot apply in Python (related fields, ``'?'``) leave the
+    objects in shard order.
+
+    """
+    if not objects:
+        return objects
+    for name in ordering:
+        if '__' in name.lstrip('-') or name == '?':
+            return objects
+    for name in reversed(ordering):
+        field_name = name.lstrip('-')
+        if field_name == 'pk':
+            field_name = objects[0]._meta.pk.attname
+
+        def key(obj):
+            value = getattr(obj, field_name)
+            # Like PostgreSQL: NULL after everything else.
+            return (value is None, value)
+
+        objects.sort(key=key, reverse=name.startswith('-'))
+    return objects
+
+
+class ShardedQuerySet(object):
+    """Lazy query over the shards that hold our allowed data sets.
+
+    Supports ``filter()``, ``exclude()``, ``order_by()``,
+    ``select_related()``, slicing, iteration, ``count()`` and ``exists()``.
+    The per-shard query sets are created in the calling thread (that has the
+    request, for the data set filter) and evaluated in parallel. Those other
+    threads have database connections of their own: they first get our
+    connection's restriction (see ``dbpolicies``).
+
+    """
+
+    def __init__(self, manager, operations=(), low=None, high=None):
+        self.manager = manager
+        self.operations = list(operations)
+        self.low = low
+        self.high = high
+        self._result_cache = None
+
+    def _chain(self, method, args=(), kwargs=None):
+        if self.low is not None or self.high is not None:
+            raise AssertionError(
+                "Cannot filter a query once a slice has been taken.")
+        return ShardedQuerySet(self.manager,
+                               self.operations + [(method, args,
+                                                   kwargs or {})])
+
+    def all(self):
+        return self._chain('all')
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', args, kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._chain('exclude', args, kwargs)
+
+    def order_by(self, *args):
+        return self._chain('order_by', args)
+
+    def select_related(self, *args):
+        return self._chain('select_related', args)
+
+    def shards(self):
+        """Return the aliases of the databases we need to query."""
+        # Imported here, as the manager imports us.
+        from lizard_security.manager import _allowed_data_set_ids
+        from lizard_security.strategies import descendant_ids
+        data_set_ids = _allowed_data_set_ids(self.manager.model)
+        if data_set_ids is not None:
+            data_set_ids = descendant_ids(data_set_ids)
+        return sorted(shards_for_data_sets(data_set_ids))
+
+    def query_sets(self):
+        """Return the filtered query sets per shard."""
+        result = []
+        for alias in self.shards():
+            query_set = self.manager.db_manager(alias).get_query_set()
+            for (method, args, kwargs) in self.operations:
+                query_set = getattr(query_set, method)(*args, **kwargs)
+            if self.high is not None:
+                # Every shard could hold the first ``high`` objects.
+                query_set = query_set[:self.high]
+            result.append(query_set)
+        return result
+
+    def ordering(self):
+        """Return the field names the objects are ordered by."""
+        ordering = list(self.manager.model._meta.ordering)
+        for (method, args, kwargs) in self.operations:
+            if method == 'order_by':
+                ordering = list(args)
+        return ordering
+
+    def _evaluate(self, function):
+        """Return ``function(query_set)`` for the query sets of all shards."""
+        access = dbpolicies.get_access(connections[DEFAULT_DB_ALIAS])
+
+        def evaluate(query_set):
+            connection = connections[query_set.db]
+            previous = dbpolicies.get_access(connection)
+            if previous != access:
+                dbpolicies.set_access(connection, access)
+            try:
+                return function(query_set)
+            finally:
+                if previous != access:
+                    dbpolicies.set_access(connection, previous)
+
+        return _in_parallel(evaluate, self.query_sets())
+
+    def _fetch(self):
+        if self._result_cache is None:
+            objects = sum(self._evaluate(list), [])
+            objects = _sort(objects, self.ordering())
+            self._result_cache = objects[self.low or 0:self.high]
+        return self._result_cache
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __len__(self):
+        return len(self._fetch())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("Sharded query sets don't support steps.")
+            low = (self.low or 0) + (key.start or 0)
+            if key.stop is None:
+                high = self.high
+            else:
+                high = (self.low or 0) + key.stop
+                if self.high is not None:
+                    high = min(high, self.high)
+            return ShardedQuerySet(self.manager, self.operations, low, high)
+        result = list(self[key:key + 1])
+        if not result:
+            raise IndexError("Sharded query set index out of range")
+        return result[0]
+
+    def count(self):
+        if self._result_cache is not None or self.low or self.high:
+            return len(self._fetch())
+        return sum(self._evaluate(lambda query_set: query_set.count()))
+
+    def exists(self):
+        return any(self._evaluate(lambda query_set: query_set.exists()))
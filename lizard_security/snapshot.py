@@ -0,0 +1,214 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+An *access snapshot* is everything the security layer needs to know about a
+client: its effective user groups and the data sets those give access to.
+Clients that make many requests (API tokens, for instance) can keep a
+snapshot in memory instead of resolving it again for every request.
+
+A snapshot is valid as long as the security epoch (see
+``lizard_security.epoch``) is unchanged and its ``expires`` moment (the next
+``valid_from``/``valid_until`` of a relevant permission mapper) hasn't
+passed.
+
+"""
+from collections import namedtuple
+from collections import OrderedDict
+import threading
+
+from django.db.models import Q
+from django.utils import timezone
+
+from lizard_security import epoch
+from lizard_security.models import DataSet
+from lizard_security.models import UserGroup
+from lizard_security.models import UserGroupAncestor
+from lizard_security.models import next_validity_change
+from lizard_security.models import valid_mappers
+
+AccessSnapshot = namedtuple(
+    'AccessSnapshot',
+    ['user', 'user_group_ids', 'data_set_ids', 'epoch', 'expires'])
+
+
+def user_group_ids_for_user(user):
+    """Return ids of the user groups the user is (indirectly) a member of."""
+    return UserGroupAncestor.objects.filter(
+        descendant__members=user).values_list(
+        'ancestor', flat=True).distinct()
+
+
+def containing_user_group_ids(user_group_ids):
+    """Return the user groups plus all user groups containing them."""
+    return UserGroupAncestor.objects.filter(
+        descendant__in=user_group_ids).values_list(
+        'ancestor', flat=True).distinct()
+
+
+def data_set_ids_for_user_groups(user_group_ids):
+    """Return ids of data sets the user groups have access to.
+
+    Any valid permission mapper from a user group to a data set gives
+    (implicit view) access to that data set and all its descendants.
+
+    """
+    mapper_prefix = 'ancestor_links__ancestor__permission_mappers__'
+    return DataSet.objects.filter(
+        Q(**{mapper_prefix + 'user_group__id__in': user_group_ids}) &
+        valid_mappers(prefix=mapper_prefix)
+        ).values_list('id', flat=True)
+
+
+_public = {'epoch': None, 'ids': frozenset()}
+_public_lock = threading.Lock()
+
+
+def public_data_set_ids(current_epoch=None):
+    """Return ids of the public data sets and all their descendants.
+
+    The result is kept in memory until the security epoch changes, so most
+    requests don't need a query for it.
+
+    """
+    if current_epoch is None:
+        current_epoch = epoch.current()
+    if _public['epoch'] != current_epoch:
+        with _public_lock:
+            if _public['epoch'] != current_epoch:
+                _public['ids'] = frozenset(DataSet.objects.filter(
+                        ancestor_links__ancestor__is_public=True).order_by(
+                        ).values_list('id', flat=True))
+                _public['epoch'] = current_epoch
+    return _public['ids']
+
+
+# The preloaded data sets per user group: ``(epoch, expires, mapping)``.
+_preloaded = [None]
+
+
+def preload_user_group_data_set_ids(current_epoch=None):
+    """Load the data sets of all user groups into memory; return the dict.
+
+    The dict maps user group ids to the data sets they have access to, like
+    ``data_set_ids_for_user_groups()``. Until the security epoch changes or
+    any permission mapper becomes valid or invalid, ``resolve()`` takes the
+    data sets from it instead of querying for them.
+
+    """
+    if current_epoch is None:
+        current_epoch = epoch.current()
+    mapper_prefix = 'ancestor_links__ancestor__permission_mappers__'
+    rows = DataSet.objects.filter(
+        Q(**{mapper_prefix + 'user_group__isnull': False}) &
+        valid_mappers(prefix=mapper_prefix)
+        ).order_by().values_list(mapper_prefix + 'user_group', 'id').distinct()
+    mapping = {}
+    for (user_group_id, data_set_id) in rows:
+        mapping.setdefault(user_group_id, set()).add(data_set_id)
+    mapping = dict([(user_group_id, frozenset(data_set_ids))
+                    for (user_group_id, data_set_ids) in mapping.items()])
+    expires = next_validity_change(UserGroup.objects.all())
+    _preloaded[0] = (current_epoch, expires, mapping)
+    return mapping
+
+
+def forget_preloaded():
+    """Stop using the preloaded data sets per user group."""
+    _preloaded[0] = None
+
+
+def _preloaded_data_set_ids(user_group_ids, current_epoch):
+    """Return ``(data_set_ids, expires)`` if preloaded and current, or None.
+    """
+    preloaded = _preloaded[0]
+    if preloaded is None or preloaded[0] != current_epoch:
+        return None
+    (expires, mapping) = preloaded[1:]
+    if expires is not None and expires <= timezone.now():
+        return None
+    data_set_ids = set()
+    for user_group_id in user_group_ids:
+        data_set_ids.update(mapping.get(user_group_id, ()))
+    # Expires no later than the snapshot of just these user groups would.
+    return frozenset(data_set_ids), expires
+
+
+def resolve(user=None, user_group_ids=()):
+    """Return a fresh access snapshot.
+
+    Effective user groups are the user's user groups (if there's a user)
+    plus the given user groups and everything containing them.
+
+    """
+    current_epoch = epoch.current()
+    effective_ids = set()
+    if user is not None and not user.is_anonymous():
+        effective_ids.update(user_group_ids_for_user(user))
+    if user_group_ids:
+        effective_ids.update(containing_user_group_ids(user_group_ids))
+    effective_ids = frozenset(effective_ids)
+    preloaded = None
+    if effective_ids:
+        preloaded = _preloaded_data_set_ids(effective_ids, current_epoch)
+    if preloaded is not None:
+        (data_set_ids, expires) = preloaded
+    elif effective_ids:
+        data_set_ids = frozenset(data_set_ids_for_user_groups(effective_ids))
+        expires = next_validity_change(effective_ids)
+    else:
+        data_set_ids = frozenset()
+        expires = None
+    return AccessSnapshot(user=user,
+                          user_group_ids=effective_ids,
+                          data_set_ids=data_set_ids,
+                          epoch=current_epoch,
+                          expires=expires)
+
+
+def is_current(snapshot, current_epoch=None):
+    """Return whether the snapshot can still be used."""
+    if current_epoch is None:
+        current_epoch = epoch.current()
+    if snapshot.epoch != current_epoch:
+        return False
+    return snapshot.expires is None or snapshot.expires > timezone.now()
+
+
+class LRUCache(object):
+    """Thread-safe dictionary holding at most ``max_size`` items.
+
+    When full, the least recently used item is dropped.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
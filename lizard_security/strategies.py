@@ -0,0 +1,465 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Strategies for the SQL shape of ``FilteredManager``'s data set filter.
+
+Which shape performs best depends on the size of the table, the number of
+allowed data sets and the database. The available strategies:
+
+- ``'subquery'`` (the default): ``data_set_id IN (SELECT descendant_id FROM
+  <closure table> WHERE ancestor_id IN (...))``.
+
+- ``'in'``: a literal ``data_set_id IN (1, 2, 3)`` of the allowed data sets
+  and their descendants. The descendants are looked up once per security
+  epoch and access set, in Python. Best for few data sets.
+
+- ``'exists'``: a correlated ``EXISTS`` subquery on the closure table.
+
+- ``'join'``: a join with a temporary table holding the allowed data sets
+  and their descendants (PostgreSQL and SQLite only), one table per access
+  set. The table is filled when the query is executed. In Django 1.6's
+  autocommit mode, that happens once per connection and access set; inside
+  transactions (and before Django 1.6) for every query, as a rollback also
+  rolls back the table's contents. Best for many data sets.
+
+- ``'union'``: ``pk IN (... WHERE data_set_id IS NULL UNION ALL ... WHERE
+  data_set_id IN (...))``, so both halves can use the data set index. Only
+  differs from ``'subquery'`` while objects without a data set are public.
+
+``LIZARD_SECURITY_FILTER_STRATEGY`` selects the strategy for all models.
+``LIZARD_SECURITY_MODEL_FILTER_STRATEGIES`` does so per model, with a dict
+of ``'app_label.model'`` to strategy. Instead of a strategy name, both also
+accept a list of thresholds: ``(maximum number of allowed data sets,
+strategy name)`` pairs, in increasing order, with ``None`` as the last
+maximum. For example::
+
+    LIZARD_SECURITY_FILTER_STRATEGY = [(20, 'in'), (None, 'join')]
+
+With ``LIZARD_SECURITY_FILTER_CALIBRATE = True``, ``SecurityMiddleware``
+calls ``calibrate()`` when it's created: it asks the database (PostgreSQL
+only) to ``EXPLAIN`` every strategy for every secured model without a
+configured strategy of its own and uses the cheapest one per number of
+data sets.
+
+Models with a ``data_sets`` many-to-many field are always filtered with
+``EXISTS`` subqueries, see ``manager.data_sets_where()``.
+
+Queries on databases without the closure table (shards, see
+``lizard_security.sharding``) always use ``'in'``.
+
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.sql.where import AND
+from django.db.models.sql.where import ExtraWhere
+
+from lizard_security import epoch
+from lizard_security import sharding
+from lizard_security import snapshot
+from lizard_security.models import DataSet
+from lizard_security.models import DataSetAncestor
+from lizard_security.models import null_data_set_is_public
+
+# Numbers of data sets to try when calibrating.
+CALIBRATION_SIZES = (1, 10, 100, 1000)
+
+logger = logging.getLogger(__name__)
+
+_descendants = snapshot.LRUCache(1000)
+
+
+def descendant_ids(data_set_ids):
+    """Return the data sets and their descendants, as a sorted list.
+
+    Cached per security epoch and set of data sets.
+
+    """
+    key = (epoch.current(), frozenset(data_set_ids))
+    cached = _descendants.get(key)
+    if cached is None:
+        cached = sorted(set(DataSetAncestor.objects.filter(
+                    ancestor__in=data_set_ids).values_list(
+                    'descendant', flat=True)))
+        _descendants.set(key, cached)
+    return cached
+
+
+def _column(query_set, connection):
+    """Return the quoted data set column of the query set's model."""
+    quote_name = connection.ops.quote_name
+    opts = query_set.model._meta
+    return '%s.%s' % (quote_name(opts.db_table),
+                      quote_name(opts.get_field('data_set').column))
+
+
+def _in_transaction(connection):
+    """Return whether a rollback could still undo our changes."""
+    if not hasattr(connection, 'in_atomic_block'):
+        # Before Django 1.6, there is no real autocommit mode.
+        return True
+    return connection.in_atomic_block or not connection.get_autocommit()
+
+
+class FilterStrategy(object):
+    """Base class for ways to filter a query set on data sets."""
+    name = None
+
+    def supports(self, connection):
+        """Return whether the strategy works on the database connection."""
+        return True
+
+    def apply(self, query_set, data_set_ids, include_null):
+        """Return the query set limited to the (non-empty) data sets.
+
+        ``include_null`` says whether objects without a data set are
+        included, too.
+
+        """
+        raise NotImplementedError
+
+
+class SubqueryStrategy(FilterStrategy):
+    name = 'subquery'
+
+    def condition(self, data_set_ids, include_null):
+        """Return the filter as a Q object."""
+        empty_data_set = Q(data_set=None) if include_null else None
+        if not data_set_ids:
+            # Matches nothing without the null data sets, without a query.
+            return empty_data_set or Q(pk__in=[])
+        match_with_data_set = Q(data_set__in=DataSetAncestor.objects.filter(
+                ancestor__in=data_set_ids).values('descendant'))
+        if empty_data_set is None:
+            return match_with_data_set
+        return empty_data_set | match_with_data_set
+
+    def apply(self, query_set, data_set_ids, include_null):
+        return query_set.filter(self.condition(data_set_ids, include_null))
+
+
+class LiteralInStrategy(FilterStrategy):
+    name = 'in'
+
+    def apply(self, query_set, data_set_ids, include_null):
+        condition = Q(data_set__in=descendant_ids(data_set_ids))
+        if include_null:
+            condition |= Q(data_set=None)
+        return query_set.filter(condition)
+
+
+class ExistsStrategy(FilterStrategy):
+    name = 'exists'
+
+    def apply(self, query_set, data_set_ids, include_null):
+        connection = connections[query_set.db]
+        column = _column(query_set, connection)
+        quote_name = connection.ops.quote_name
+        closure = DataSetAncestor._meta
+        where = ('EXISTS (SELECT 1 FROM %s closure WHERE closure.%s = %s '
+                 'AND closure.%s IN (%s))') % (
+            quote_name(closure.db_table),
+            quote_name(closure.get_field('descendant').column),
+            column,
+            quote_name(closure.get_field('ancestor').column),
+            ', '.join(['%s'] * len(data_set_ids)))
+        if include_null:
+            where = '(%s IS NULL OR %s)' % (column, where)
+        return query_set.extra(where=[where], params=list(data_set_ids))
+
+
+class AccessTableWhere(ExtraWhere):
+    """Where clause that fills its access table when the query is compiled.
+
+    Query sets that are never evaluated don't touch the database, and those
+    that are evaluated by another thread (see ``sharding``) fill the table
+    on that thread's connection.
+
+    """
+
+    def __init__(self, strategy, data_set_ids, sqls):
+        super(AccessTableWhere, self).__init__(sqls, [])
+        self.strategy = strategy
+        self.data_set_ids = data_set_ids
+
+    def as_sql(self, qn=None, connection=None):
+        self.strategy.materialize(connection, self.data_set_ids)
+        return super(AccessTableWhere, self).as_sql(qn, connection)
+
+
+class AccessTableStrategy(FilterStrategy):
+    name = 'join'
+    table_prefix = 'lizard_security_filter_access_'
+    # Tables kept per connection, one per access set.
+    max_tables = 100
+
+    def supports(self, connection):
+        return connection.vendor in ('postgresql', 'sqlite')
+
+    def table(self, data_set_ids):
+        """Return the name of the temporary table for the data sets.
+
+        Every access set has a table of its own, so query sets with
+        different access sets can't get each other's rows.
+
+        """
+        ids = descendant_ids(data_set_ids)
+        return self.table_prefix + hashlib.sha1(
+            ','.join([str(data_set_id) for data_set_id in ids])).hexdigest(
+            )[:16]
+
+    def materialize(self, connection, data_set_ids):
+        """Fill the connection's temporary table for the data sets.
+
+        Tables that were filled outside a transaction are re-used. Inside a
+        transaction, the table is filled every time: a rollback would undo
+        the filling, but not our bookkeeping. Returns the table name.
+
+        """
+        table = self.table(data_set_ids)
+        # Connects, if needed.
+        cursor = connection.cursor()
+        # The wrapper outlives the database connection itself. We keep the
+        # database connection (not its id(), which can be reused) to see
+        # whether the wrapper reconnected since.
+        filled = getattr(connection, '_lizard_security_access', None)
+        if filled is None or filled[0] is not connection.connection:
+            filled = (connection.connection, OrderedDict())
+            connection._lizard_security_access = filled
+        tables = filled[1]
+        if table in tables:
+            # The most recently used one now.
+            tables[table] = tables.pop(table)
+            return table
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS %s '
+                       '(data_set_id INTEGER PRIMARY KEY)' % table)
+        cursor.execute('DELETE FROM %s' % table)
+        cursor.executemany('INSERT INTO %s VALUES (%%s)' % table,
+                           [(data_set_id, ) for data_set_id
+                            in descendant_ids(data_set_ids)])
+        if not _in_transaction(connection):
+            tables[table] = True
+            while len(tables) > self.max_tables:
+                cursor.execute('DROP TABLE IF EXISTS %s' %
+                               tables.popitem(last=False)[0])
+        return table
+
+    def apply(self, query_set, data_set_ids, include_null):
+        connection = connections[query_set.db]
+        column = _column(query_set, connection)
+        table = connection.ops.quote_name(self.table(data_set_ids))
+        access = '%s.data_set_id' % table
+        if include_null:
+            # An inner join would lose the objects without a data set.
+            where = ('(%s IS NULL OR EXISTS (SELECT 1 FROM %s WHERE %s = %s))'
+                     % (column, table, access, column))
+        else:
+            query_set = query_set.extra(tables=[self.table(data_set_ids)])
+            where = '%s = %s' % (access, column)
+        query_set = query_set._clone()
+        query_set.query.where.add(
+            AccessTableWhere(self, data_set_ids, [where]), AND)
+        return query_set
+
+
+class UnionAllStrategy(FilterStrategy):
+    name = 'union'
+
+    def apply(self, query_set, data_set_ids, include_null):
+        if not include_null:
+            return SUBQUERY.apply(query_set, data_set_ids, include_null)
+        connection = connections[query_set.db]
+        quote_name = connection.ops.quote_name
+        opts = query_set.model._meta
+        closure = DataSetAncestor._meta
+        table = quote_name(opts.db_table)
+        pk = quote_name(opts.pk.column)
+        data_set = quote_name(opts.get_field('data_set').column)
+        where = (
+            '%(table)s.%(pk)s IN ('
+            'SELECT part.%(pk)s FROM %(table)s part '
+            'WHERE part.%(data_set)s IS NULL '
+            'UNION ALL '
+            'SELECT part.%(pk)s FROM %(table)s part '
+            'WHERE part.%(data_set)s IN (SELECT %(descendant)s FROM '
+            '%(closure)s WHERE %(ancestor)s IN (%(ids)s)))') % {
+            'table': table,
+            'pk': pk,
+            'data_set': data_set,
+            'descendant': quote_name(closure.get_field('descendant').column),
+            'closure': quote_name(closure.db_table),
+            'ancestor': quote_name(closure.get_field('ancestor').column),
+            'ids': ', '.join(['%s'] * len(data_set_ids))}
+        return query_set.extra(where=[where], params=list(data_set_ids))
+
+
+SUBQUERY = SubqueryStrategy()
+STRATEGIES = {}
+
+
+def register(strategy):
+    """Make a strategy (instance) available under its ``name``."""
+    STRATEGIES[strategy.name] = strategy
+
+
+for _strategy in (SUBQUERY, LiteralInStrategy(), ExistsStrategy(),
+                  AccessTableStrategy(), UnionAllStrategy()):
+    register(_strategy)
+
+# Thresholds found by calibrate(), by model label.
+_calibrated = {}
+_calibrated_lock = threading.Lock()
+_calibration_started = False
+
+
+def _label(model):
+    return model._meta.app_label + '.' + model._meta.module_name
+
+
+def _pick(configured, size):
+    """Return the strategy name for the number of data sets."""
+    if isinstance(configured, basestring):
+        return configured
+    for (max_size, name) in configured:
+        if max_size is None or size <= max_size:
+            return name
+    return configured[-1][1]
+
+
+def choose(model, size, connection=None):
+    """Return the strategy for filtering the model on ``size`` data sets.
+
+    A strategy configured for the model wins from a calibrated one, which
+    wins from the general setting. Strategies the database doesn't support
+    are replaced by ``'subquery'``.
+
+    """
+    label = _label(model)
+    configured = getattr(settings, 'LIZARD_SECURITY_MODEL_FILTER_STRATEGIES',
+                         {}).get(label)
+    if configured is None:
+        configured = _calibrated.get(label)
+    if configured is None:
+        configured = getattr(settings, 'LIZARD_SECURITY_FILTER_STRATEGY',
+                             SUBQUERY.name)
+    strategy = STRATEGIES.get(_pick(configured, size), SUBQUERY)
+    if connection is not None and not strategy.supports(connection):
+        return SUBQUERY
+    return strategy
+
+
+def _strategy_for(model, data_set_ids, alias):
+    if alias != DEFAULT_DB_ALIAS and alias in sharding.configured_shards():
+        # A shard without the closure table.
+        return STRATEGIES[LiteralInStrategy.name]
+    return choose(model, len(data_set_ids), connections[alias])
+
+
+def apply_filter(query_set, data_set_ids):
+    """Return the query set limited to the data sets, by the chosen strategy.
+    """
+    include_null = null_data_set_is_public()
+    if not data_set_ids:
+        return SUBQUERY.apply(query_set, data_set_ids, include_null)
+    strategy = _strategy_for(query_set.model, data_set_ids, query_set.db)
+    return strategy.apply(query_set, data_set_ids, include_null)
+
+
+_COST = re.compile(r'cost=[\d.]+\.\.([\d.]+)')
+
+
+def explain_cost(query_set):
+    """Return the database's estimated total cost of the query, if known.
+
+    Only PostgreSQL gives us a cost; None for other databases.
+
+    """
+    connection = connections[query_set.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = query_set.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN ' + sql, params)
+    match = _COST.search(cursor.fetchone()[0])
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def calibrate(models=None, sizes=CALIBRATION_SIZES):
+    """Pick the cheapest strategy per model and number of data sets.
+
+    For every size, ``EXPLAIN`` is asked for the cost of every supported
+    strategy with that many (existing) data sets. Models with a strategy of
+    their own in ``LIZARD_SECURITY_MODEL_FILTER_STRATEGIES`` are skipped.
+    Returns a dict of model label to the thresholds that ``choose()`` uses
+    from now on.
+
+    """
+    # Imported here, as the manager imports us.
+    from lizard_security.manager import secured_models
+    from lizard_security.models import data_sets_field
+    if models is None:
+        models = secured_models()
+    configured = getattr(settings, 'LIZARD_SECURITY_MODEL_FILTER_STRATEGIES',
+                         {})
+    all_ids = list(DataSet.objects.order_by('id').values_list(
+            'id', flat=True)[:max(sizes)])
+    if all_ids:
+        sizes = sorted(set([min(size, len(all_ids)) for size in sizes]))
+    else:
+        sizes = []
+    include_null = null_data_set_is_public()
+    result = {}
+    for model in models:
+        label = _label(model)
+        if label in configured or data_sets_field(model) is not None:
+            continue
+        # Not through the model's manager: we're filtering ourselves.
+        query_set = QuerySet(model)
+        connection = connections[query_set.db]
+        thresholds = []
+        for size in sizes:
+            costs = []
+            for name in sorted(STRATEGIES):
+                strategy = STRATEGIES[name]
+                if not strategy.supports(connection):
+                    continue
+                cost = explain_cost(strategy.apply(
+                        query_set, all_ids[:size], include_null))
+                if cost is not None:
+                    costs.append((cost, name))
+            if costs:
+                thresholds.append((size, min(costs)[1]))
+        if thresholds:
+            thresholds[-1] = (None, thresholds[-1][1])
+            result[label] = thresholds
+    with _calibrated_lock:
+        _calibrated.clear()
+        _calibrated.update(result)
+    return result
+
+
+def calibrate_configured():
+    """Calibrate once per process if ``LIZARD_SECURITY_FILTER_CALIBRATE``.
+    """
+    global _calibration_started
+    if not getattr(settings, 'LIZARD_SECURITY_FILTER_CALIBRATE', False):
+        return
+    with _calibrated_lock:
+        if _calibration_started:
+            return
+        _calibration_started = True
+    try:
+        calibrate()
+    except Exception:
+        # Without calibration, we simply use the configured strategies.
+        logger.exception("Calibrating the filter strategies failed")
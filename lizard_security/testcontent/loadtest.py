@@ -0,0 +1,259 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Load test of the security middleware and managers under concurrency.
+
+``make_fixtures()`` fills the database with synthetic users, user groups,
+data sets, permission mappers and content, all named with ``PREFIX`` so
+that ``remove_fixtures()`` can clean them up again. ``run()`` logs in the
+fixture users with Django's test client and requests the given URLs (by
+default the ``overview`` page and the content admin) from an increasing
+number of concurrent workers: threads, optionally spread over several
+processes. Per concurrency level it reports the throughput, the latency
+percentiles and the number of queries per request.
+
+This uses the configured database, not a test database: use it on a
+development or staging copy. The ``security_load_test`` management command
+wraps it all.
+
+"""
+from collections import namedtuple
+import math
+import multiprocessing
+import random
+import threading
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from lizard_security import epoch
+from lizard_security.models import DataSet
+from lizard_security.models import PermissionMapper
+from lizard_security.models import UserGroup
+from lizard_security.testcontent.models import Content
+
+PREFIX = 'loadtest-'
+PASSWORD = 'loadtest'
+PERCENTILES = (50, 90, 99)
+
+Sample = namedtuple('Sample', ['seconds', 'queries', 'status'])
+LevelResult = namedtuple(
+    'LevelResult',
+    ['concurrency', 'requests', 'errors', 'seconds', 'throughput',
+     'latencies', 'mean_queries', 'max_queries'])
+
+
+def make_fixtures(users=50, data_sets=100, contents=1000,
+                  data_sets_per_user_group=10):
+    """Create synthetic fixtures; return the usernames.
+
+    Every user gets its own user group with permission mappers (including
+    the permission to change content, for the admin) to a random selection
+    of the data sets. Content is spread evenly over the data sets.
+
+    """
+    random.seed(0)
+    group, _ = Group.objects.get_or_create(name=PREFIX + 'editors')
+    group.permissions.add(
+        *Permission.objects.filter(content_type__app_label='testcontent'))
+    with epoch.coalesced():
+        # Saved one by one, for their closure table entries.
+        data_set_ids = [
+            DataSet.objects.create(name='%sdata-set-%s' % (PREFIX, number)).id
+            for number in range(data_sets)]
+    Content.objects.bulk_create(
+        [Content(name='%scontent-%s' % (PREFIX, number),
+                 data_set_id=data_set_ids[number % len(data_set_ids)])
+         for number in range(contents)])
+    # Hashing is slow on purpose; all users share the same password.
+    password = make_password(PASSWORD)
+    usernames = ['%suser-%s' % (PREFIX, number) for number in range(users)]
+    User.objects.bulk_create(
+        [User(username=username, password=password, is_staff=True)
+         for username in usernames])
+    with epoch.coalesced():
+        for user in User.objects.filter(username__in=usernames):
+            user_group = UserGroup.objects.create(name=PREFIX + user.username)
+            user_group.members.add(user)
+            PermissionMapper.objects.bulk_create(
+                [PermissionMapper(name=PREFIX + user.username,
+                                  user_group=user_group,
+                                  data_set_id=data_set_id,
+                                  permission_group=group)
+                 for data_set_id in random.sample(
+                        data_set_ids,
+                        min(data_sets_per_user_group, len(data_set_ids)))])
+    return usernames
+
+
+def remove_fixtures():
+    """Remove everything ``make_fixtures()`` created."""
+    with epoch.coalesced():
+        PermissionMapper.objects.filter(name__startswith=PREFIX).delete()
+        UserGroup.objects.filter(name__startswith=PREFIX).delete()
+        User.objects.filter(username__startswith=PREFIX).delete()
+        Content.objects.filter(name__startswith=PREFIX).delete()
+        DataSet.objects.filter(name__startswith=PREFIX).delete()
+        Group.objects.filter(name__startswith=PREFIX).delete()
+
+
+def fixture_usernames():
+    """Return the usernames of the fixture users."""
+    return list(User.objects.filter(username__startswith=PREFIX).values_list(
+            'username', flat=True))
+
+
+def default_urls():
+    """Return the URLs of the overview page and the content admin."""
+    return [reverse('overview'),
+            reverse('admin:testcontent_content_changelist')]
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of the values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class _QueryCounter(object):
+    """Count the queries of this thread's connection, even without DEBUG.
+
+    Like Django 1.6's ``CaptureQueriesContext``, which older versions lack.
+
+    """
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        # Django empties the list at the start of a request, too.
+        connection.queries = []
+        return self
+
+    def __exit__(self, *exc_info):
+        connection.use_debug_cursor = self.use_debug_cursor
+
+    def __len__(self):
+        return len(connection.queries)
+
+
+def _work(username, urls, requests, samples):
+    """Log in and do the requests, appending a ``Sample`` for each."""
+    client = Client()
+    if username is not None:
+        client.login(username=username, password=PASSWORD)
+    for number in range(requests):
+        with _QueryCounter() as queries:
+            start = time.time()
+            response = client.get(urls[number % len(urls)])
+            seconds = time.time() - start
+        samples.append(Sample(seconds, len(queries), response.status_code))
+
+
+def _work_in_thread(*args):
+    try:
+        _work(*args)
+    finally:
+        # Every thread has its own database connection.
+        connection.close()
+
+
+def _run_threads(workers, usernames, urls, requests):
+    """Run the workers as threads; return all samples."""
+    samples = []
+    if workers == 1:
+        # No thread needed: handy for SQLite's in-memory test databases.
+        _work(usernames[0], urls, requests, samples)
+        return samples
+    threads = [threading.Thread(target=_work_in_thread,
+                                args=(usernames[number % len(usernames)],
+                                      urls, requests, samples))
+               for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def _run_process(arguments):
+    """Run a share of the workers in a child process."""
+    # Connections shouldn't be shared with the parent process.
+    connection.close()
+    return _run_threads(*arguments)
+
+
+def run_level(concurrency, usernames, urls, requests=20, processes=1):
+    """Run ``concurrency`` workers doing ``requests`` requests each.
+
+    With more than one process, the workers are spread over the processes.
+
+    """
+    if not usernames:
+        usernames = [None]
+    start = time.time()
+    processes = min(processes, concurrency)
+    if processes > 1:
+        # Each process gets its own share of the workers and users.
+        arguments = [(len(range(number, concurrency, processes)),
+                      usernames[number::processes] or usernames,
+                      urls, requests)
+                     for number in range(processes)]
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            samples = sum(pool.map(_run_process, arguments), [])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        samples = _run_threads(concurrency, usernames, urls, requests)
+    seconds = time.time() - start
+    latencies = [sample.seconds for sample in samples]
+    queries = [sample.queries for sample in samples]
+    return LevelResult(
+        concurrency=concurrency,
+        requests=len(samples),
+        errors=len([sample for sample in samples if sample.status >= 400]),
+        seconds=seconds,
+        throughput=len(samples) / seconds if seconds else 0.0,
+        latencies=dict([(percent, percentile(latencies, percent))
+                        for percent in PERCENTILES]),
+        mean_queries=float(sum(queries)) / len(queries) if queries else 0.0,
+        max_queries=max(queries) if queries else 0)
+
+
+def run(levels=(1, 2, 4, 8, 16), usernames=None, urls=None, requests=20,
+        processes=1):
+    """Run all concurrency levels; return a list of ``LevelResult``."""
+    if usernames is None:
+        usernames = fixture_usernames()
+    if urls is None:
+        urls = default_urls()
+    return [run_level(concurrency, usernames, urls, requests=requests,
+                      processes=processes)
+            for concurrency in levels]
+
+
+def report(results):
+    """Return the results as a text table."""
+    lines = ['%11s %8s %6s %10s %8s %8s %8s %9s %8s' % (
+            'concurrency', 'requests', 'errors', 'req/s', 'p50 ms',
+            'p90 ms', 'p99 ms', 'queries', 'max q')]
+    for result in results:
+        lines.append('%11s %8s %6s %10.1f %8.1f %8.1f %8.1f %9.1f %8s' % (
+                result.concurrency, result.requests, result.errors,
+                result.throughput,
+                1000 * (result.latencies[50] or 0),
+                1000 * (result.latencies[90] or 0),
+                1000 * (result.latencies[99] or 0),
+                result.mean_queries, result.max_queries))
+    return '\n'.join(lines)
@@ -0,0 +1,90 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_security.testcontent import loadtest
+
+
+class Command(BaseCommand):
+    """Load test the security middleware and managers.
+
+    See ``lizard_security.testcontent.loadtest``. Run it with
+    ``--make-fixtures`` once to create the synthetic users and content, and
+    with ``--remove-fixtures`` to clean them up.
+
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--make-fixtures',
+                    action='store_true',
+                    dest='make_fixtures',
+                    default=False,
+                    help='Create the synthetic fixtures first.'),
+        make_option('--remove-fixtures',
+                    action='store_true',
+                    dest='remove_fixtures',
+                    default=False,
+                    help='Remove the synthetic fixtures afterwards.'),
+        make_option('--users',
+                    type='int',
+                    dest='users',
+                    default=50,
+                    help='Number of fixture users (default 50).'),
+        make_option('--data-sets',
+                    type='int',
+                    dest='data_sets',
+                    default=100,
+                    help='Number of fixture data sets (default 100).'),
+        make_option('--contents',
+                    type='int',
+                    dest='contents',
+                    default=1000,
+                    help='Number of fixture content objects (default 1000).'),
+        make_option('--levels',
+                    dest='levels',
+                    default='1,2,4,8,16',
+                    help='Comma separated numbers of concurrent workers.'),
+        make_option('--requests',
+                    type='int',
+                    dest='requests',
+                    default=20,
+                    help='Requests per worker per level (default 20).'),
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=1,
+                    help='Spread the workers over this many processes.'),
+        make_option('--url',
+                    action='append',
+                    dest='urls',
+                    default=None,
+                    help=('URL to request (repeatable). Defaults to the '
+                          'overview page and the content admin.')),
+        )
+    help = ("Measure throughput, latency percentiles and queries per request "
+            "under increasing concurrency.")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['levels'].split(',')]
+        except ValueError:
+            raise CommandError("Invalid --levels: %s" % options['levels'])
+        if options['make_fixtures']:
+            loadtest.make_fixtures(users=options['users'],
+                                   data_sets=options['data_sets'],
+                                   contents=options['contents'])
+        try:
+            usernames = loadtest.fixture_usernames()
+            if not usernames:
+                raise CommandError(
+                    "No fixture users; run with --make-fixtures.")
+            results = loadtest.run(levels=levels,
+                                   usernames=usernames,
+                                   urls=options['urls'],
+                                   requests=options['requests'],
+                                   processes=options['processes'])
+            self.stdout.write(loadtest.report(results))
+        finally:
+            if options['remove_fixtures']:
+                loadtest.remove_fixtures()
@@ -4,6 +4,7 @@ from django.contrib import admin
 
 from lizard_security.manager import FilteredManager
 from lizard_security.manager import FilteredGeoManager
+from lizard_security.manager import SecuredJoinManager
 from lizard_security.models import DataSet
 from lizard_security.admin import SecurityFilteredAdmin
 
@@ -38,6 +39,7 @@ class Content(models.Model):
                                  null=True,
                                  blank=True)
     objects = FilteredManager()
+    cached_objects = FilteredManager(cache_results=True)
 
     def __unicode__(self):
         if self.data_set:
@@ -47,9 +49,24 @@ class Content(models.Model):
         return '%s (%s)' % (self.name, data_set_name)
 
 
+class SharedContent(models.Model):
+    """Test content that belongs to several data sets at once."""
+    supports_object_permissions = True
+    name = models.CharField('name',
+                            max_length=80,
+                            blank=True)
+    data_sets = models.ManyToManyField(DataSet,
+                                       blank=True)
+    objects = FilteredManager()
+
+    def __unicode__(self):
+        return self.name
+
+
 class ContentWithForeignKeyToContentWithDataset(models.Model):
     name = models.TextField('Some field')
     content = models.ForeignKey(Content, null=True)
+    objects = SecuredJoinManager()
 
 
 class GeoContent(geo_models.Model):
@@ -81,3 +98,4 @@ class GeoContent(geo_models.Model):
 
 admin.site.register(Content, SecurityFilteredAdmin)
 admin.site.register(GeoContent, SecurityFilteredAdmin)
+admin.site.register(SharedContent, SecurityFilteredAdmin)
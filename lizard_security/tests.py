@@ -1,29 +1,77 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 # -*- coding: utf-8 -*-
+from StringIO import StringIO
+import datetime
+import json
+import tempfile
+import threading
+import time
 
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.models import Group
 from django.contrib.auth.models import Permission
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import PermissionDenied
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.db.models.sql.subqueries import DateQuery
 from django.test import TestCase
 from django.test.client import Client
 from django.test.client import RequestFactory
+from django.utils import timezone
 from mock import Mock
 from mock import patch
 
 from lizard_security.admin import UserGroupAdmin
+from lizard_security.admin import effective_permissions
+from lizard_security.admin import SecurityFilteredAdmin
 from lizard_security.admin import UserGroupAdminForm
 from lizard_security.backends import LizardPermissionBackend
+from lizard_security.iptree import PrefixTree
+from lizard_security.middleware import DatabaseSecurityMiddleware
+from lizard_security.middleware import IPRangeMiddleware
+from lizard_security.middleware import ReplicaConsistencyMiddleware
 from lizard_security.middleware import SecurityMiddleware
+from lizard_security.middleware import TokenMiddleware
+from lizard_security.models import APIToken
+from lizard_security.models import AccessLog
 from lizard_security.models import DataSet
+from lizard_security.models import DataSetAncestor
+from lizard_security.models import DataSetExtent
+from lizard_security.models import IPRange
 from lizard_security.models import PermissionMapper
 from lizard_security.models import UserGroup
+from lizard_security.models import UserGroupAncestor
+from lizard_security.models import next_validity_change
+from lizard_security.testcontent import loadtest
 from lizard_security.testcontent import models as testmodels
 from lizard_security.testcontent.models import ContentWithoutDataset
 from lizard_security.testcontent.models import Content
 from lizard_security.testcontent.models import GeoContent
+from lizard_security.testcontent.models import SharedContent
+from lizard_security import audit
+from lizard_security import bulk
+from lizard_security import dbpolicies
+from lizard_security import epoch
+from lizard_security import extents
 from lizard_security import manager as geo_manager
+from lizard_security import middleware
+from lizard_security import profiles
+from lizard_security import providers
+from lizard_security import replicas
+from lizard_security import resultcache
+from lizard_security import sharding
+from lizard_security import snapshot
+from lizard_security import strategies
+from lizard_security import transfer
+from lizard_security import warmup
 
 
 class DataSetTest(TestCase):
@@ -40,6 +88,624 @@ class DataSetTest(TestCase):
         self.assertTrue(unicode(data_set_from_django))
 
 
+class DataSetHierarchyTest(TestCase):
+
+    def setUp(self):
+        self.province = DataSet.objects.create(name='province')
+        self.water_board = DataSet.objects.create(name='water board',
+                                                  parent=self.province)
+        self.polder = DataSet.objects.create(name='polder',
+                                             parent=self.water_board)
+
+    def descendant_ids(self, data_set):
+        return set(DataSetAncestor.objects.filter(
+                ancestor=data_set).values_list('descendant', flat=True))
+
+    def test_closure(self):
+        self.assertSetEqual(
+            set([self.province.id, self.water_board.id, self.polder.id]),
+            self.descendant_ids(self.province))
+        self.assertSetEqual(set([self.polder.id]),
+                            self.descendant_ids(self.polder))
+        self.assertEquals(
+            DataSetAncestor.objects.get(ancestor=self.province,
+                                        descendant=self.polder).depth,
+            2)
+
+    def test_move_subtree(self):
+        other_province = DataSet.objects.create(name='other province')
+        self.water_board.parent = other_province
+        self.water_board.save()
+        self.assertSetEqual(set([self.province.id]),
+                            self.descendant_ids(self.province))
+        self.assertIn(self.polder.id, self.descendant_ids(other_province))
+
+    def test_no_cycles(self):
+        self.province.parent = self.polder
+        self.assertRaises(ValueError, self.province.save)
+        self.assertRaises(ValidationError, self.province.clean)
+
+    def test_delete_detaches_children(self):
+        self.water_board.delete()
+        polder = DataSet.objects.get(pk=self.polder.pk)
+        self.assertEquals(polder.parent, None)
+        self.assertSetEqual(set([self.province.id]),
+                            self.descendant_ids(self.province))
+
+    def test_access_to_descendants(self):
+        user = User.objects.create(username='user')
+        user_group = UserGroup.objects.create(name='user_group')
+        user_group.members.add(user)
+        PermissionMapper.objects.create(user_group=user_group,
+                                        data_set=self.water_board)
+        request = RequestFactory().get('/some/url')
+        request.user = user
+        SecurityMiddleware().process_request(request)
+        self.assertSetEqual(set([self.water_board.id, self.polder.id]),
+                            request.allowed_data_set_ids)
+        content = Content.objects.create(data_set=self.polder)
+        backend = LizardPermissionBackend()
+        with patch('lizard_security.backends.request') as tls_request:
+            tls_request.user_group_ids = [user_group.id]
+            self.assertTrue(backend.has_perm(
+                    user, 'lizard_security.can_view_lizard_data', content))
+
+    def test_filter_expands_parents(self):
+        Content.objects.create(name='polder content', data_set=self.polder)
+        Content.objects.create(name='other content',
+                               data_set=DataSet.objects.create(name='other'))
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set([self.province.id])
+            self.assertListEqual(
+                ['polder content'],
+                [content.name for content in Content.objects.all()])
+
+
+class MultipleDataSetsTest(TestCase):
+
+    def setUp(self):
+        self.noord = DataSet.objects.create(name='Noord')
+        self.polder = DataSet.objects.create(name='polder', parent=self.noord)
+        self.zuid = DataSet.objects.create(name='Zuid')
+        self.public = SharedContent.objects.create(name='public')
+        self.base_layer = SharedContent.objects.create(name='base layer')
+        self.base_layer.data_sets.add(self.polder, self.zuid)
+        self.zuid_only = SharedContent.objects.create(name='zuid only')
+        self.zuid_only.data_sets.add(self.zuid)
+
+    def visible(self, data_set_ids):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set(data_set_ids)
+            return sorted([content.name
+                           for content in SharedContent.objects.all()])
+
+    def test_filtering(self):
+        self.assertListEqual(['base layer', 'public'],
+                             self.visible([self.noord.id]))
+        self.assertListEqual(['base layer', 'public', 'zuid only'],
+                             self.visible([self.zuid.id]))
+        self.assertListEqual(['public'], self.visible([]))
+
+    def test_no_duplicates(self):
+        self.assertEquals(
+            2, len(self.visible([self.polder.id, self.zuid.id])) - 1)
+
+    def test_has_perm(self):
+        user_group = UserGroup.objects.create(name='editors')
+        group = Group.objects.create(name='editors')
+        group.permissions.add(
+            Permission.objects.get(codename='change_sharedcontent'))
+        PermissionMapper.objects.create(user_group=user_group,
+                                        data_set=self.noord,
+                                        permission_group=group)
+        backend = LizardPermissionBackend()
+        perm = 'testcontent.change_sharedcontent'
+        with patch('lizard_security.backends.request') as request:
+            request.user_group_ids = [user_group.id]
+            self.assertTrue(backend.has_perm(None, perm, self.base_layer))
+            self.assertFalse(backend.has_perm(None, perm, self.zuid_only))
+            self.assertFalse(backend.has_perm(None, perm, self.public))
+
+    def test_database_policies(self):
+        postgresql = Mock()
+        postgresql.vendor = 'postgresql'
+        postgresql.ops.quote_name = lambda name: '"%s"' % name
+        statements = dbpolicies.create_statements(postgresql,
+                                                  [SharedContent])
+        self.assertIn('NOT EXISTS (SELECT 1 FROM '
+                      '"testcontent_sharedcontent_data_sets" link',
+                      statements[-1])
+
+
+class PublicDataSetTest(TestCase):
+
+    def setUp(self):
+        self.public = DataSet.objects.create(name='public', is_public=True)
+        self.child = DataSet.objects.create(name='child', parent=self.public)
+        self.secret = DataSet.objects.create(name='secret')
+        self.no_data_set = Content.objects.create(name='no data set')
+        self.in_public = Content.objects.create(name='in public',
+                                                data_set=self.child)
+        Content.objects.create(name='in secret', data_set=self.secret)
+
+    def visible(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        SecurityMiddleware().process_request(request)
+        with patch('lizard_security.manager.request', request):
+            return sorted([content.name for content in Content.objects.all()])
+
+    def test_middleware(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        SecurityMiddleware().process_request(request)
+        self.assertSetEqual(set([self.public.id, self.child.id]),
+                            request.allowed_data_set_ids)
+
+    def test_filtering(self):
+        self.assertListEqual(['in public', 'no data set'], self.visible())
+        with self.settings(LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+            self.assertListEqual(['in public'], self.visible())
+
+    def test_index_friendly_filter(self):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set([self.public.id])
+            with self.settings(LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+                sql = str(Content.objects.all().query)
+        self.assertNotIn('IS NULL', sql)
+
+    def test_nothing_allowed(self):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set()
+            with self.settings(LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+                self.assertEquals(0, Content.objects.count())
+                self.assertEquals(0, SharedContent.objects.count())
+
+    def test_assign_public_data_set(self):
+        unlinked = SharedContent.objects.create(name='unlinked')
+        linked = SharedContent.objects.create(name='linked')
+        linked.data_sets.add(self.secret)
+        with patch.object(bulk, 'ASSIGN_CHUNK_SIZE', 1):
+            result = bulk.assign_public_data_set(
+                self.secret, models=[Content, SharedContent])
+        self.assertDictEqual({'testcontent.content': 1,
+                              'testcontent.sharedcontent': 1}, result)
+        self.assertTrue(DataSet.objects.get(pk=self.secret.pk).is_public)
+        with patch('lizard_security.manager.request'):
+            # Unfiltered, as a (mock) superuser.
+            self.assertEquals(
+                self.secret.id,
+                Content.objects.get(pk=self.no_data_set.pk).data_set_id)
+        self.assertListEqual([self.secret.id],
+                             [data_set.id
+                              for data_set in unlinked.data_sets.all()])
+        self.assertEquals(1, linked.data_sets.count())
+
+    def test_database_policies(self):
+        postgresql = Mock()
+        postgresql.vendor = 'postgresql'
+        postgresql.ops.quote_name = lambda name: '"%s"' % name
+        with self.settings(LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+            statements = dbpolicies.create_statements(
+                postgresql, [Content, SharedContent])
+        self.assertNotIn('IS NULL', statements[3])
+        self.assertNotIn('NOT EXISTS', statements[-1])
+
+
+class FilterStrategyTest(TestCase):
+
+    def setUp(self):
+        self.noord = DataSet.objects.create(name='Noord')
+        self.polder = DataSet.objects.create(name='polder', parent=self.noord)
+        self.zuid = DataSet.objects.create(name='Zuid')
+        Content.objects.create(name='no data set')
+        Content.objects.create(name='noord', data_set=self.noord)
+        Content.objects.create(name='polder', data_set=self.polder)
+        Content.objects.create(name='zuid', data_set=self.zuid)
+
+    def visible(self, data_set_ids):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set(data_set_ids)
+            return sorted([content.name for content in Content.objects.all()])
+
+    def test_same_results(self):
+        for name in sorted(strategies.STRATEGIES):
+            with self.settings(LIZARD_SECURITY_FILTER_STRATEGY=name):
+                self.assertListEqual(['no data set', 'noord', 'polder'],
+                                     self.visible([self.noord.id]), name)
+                self.assertListEqual(['no data set'], self.visible([]), name)
+                with self.settings(
+                    LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+                    self.assertListEqual(
+                        ['polder', 'zuid'],
+                        self.visible([self.polder.id, self.zuid.id]), name)
+
+    def test_access_table_after_rollback(self):
+        strategy = strategies.STRATEGIES['join']
+        outside_transaction = patch.object(strategies, '_in_transaction',
+                                           lambda connection: False)
+        # The tables are gone with the test's transaction.
+        self.addCleanup(delattr, connection, '_lizard_security_access')
+        with outside_transaction:
+            strategy.materialize(connection, [self.zuid.id])
+        # The test itself runs in a transaction.
+        savepoint = transaction.savepoint()
+        strategy.materialize(connection, [self.noord.id])
+        transaction.savepoint_rollback(savepoint)
+        with outside_transaction:
+            table = strategy.materialize(connection, [self.noord.id])
+        cursor = connection.cursor()
+        cursor.execute('SELECT data_set_id FROM %s' % table)
+        self.assertSetEqual(set([self.noord.id, self.polder.id]),
+                            set([row[0] for row in cursor.fetchall()]))
+        with outside_transaction:
+            with self.assertNumQueries(0):
+                strategy.materialize(connection, [self.noord.id])
+        self.assertNotEqual(
+            table, strategy.materialize(connection, [self.zuid.id]))
+
+    def test_access_table_when_evaluated(self):
+        with self.settings(LIZARD_SECURITY_FILTER_STRATEGY='join',
+                           LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+            with patch('lizard_security.manager.request') as request:
+                request.user = None
+                # The data sets' descendants are cached.
+                self.visible([self.noord.id])
+                self.visible([self.zuid.id])
+                with self.assertNumQueries(0):
+                    request.allowed_data_set_ids = set([self.noord.id])
+                    noord = Content.objects.all()
+                    request.allowed_data_set_ids = set([self.zuid.id])
+                    zuid = Content.objects.all()
+            self.assertListEqual(['zuid'],
+                                 [content.name for content in zuid])
+            self.assertListEqual(['noord', 'polder'],
+                                 sorted([content.name for content in noord]))
+
+    def test_thresholds(self):
+        with self.settings(
+            LIZARD_SECURITY_FILTER_STRATEGY=[(2, 'in'), (None, 'join')],
+            LIZARD_SECURITY_MODEL_FILTER_STRATEGIES={
+                'testcontent.geocontent': 'exists'}):
+            self.assertEquals('in', strategies.choose(Content, 2).name)
+            self.assertEquals('join', strategies.choose(Content, 3).name)
+            self.assertEquals('exists',
+                              strategies.choose(GeoContent, 3).name)
+            self.assertEquals('subquery', strategies.choose(
+                    Content, 3, Mock(vendor='oracle')).name)
+
+    def test_calibrate(self):
+        # Pretend the shortest SQL is the cheapest.
+        with patch.object(strategies, 'explain_cost',
+                          lambda query_set: len(str(query_set.query))):
+            result = strategies.calibrate(models=[Content])
+        try:
+            thresholds = result['testcontent.content']
+            self.assertEquals(None, thresholds[-1][0])
+            self.assertEquals(thresholds[-1][1],
+                              strategies.choose(Content, 3).name)
+        finally:
+            strategies._calibrated.clear()
+
+    def test_explain_cost(self):
+        # SQLite has no cost estimates.
+        self.assertEquals(None, strategies.explain_cost(
+                Content.objects.all()))
+
+
+class SecuredJoinTest(TestCase):
+
+    def setUp(self):
+        self.noord = DataSet.objects.create(name='Noord')
+        self.zuid = DataSet.objects.create(name='Zuid')
+        referring = testmodels.ContentWithForeignKeyToContentWithDataset
+        for (name, data_set) in (('open', None),
+                                 ('noord', self.noord),
+                                 ('zuid', self.zuid)):
+            content = Content.objects.create(name=name, data_set=data_set)
+            referring.objects.create(name='to ' + name, content=content)
+        referring.objects.create(name='to nothing')
+        self.shared = SharedContent.objects.create(name='shared')
+        self.shared.data_sets.add(self.zuid)
+
+    def names(self, query_set, data_set_ids=None):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set(data_set_ids or [])
+            return sorted([str(item.name) for item in query_set.all()])
+
+    def test_filter_through_join(self):
+        query_set = (testmodels.ContentWithForeignKeyToContentWithDataset
+                     .objects.filter(content__name__in=['open', 'zuid']))
+        self.assertListEqual(['to open'], self.names(query_set))
+        self.assertListEqual(['to open', 'to zuid'],
+                             self.names(query_set, [self.zuid.id]))
+
+    def test_outer_join(self):
+        query_set = (testmodels.ContentWithForeignKeyToContentWithDataset
+                     .objects.order_by('content__name'))
+        self.assertListEqual(['to noord', 'to nothing', 'to open'],
+                             self.names(query_set, [self.noord.id]))
+
+    def test_many_to_many(self):
+        query_set = geo_manager.secure_joins(
+            DataSet.objects.filter(sharedcontent__name='shared'))
+        self.assertListEqual([], self.names(query_set, [self.noord.id]))
+        self.assertListEqual(['Zuid'], self.names(query_set, [self.zuid.id]))
+
+    def test_update(self):
+        referring = testmodels.ContentWithForeignKeyToContentWithDataset
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set()
+            self.assertEquals(1, referring.objects.filter(
+                    content__name__in=['open', 'zuid']).update(
+                    name='updated'))
+        self.assertListEqual(
+            ['to noord', 'to nothing', 'to zuid', 'updated'],
+            sorted(referring.objects.values_list('name', flat=True)))
+
+    def test_date_query_class(self):
+        referring = testmodels.ContentWithForeignKeyToContentWithDataset
+        query = referring.objects.all().query.clone(DateQuery)
+        self.assertTrue(isinstance(query, geo_manager.SecuredJoinsMixin))
+        self.assertTrue(isinstance(query, DateQuery))
+
+    def test_one_query(self):
+        query_set = (testmodels.ContentWithForeignKeyToContentWithDataset
+                     .objects.filter(content__name='zuid'))
+        with self.assertNumQueries(1):
+            self.names(query_set)
+
+    def test_superuser(self):
+        query_set = (testmodels.ContentWithForeignKeyToContentWithDataset
+                     .objects.filter(content__name='zuid'))
+        with patch('lizard_security.manager.request'):
+            # Mock users are superusers.
+            self.assertEquals(1, query_set.count())
+
+
+class LoadTestTest(TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(50, loadtest.percentile(values, 50))
+        self.assertEquals(99, loadtest.percentile(values, 99))
+        self.assertEquals(None, loadtest.percentile([], 50))
+
+    def test_run(self):
+        usernames = loadtest.make_fixtures(users=2, data_sets=3, contents=6)
+        self.assertEquals(2, len(loadtest.fixture_usernames()))
+        results = loadtest.run(levels=(1, ), usernames=usernames, requests=4)
+        self.assertEquals(1, len(results))
+        self.assertEquals(4, results[0].requests)
+        self.assertEquals(0, results[0].errors)
+        self.assertTrue(results[0].mean_queries > 0)
+        self.assertIn('concurrency', loadtest.report(results))
+        loadtest.remove_fixtures()
+        self.assertFalse(DataSet.objects.filter(
+                name__startswith=loadtest.PREFIX).exists())
+
+
+class ShardingTest(TestCase):
+
+    def setUp(self):
+        self.tenant = DataSet.objects.create(name='tenant')
+        self.polder = DataSet.objects.create(name='polder',
+                                             parent=self.tenant)
+        self.other = DataSet.objects.create(name='other')
+        self.shards = {'tenant': [self.tenant.id]}
+        for (name, data_set) in (('b', self.other), ('a', self.other),
+                                 ('c', None), ('d', self.polder)):
+            Content.objects.create(name=name, data_set=data_set)
+
+    def test_shard_map(self):
+        with self.settings(LIZARD_SECURITY_SHARDS=self.shards):
+            self.assertEquals('tenant',
+                              sharding.shard_for_data_set(self.polder.id))
+            self.assertEquals('default',
+                              sharding.shard_for_data_set(self.other.id))
+            self.assertSetEqual(
+                set(['tenant', 'default']),
+                sharding.shards_for_data_sets([self.polder.id]))
+            with self.settings(LIZARD_SECURITY_NULL_DATA_SET_IS_PUBLIC=False):
+                self.assertSetEqual(
+                    set(['tenant']),
+                    sharding.shards_for_data_sets([self.polder.id]))
+
+    def test_router(self):
+        router = sharding.DataSetRouter()
+        with self.settings(LIZARD_SECURITY_SHARDS=self.shards):
+            self.assertEquals('tenant', router.db_for_write(
+                    Content, instance=Content(data_set=self.polder)))
+            self.assertEquals('default', router.db_for_read(DataSet))
+            self.assertFalse(router.allow_syncdb('tenant', DataSet))
+            self.assertTrue(router.allow_relation(Content(), self.tenant))
+
+    def test_sharded_query_set(self):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set([self.other.id])
+            sharded = Content.objects.sharded()
+            self.assertListEqual(['default'], sharded.shards())
+            self.assertListEqual(
+                ['a', 'b', 'c'],
+                [content.name for content in sharded.order_by('name')])
+            self.assertListEqual(
+                ['b', 'a'],
+                [content.name for content in sharded.filter(
+                        data_set=self.other).order_by('-name')[:2]])
+            self.assertEquals(3, sharded.count())
+            self.assertEquals('c', sharded.order_by('name')[2].name)
+            self.assertRaises(AssertionError, sharded[:1].filter, name='a')
+
+    def test_database_filtering_in_threads(self):
+        # The shards are queried from other threads, with connections of
+        # their own.
+        dbpolicies.set_access(connection, [self.other.id])
+        try:
+            with patch('lizard_security.manager.request') as request:
+                request.user = None
+                request.allowed_data_set_ids = set([self.other.id])
+                request.database_filtered = True
+                with self.settings(LIZARD_SECURITY_SKIP_QUERY_FILTER=True):
+                    sharded = Content.objects.sharded()
+                    sharded.shards = lambda: ['default', 'default']
+                    with patch.object(dbpolicies, 'set_access') as set_access:
+                        sharded._evaluate(lambda query_set: None)
+        finally:
+            dbpolicies.reset_access(connection)
+        restricted = [args for (args, kwargs) in set_access.call_args_list
+                      if args[1] == [self.other.id]]
+        self.assertEquals(2, len(restricted))
+
+    def test_join_strategy_in_threads(self):
+        threads = set()
+
+        def materialize(strategy, connection, data_set_ids):
+            threads.add(threading.current_thread())
+            return strategy.table(data_set_ids)
+
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set([self.other.id])
+            with self.settings(LIZARD_SECURITY_FILTER_STRATEGY='join'):
+                sharded = Content.objects.sharded()
+                sharded.shards = lambda: ['default', 'default']
+                with patch.object(strategies.AccessTableStrategy,
+                                  'materialize', materialize):
+                    sharded._evaluate(lambda query_set: str(query_set.query))
+        # Those of both workers, that compile the queries.
+        self.assertEquals(2, len(threads))
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_literal_filter_on_shards(self):
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set([self.tenant.id])
+            with self.settings(LIZARD_SECURITY_SHARDS=self.shards):
+                sql = str(Content.objects.db_manager('tenant').all().query)
+                self.assertNotIn('datasetancestor', sql)
+                self.assertIn(str(self.polder.id), sql)
+                # Not for the default database, also when the closure table
+                # is read from a replica.
+                with patch('django.db.router.db_for_read',
+                           lambda model, **hints: model is DataSetAncestor
+                           and 'replica' or 'default'):
+                    sql = str(Content.objects.all().query)
+                self.assertIn('datasetancestor', sql)
+
+
+class ReplicaTest(TestCase):
+
+    def setUp(self):
+        self.router = replicas.ReplicaRouter()
+        epoch._cache().delete(replicas.WRITTEN_KEY)
+        replicas.finish_request(None)
+
+    def tearDown(self):
+        replicas.finish_request(None)
+
+    def test_routing(self):
+        self.assertEquals(None, self.router.db_for_read(UserGroup))
+        with self.settings(LIZARD_SECURITY_REPLICA='replica'):
+            self.assertEquals('replica', self.router.db_for_read(UserGroup))
+            self.assertEquals('replica', self.router.db_for_read(Permission))
+            self.assertEquals(None, self.router.db_for_read(Content))
+            self.assertEquals('default', self.router.db_for_write(DataSet))
+            self.assertFalse(self.router.allow_syncdb('replica', DataSet))
+            with replicas.primary():
+                self.assertEquals('default',
+                                  self.router.db_for_read(UserGroup))
+            self.assertEquals('replica', self.router.db_for_read(UserGroup))
+
+    def test_closure_from_primary(self):
+        parent = UserGroup.objects.create(name='parent')
+        child = UserGroup.objects.create(name='child')
+        grandchild = UserGroup.objects.create(name='grandchild')
+        noord = DataSet.objects.create(name='Noord')
+        # There is no replica database: reading from it fails.
+        with patch('django.db.router.db_for_read',
+                   lambda model, **hints: 'replica'):
+            parent.member_groups.add(child)
+            child.member_groups.add(grandchild)
+            child.member_groups.remove(grandchild)
+            polder = DataSet.objects.create(name='polder', parent=noord)
+        self.assertTrue(UserGroupAncestor.objects.filter(
+                ancestor=parent, descendant=child).exists())
+        self.assertFalse(UserGroupAncestor.objects.filter(
+                ancestor=parent, descendant=grandchild).exists())
+        self.assertTrue(DataSetAncestor.objects.filter(
+                ancestor=noord, descendant=polder, depth=1).exists())
+
+    def test_bulk_reads_from_primary(self):
+        User.objects.create(username='jan')
+        bulk.sync_memberships({'editors': {'members': ['jan']}})
+        replicas.finish_request(None)
+        # There is no replica database: reading from it fails.
+        with self.settings(LIZARD_SECURITY_REPLICA='replica'):
+            with patch('django.db.router.db_for_read',
+                       lambda model, **hints:
+                       self.router.db_for_read(model) or 'default'):
+                result = bulk.sync_memberships(
+                    {'editors': {'members': ['jan']}})
+                self.assertEquals((0, 0), (result.added, result.removed))
+                output = StringIO()
+                transfer.export(output)
+                replicas.finish_request(None)
+                importer = transfer.import_records(
+                    transfer.read(StringIO(output.getvalue())))
+                self.assertEquals(0, sum(importer.created.values()))
+                self.assertTrue(replicas.use_primary())
+
+    def test_writes_pin_to_primary(self):
+        with self.settings(LIZARD_SECURITY_REPLICA='replica'):
+            self.assertFalse(replicas.start_request({}))
+            DataSet.objects.create(name='new')
+            self.assertEquals('default', self.router.db_for_read(DataSet))
+            session = {}
+            replicas.finish_request(session)
+            self.assertTrue(session[replicas.SESSION_KEY].startswith('time:'))
+            # Everybody reads from the primary for a while.
+            self.assertTrue(replicas.start_request({}))
+
+    def test_consistency_token(self):
+        with self.settings(LIZARD_SECURITY_REPLICA='replica',
+                           LIZARD_SECURITY_REPLICA_LAG=10):
+            session = {replicas.SESSION_KEY: 'time:%r' % time.time()}
+            self.assertTrue(replicas.start_request(session))
+            self.assertIn(replicas.SESSION_KEY, session)
+            session = {replicas.SESSION_KEY: 'time:%r' % (time.time() - 20)}
+            self.assertFalse(replicas.start_request(session))
+            self.assertNotIn(replicas.SESSION_KEY, session)
+
+    def test_lsn(self):
+        self.assertEquals(0x100000010, replicas._lsn('1/10'))
+        self.assertTrue(replicas._lsn('1/0') > replicas._lsn('0/FFFFFFFF'))
+
+    def test_middleware(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        middleware = ReplicaConsistencyMiddleware()
+        with self.settings(LIZARD_SECURITY_REPLICA='replica'):
+            middleware.process_request(request)
+            UserGroup.objects.create(name='new')
+            middleware.process_response(request, None)
+            self.assertIn(replicas.SESSION_KEY, request.session)
+            self.assertFalse(replicas.use_primary())
+
+    def test_in_parallel(self):
+        self.assertListEqual([2, 4, 6],
+                             sharding._in_parallel(lambda x: 2 * x, [1, 2, 3]))
+        self.assertRaises(ZeroDivisionError, sharding._in_parallel,
+                          lambda x: 1 / x, [1, 0])
+
+
 class UserGroupTest(TestCase):
 
     def setUp(self):
@@ -117,6 +783,59 @@ class UserGroupTest(TestCase):
                              [self.user1, self.admin1])
 
 
+class NestedUserGroupTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.everyone = UserGroup.objects.create(name='everyone')
+        self.employees = UserGroup.objects.create(name='employees')
+        self.engineers = UserGroup.objects.create(name='engineers')
+        self.everyone.member_groups.add(self.employees)
+        self.employees.member_groups.add(self.engineers)
+        self.engineers.members.add(self.user)
+        self.request = RequestFactory().get('/some/url')
+        self.request.user = self.user
+
+    def effective_ids(self):
+        return set(SecurityMiddleware()._user_group_ids(self.request))
+
+    def test_transitive_membership(self):
+        self.assertSetEqual(
+            set([self.everyone.id, self.employees.id, self.engineers.id]),
+            self.effective_ids())
+
+    def test_multiple_paths(self):
+        # A second path from "everyone" to "engineers" keeps the link alive
+        # when the first one is removed.
+        self.everyone.member_groups.add(self.engineers)
+        self.assertEquals(
+            UserGroupAncestor.objects.get(ancestor=self.everyone,
+                                          descendant=self.engineers
+                                          ).path_count,
+            2)
+        self.employees.member_groups.remove(self.engineers)
+        self.assertSetEqual(set([self.everyone.id, self.engineers.id]),
+                            self.effective_ids())
+
+    def test_remove_through_reverse_relation(self):
+        self.engineers.parent_groups.clear()
+        self.assertSetEqual(set([self.engineers.id]), self.effective_ids())
+
+    def test_remove_unlinked_group(self):
+        self.everyone.member_groups.remove(self.engineers)
+        self.assertEquals(len(self.effective_ids()), 3)
+
+    def test_delete_nested_group(self):
+        self.employees.delete()
+        self.assertSetEqual(set([self.engineers.id]), self.effective_ids())
+
+    def test_no_cycles(self):
+        self.assertRaises(ValueError,
+                          self.engineers.member_groups.add, self.everyone)
+        self.assertRaises(ValueError,
+                          self.engineers.member_groups.add, self.engineers)
+
+
 class PermissionMapperTest(TestCase):
 
     def test_smoke(self):
@@ -140,6 +859,52 @@ class PermissionMapperTest(TestCase):
                              [permission_mapper])
 
 
+class TimeBoundPermissionMapperTest(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.hour = datetime.timedelta(hours=1)
+        self.user = User.objects.create(username='contractor')
+        self.user_group = UserGroup.objects.create(name='contractors')
+        self.user_group.members.add(self.user)
+        self.data_set = DataSet.objects.create(name='project')
+        self.permission_mapper = PermissionMapper.objects.create(
+            user_group=self.user_group, data_set=self.data_set)
+        self.request = RequestFactory().get('/some/url')
+        self.request.user = self.user
+
+    def allowed_data_set_ids(self):
+        SecurityMiddleware().process_request(self.request)
+        return self.request.allowed_data_set_ids
+
+    def test_unlimited(self):
+        self.assertSetEqual(set([self.data_set.id]),
+                            self.allowed_data_set_ids())
+        self.assertEquals(None, next_validity_change([self.user_group.id]))
+
+    def test_expired(self):
+        self.permission_mapper.valid_until = self.now - self.hour
+        self.permission_mapper.save()
+        self.assertSetEqual(set(), self.allowed_data_set_ids())
+
+    def test_not_yet_valid(self):
+        self.permission_mapper.valid_from = self.now + self.hour
+        self.permission_mapper.save()
+        self.assertSetEqual(set(), self.allowed_data_set_ids())
+
+    def test_next_validity_change(self):
+        self.permission_mapper.valid_from = self.now - self.hour
+        self.permission_mapper.valid_until = self.now + 2 * self.hour
+        self.permission_mapper.save()
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        valid_from=self.now + self.hour)
+        self.assertSetEqual(set([self.data_set.id]),
+                            self.allowed_data_set_ids())
+        self.assertEquals(
+            self.now + self.hour,
+            next_validity_change([self.user_group.id], now=self.now))
+
+
 class AdminInterfaceTests(TestCase):
 
     def setUp(self):
@@ -218,6 +983,204 @@ class AdminInterfaceTests(TestCase):
         self.assertEquals(response.status_code, 200)
 
 
+class PermissionMatrixTest(TestCase):
+
+    def setUp(self):
+        self.group = Group.objects.create(name='editors')
+        self.group.permissions.add(
+            Permission.objects.get(codename='change_content'))
+        self.noord = DataSet.objects.create(name='Noord')
+        DataSet.objects.create(name='Noord-Oost', parent=self.noord)
+        self.editors = UserGroup.objects.create(name='editors')
+        self.interns = UserGroup.objects.create(name='interns')
+        self.editors.member_groups.add(self.interns)
+        PermissionMapper.objects.create(user_group=self.editors,
+                                        data_set=self.noord,
+                                        permission_group=self.group)
+
+    def test_effective_permissions(self):
+        self.assertListEqual(
+            [('editors', 'Noord', 'testcontent', 'change_content'),
+             ('editors', 'Noord-Oost', 'testcontent', 'change_content'),
+             ('interns', 'Noord', 'testcontent', 'change_content'),
+             ('interns', 'Noord-Oost', 'testcontent', 'change_content')],
+            list(effective_permissions()))
+
+    def test_filters(self):
+        self.assertListEqual(
+            [('interns', 'Noord-Oost', 'testcontent', 'change_content')],
+            list(effective_permissions(user_group='intern',
+                                       data_set='oost',
+                                       permission='change')))
+        self.assertListEqual(
+            [], list(effective_permissions(permission='delete')))
+
+    def test_view(self):
+        User.objects.create_superuser('adminadmin', 'a@a.nl', 'adminadmin')
+        client = Client()
+        self.assertTrue(client.login(username='adminadmin',
+                                     password='adminadmin'))
+        url = '/admin/lizard_security/permissionmapper/matrix/'
+        response = client.get(url, {'user_group': 'interns'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(2, response.context['page'].paginator.count)
+        response = client.get(url, {'user_group': 'interns',
+                                    'format': 'csv'})
+        self.assertEquals(
+            'interns,Noord,testcontent,change_content\r\n'
+            'interns,Noord-Oost,testcontent,change_content\r\n',
+            ''.join(response.streaming_content))
+
+
+class ObjectPermissionAdminTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='editor', is_staff=True)
+        self.user_group = UserGroup.objects.create(name='editors')
+        self.noord = DataSet.objects.create(name='Noord')
+        self.zuid = DataSet.objects.create(name='Zuid')
+        group = Group.objects.create(name='editors')
+        group.permissions.add(
+            Permission.objects.get(codename='change_content'))
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        data_set=self.noord,
+                                        permission_group=group)
+        # Implicit view permission only.
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        data_set=self.zuid)
+        self.request = RequestFactory().get('/admin/')
+        self.request.user = self.user
+        self.request.user_group_ids = frozenset([self.user_group.id])
+        self.model_admin = SecurityFilteredAdmin(Content, AdminSite())
+
+    def test_object_permissions(self):
+        content_noord = Content.objects.create(data_set=self.noord)
+        content_zuid = Content.objects.create(data_set=self.zuid)
+        with patch('lizard_security.admin.tls_request', self.request):
+            self.assertTrue(self.model_admin.has_change_permission(
+                    self.request))
+        self.assertTrue(self.model_admin.has_change_permission(
+                self.request, content_noord))
+        # The permissions per data set are looked up only once.
+        with self.assertNumQueries(0):
+            self.assertFalse(self.model_admin.has_change_permission(
+                    self.request, content_zuid))
+            self.assertFalse(self.model_admin.has_delete_permission(
+                    self.request, content_noord))
+        self.assertFalse(self.model_admin.has_change_permission(
+                self.request, Content.objects.create()))
+
+    def test_actionable_only(self):
+        content_noord = Content.objects.create(data_set=self.noord)
+        Content.objects.create(data_set=self.zuid)
+        Content.objects.create()
+        self.model_admin.actionable_only = True
+        self.assertListEqual(
+            [content_noord],
+            list(self.model_admin.queryset(self.request)))
+
+    def test_bulk_delete(self):
+        Content.objects.create(data_set=self.noord)
+        self.request.user_group_ids = frozenset()
+        with patch('django.contrib.admin.actions.delete_selected') as action:
+            action.short_description = 'Delete'
+            checked = self.model_admin._checked_delete_action(action)
+            self.assertRaises(PermissionDenied, checked, self.model_admin,
+                              self.request, Content.objects.all())
+            self.assertFalse(action.called)
+
+    def test_several_data_sets(self):
+        group = Group.objects.get(name='editors')
+        group.permissions.add(
+            Permission.objects.get(codename='change_sharedcontent'),
+            Permission.objects.get(codename='delete_sharedcontent'))
+        both = SharedContent.objects.create(name='both')
+        both.data_sets.add(self.noord, self.zuid)
+        SharedContent.objects.create(name='zuid').data_sets.add(self.zuid)
+        SharedContent.objects.create(name='none')
+        model_admin = SecurityFilteredAdmin(SharedContent, AdminSite())
+        model_admin.actionable_only = True
+        self.assertListEqual([both], list(model_admin.queryset(self.request)))
+        with patch('django.contrib.admin.actions.delete_selected') as action:
+            action.short_description = 'Delete'
+            checked = model_admin._checked_delete_action(action)
+            self.assertRaises(PermissionDenied, checked, model_admin,
+                              self.request, SharedContent.objects.all())
+            self.assertFalse(action.called)
+            checked(model_admin, self.request,
+                    SharedContent.objects.filter(name='both'))
+            self.assertTrue(action.called)
+
+
+class AuthorizeViewTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_user('editor', 'e@e.nl', 'editor')
+        self.user_group = UserGroup.objects.create(name='editors')
+        self.user_group.members.add(User.objects.get(username='editor'))
+        self.noord = DataSet.objects.create(name='Noord')
+        self.zuid = DataSet.objects.create(name='Zuid')
+        group = Group.objects.create(name='editors')
+        group.permissions.add(
+            Permission.objects.get(codename='change_content'))
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        data_set=self.noord,
+                                        permission_group=group)
+        self.content = Content.objects.create(data_set=self.noord)
+        self.client = Client()
+        self.client.login(username='editor', password='editor')
+
+    def authorize(self, checks, **extra):
+        return self.client.post('/security/authorize/',
+                                json.dumps({'checks': checks}),
+                                content_type='application/json', **extra)
+
+    def test_checks(self):
+        response = self.authorize(
+            [{'model': 'testcontent.Content', 'id': self.content.id,
+              'perm': 'testcontent.change_content'},
+             {'model': 'testcontent.Content', 'id': self.content.id + 1},
+             {'data_set': self.noord.id},
+             {'data_set': self.zuid.id},
+             {'data_set': None},
+             {'data_set': self.noord.id,
+              'perm': 'testcontent.delete_content'}])
+        self.assertEquals(response.status_code, 200)
+        self.assertListEqual([True, False, True, False, True, False],
+                             json.loads(response.content)['results'])
+        self.assertEquals(str(epoch.current()),
+                          response['X-Lizard-Security-Epoch'])
+
+    def test_several_data_sets(self):
+        shared = SharedContent.objects.create(name='shared')
+        shared.data_sets.add(self.noord, self.zuid)
+        response = self.authorize(
+            [{'model': 'testcontent.SharedContent', 'id': shared.id},
+             {'model': 'testcontent.SharedContent', 'id': shared.id,
+              'perm': 'testcontent.change_sharedcontent'}])
+        self.assertEquals(response.status_code, 200)
+        self.assertListEqual([True, False],
+                             json.loads(response.content)['results'])
+
+    def test_etag(self):
+        checks = [{'data_set': self.noord.id}]
+        etag = self.authorize(checks)['ETag']
+        response = self.authorize(checks, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+    def test_invalid(self):
+        self.assertEquals(
+            400, self.authorize([{'model': 'auth.user', 'id': 1}]).status_code)
+        self.assertEquals(
+            405, self.client.get('/security/authorize/').status_code)
+
+    def test_too_many_checks(self):
+        checks = [{'data_set': self.noord.id}] * 3
+        with self.settings(LIZARD_SECURITY_AUTHORIZE_MAX_CHECKS=2):
+            self.assertEquals(400, self.authorize(checks).status_code)
+            self.assertEquals(200, self.authorize(checks[:2]).status_code)
+
+
 class PermissionBackendTest(TestCase):
 
     def setUp(self):
@@ -425,6 +1388,676 @@ class MiddlewareTest(TestCase):
                             self.request.allowed_data_set_ids)
 
 
+class PrefixTreeTest(TestCase):
+
+    def setUp(self):
+        self.tree = PrefixTree()
+        self.tree.add('10.0.0.0/8', 'intranet')
+        self.tree.add('10.1.0.0/16', 'office')
+        self.tree.add('192.168.1.5', 'printer')
+        self.tree.add('2001:db8::/32', 'ipv6')
+
+    def test_nested_ranges(self):
+        self.assertSetEqual(set(['intranet', 'office']),
+                            self.tree.lookup('10.1.2.3'))
+        self.assertSetEqual(set(['intranet']), self.tree.lookup('10.2.2.3'))
+
+    def test_single_address(self):
+        self.assertSetEqual(set(['printer']), self.tree.lookup('192.168.1.5'))
+        self.assertSetEqual(set(), self.tree.lookup('192.168.1.6'))
+
+    def test_ipv6(self):
+        self.assertSetEqual(set(['ipv6']), self.tree.lookup('2001:db8::1'))
+        self.assertSetEqual(set(['office', 'intranet']),
+                            self.tree.lookup('::ffff:10.1.0.1'))
+
+    def test_invalid(self):
+        self.assertSetEqual(set(), self.tree.lookup('not.an.address'))
+        self.assertRaises(ValueError, self.tree.add, '10.0.0.0/33', 'x')
+
+
+class IPRangeMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.middleware = IPRangeMiddleware()
+        self.everyone = UserGroup.objects.create(name='everyone')
+        self.office = UserGroup.objects.create(name='office')
+        self.everyone.member_groups.add(self.office)
+        IPRange.objects.create(network='10.1.0.0/16', user_group=self.office)
+
+    def user_group_ids(self, address):
+        request = RequestFactory().get('/some/url', REMOTE_ADDR=address)
+        request.user_group_ids = set([42])
+        self.middleware.process_request(request)
+        return request.user_group_ids
+
+    def test_match(self):
+        self.assertSetEqual(set([42, self.everyone.id, self.office.id]),
+                            self.user_group_ids('10.1.2.3'))
+
+    def test_no_match(self):
+        self.assertSetEqual(set([42]), self.user_group_ids('10.2.2.3'))
+
+    def test_forwarded_for(self):
+        request = RequestFactory().get(
+            '/some/url', HTTP_X_FORWARDED_FOR='10.1.2.3, 10.2.2.3')
+        with self.settings(LIZARD_SECURITY_IP_HEADER='HTTP_X_FORWARDED_FOR'):
+            # The client set the first address itself.
+            self.middleware.process_request(request)
+            self.assertSetEqual(set(), request.user_group_ids)
+            request.META['HTTP_X_FORWARDED_FOR'] = '10.2.2.3, 10.1.2.3'
+            self.middleware.process_request(request)
+            self.assertIn(self.office.id, request.user_group_ids)
+            request.user_group_ids = set()
+            request.META['HTTP_X_FORWARDED_FOR'] = (
+                '10.2.2.3,10.1.2.3 , 192.168.1.1')
+            with self.settings(LIZARD_SECURITY_TRUSTED_PROXIES=2):
+                self.middleware.process_request(request)
+            self.assertIn(self.office.id, request.user_group_ids)
+
+    def test_rebuild_on_change(self):
+        self.user_group_ids('10.2.2.3')
+        IPRange.objects.create(network='10.2.0.0/16', user_group=self.office)
+        self.assertIn(self.office.id, self.user_group_ids('10.2.2.3'))
+
+    def test_validation(self):
+        self.assertRaises(ValidationError,
+                          IPRange(network='10.0.0.0/99').clean)
+
+
+class TokenMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.middleware = TokenMiddleware()
+        self.user_group = UserGroup.objects.create(name='tile servers')
+        self.data_set = DataSet.objects.create(name='tiles')
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        data_set=self.data_set)
+        self.token = APIToken.objects.create(name='tile server')
+        self.token.user_groups.add(self.user_group)
+
+    def process(self, key):
+        request = RequestFactory().get(
+            '/some/url', HTTP_AUTHORIZATION='Token %s' % key)
+        request.user = AnonymousUser()
+        response = self.middleware.process_request(request)
+        return request, response
+
+    def test_generated_key(self):
+        self.assertEquals(len(self.token.key), 40)
+
+    def test_no_token(self):
+        request = RequestFactory().get('/some/url')
+        self.assertEquals(None, self.middleware.process_request(request))
+        self.assertFalse(hasattr(request, 'user_group_ids'))
+
+    def test_invalid_token(self):
+        request, response = self.process('nonsense')
+        self.assertEquals(response.status_code, 403)
+        self.token.is_active = False
+        self.token.save()
+        request, response = self.process(self.token.key)
+        self.assertEquals(response.status_code, 403)
+
+    def test_access(self):
+        request, response = self.process(self.token.key)
+        self.assertEquals(None, response)
+        self.assertSetEqual(set([self.user_group.id]),
+                            request.user_group_ids)
+        self.assertSetEqual(set([self.data_set.id]),
+                            request.allowed_data_set_ids)
+
+    def test_public_data_sets(self):
+        public = DataSet.objects.create(name='base maps', is_public=True)
+        request, response = self.process(self.token.key)
+        self.assertSetEqual(set([self.data_set.id, public.id]),
+                            request.allowed_data_set_ids)
+
+    def test_cached_snapshot(self):
+        self.process(self.token.key)
+        with self.assertNumQueries(0):
+            request, response = self.process(self.token.key)
+        self.assertSetEqual(set([self.data_set.id]),
+                            request.allowed_data_set_ids)
+
+    def test_invalidation(self):
+        self.process(self.token.key)
+        other_data_set = DataSet.objects.create(name='other tiles')
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        data_set=other_data_set)
+        request, response = self.process(self.token.key)
+        self.assertSetEqual(set([self.data_set.id, other_data_set.id]),
+                            request.allowed_data_set_ids)
+
+    def test_user(self):
+        user = User.objects.create(username='script')
+        self.token.user = user
+        self.token.save()
+        request, response = self.process(self.token.key)
+        self.assertEquals(request.user, user)
+
+    def test_deactivated_user(self):
+        user = User.objects.create(username='script', is_superuser=True)
+        self.token.user = user
+        self.token.save()
+        self.process(self.token.key)
+        user.last_login = timezone.now()
+        user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            self.process(self.token.key)
+        user.is_superuser = False
+        user.save()
+        request, response = self.process(self.token.key)
+        self.assertFalse(request.user.is_superuser)
+        user.is_active = False
+        user.save()
+        request, response = self.process(self.token.key)
+        self.assertEquals(response.status_code, 403)
+
+
+class DatabasePoliciesTest(TestCase):
+
+    def test_secured_models(self):
+        self.assertIn(Content, geo_manager.secured_models())
+        self.assertNotIn(ContentWithoutDataset, geo_manager.secured_models())
+
+    def test_postgresql_policies(self):
+        postgresql = Mock()
+        postgresql.vendor = 'postgresql'
+        postgresql.ops.quote_name = lambda name: '"%s"' % name
+        statements = dbpolicies.create_statements(postgresql, [Content])
+        self.assertIn('ALTER TABLE "testcontent_content" '
+                      'ENABLE ROW LEVEL SECURITY', statements)
+        self.assertIn('"data_set_id" = ANY', statements[-1])
+        # Unset means no data sets, only '*' means unrestricted.
+        self.assertIn("= '*' OR", statements[-1])
+        self.assertIn("'{}')::integer[]", statements[-1])
+
+    def test_print_sql(self):
+        with patch('sys.stdout'):
+            call_command('create_security_policies', print_sql=True)
+
+    def test_sqlite_views(self):
+        if connection.vendor != 'sqlite':
+            return
+        data_set1 = DataSet.objects.create(name='data_set1')
+        data_set2 = DataSet.objects.create(name='data_set2')
+        Content.objects.create(name='public')
+        Content.objects.create(name='content1', data_set=data_set1)
+        Content.objects.create(name='content2', data_set=data_set2)
+        request = RequestFactory().get('/some/url')
+        request.user = AnonymousUser()
+        request.allowed_data_set_ids = set([data_set1.id])
+        middleware = DatabaseSecurityMiddleware()
+        middleware.process_request(request)
+        cursor = connection.cursor()
+        cursor.execute('SELECT name FROM secured_testcontent_content')
+        self.assertSetEqual(set(['public', 'content1']),
+                            set([row[0] for row in cursor.fetchall()]))
+        middleware.process_response(request, None)
+        # Denied by default, except for objects without a data set.
+        cursor.execute('SELECT name FROM secured_testcontent_content')
+        self.assertListEqual([('public', )], cursor.fetchall())
+        request.user = User(is_superuser=True)
+        middleware.process_request(request)
+        cursor.execute('SELECT name FROM secured_testcontent_content')
+        self.assertEquals(3, len(cursor.fetchall()))
+        middleware.process_response(request, None)
+        # The views are only created once per connection.
+        with patch.object(dbpolicies, 'create_statements') as statements:
+            middleware.process_request(request)
+            middleware.process_response(request, None)
+        self.assertFalse(statements.called)
+
+
+class ResultCacheTest(TestCase):
+
+    def setUp(self):
+        resultcache.results.clear()
+        self.data_set1 = DataSet.objects.create(name='data_set1')
+        self.data_set2 = DataSet.objects.create(name='data_set2')
+        Content.objects.create(name='content1', data_set=self.data_set1)
+        Content.objects.create(name='content2', data_set=self.data_set2)
+        self.patcher1 = patch('lizard_security.manager.request')
+        self.patcher2 = patch('lizard_security.resultcache.request')
+        self.requests = [self.patcher1.start(), self.patcher2.start()]
+        self.set_access([self.data_set1.id])
+
+    def tearDown(self):
+        self.patcher1.stop()
+        self.patcher2.stop()
+
+    def set_access(self, data_set_ids):
+        for request in self.requests:
+            request.user = None
+            request.allowed_data_set_ids = set(data_set_ids)
+
+    def names(self):
+        return sorted([content.name for content
+                       in Content.cached_objects.all()])
+
+    def test_shared_results(self):
+        self.assertListEqual(['content1'], self.names())
+        with self.assertNumQueries(0):
+            self.assertListEqual(['content1'], self.names())
+
+    def test_access_in_key(self):
+        self.assertListEqual(['content1'], self.names())
+        self.set_access([self.data_set2.id])
+        self.assertListEqual(['content2'], self.names())
+
+    def test_data_version(self):
+        self.assertListEqual(['content1'], self.names())
+        Content.objects.create(name='content3', data_set=self.data_set1)
+        self.assertListEqual(['content1', 'content3'], self.names())
+
+    def test_size_bound(self):
+        cache = resultcache.SizeBoundedCache(10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        cache.set('c', '12345')
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals('12345', cache.get('c'))
+        cache.set('d', '12345678901')
+        self.assertEquals(None, cache.get('d'))
+
+
+class AccessProfileTest(TestCase):
+
+    def test_interned(self):
+        profile = profiles.intern_profile([1, 2], [3])
+        self.assertTrue(profile is profiles.intern_profile(set([2, 1]),
+                                                           frozenset([3])))
+        self.assertNotEqual(profile, profiles.intern_profile([1], [3]))
+        self.assertEquals(profile.data_set_fingerprint,
+                          profiles.intern_profile([1], [3]
+                                                  ).data_set_fingerprint)
+
+    def test_snapshot_profile(self):
+        access = snapshot.resolve(user_group_ids=[])._replace(
+            data_set_ids=frozenset([3]))
+        public = frozenset([4])
+        profile = profiles.snapshot_profile(access, public)
+        self.assertEquals(frozenset([3, 4]), profile.data_set_ids)
+        self.assertTrue(profile is profiles.intern_profile([], [3, 4]))
+        with patch.object(profiles, 'intern_profile') as intern_profile:
+            self.assertTrue(
+                profile is profiles.snapshot_profile(access, public))
+        self.assertFalse(intern_profile.called)
+        self.assertEquals(frozenset([3]), profiles.snapshot_profile(
+                access, frozenset()).data_set_ids)
+
+    def test_stable_fingerprint(self):
+        profile = profiles.AccessProfile([1, 2], [3])
+        self.assertEquals(profile.fingerprint,
+                          profiles.AccessProfile([2, 1], [3]).fingerprint)
+        self.assertEquals(hash(profile),
+                          hash(profiles.AccessProfile([2, 1], [3])))
+
+    def test_shared_between_requests(self):
+        user_group = UserGroup.objects.create(name='user_group')
+        users = [User.objects.create(username='user1'),
+                 User.objects.create(username='user2')]
+        requests = []
+        for user in users:
+            user_group.members.add(user)
+            request = RequestFactory().get('/some/url')
+            request.user = user
+            SecurityMiddleware().process_request(request)
+            requests.append(request)
+        self.assertTrue(requests[0].access_profile is
+                        requests[1].access_profile)
+        self.assertTrue(requests[0].user_group_ids is
+                        requests[1].user_group_ids)
+        self.assertTrue(profiles.request_profile(requests[0]))
+        requests[0].allowed_data_set_ids = set([42])
+        self.assertEquals(None, profiles.request_profile(requests[0]))
+
+
+class BulkSyncTest(TestCase):
+
+    def setUp(self):
+        for username in ['jan', 'piet', 'klaas']:
+            User.objects.create(username=username)
+        self.data_set = DataSet.objects.create(name='Noord')
+        self.group = Group.objects.create(name='editors')
+
+    def members(self, name):
+        return sorted(UserGroup.objects.get(name=name).members.values_list(
+                'username', flat=True))
+
+    def test_memberships(self):
+        result = bulk.sync_memberships(
+            {'editors': {'members': ['piet', 'nobody'],
+                         'managers': ['jan']}})
+        self.assertEquals(result.added, 3)
+        self.assertSetEqual(set(['nobody']), result.unknown)
+        self.assertListEqual(['jan', 'piet'], self.members('editors'))
+        result = bulk.sync_memberships(
+            {'editors': {'members': ['klaas', 'piet']}})
+        self.assertEquals((result.added, result.removed), (1, 2))
+        self.assertListEqual(['klaas', 'piet'], self.members('editors'))
+
+    def test_chunks(self):
+        with patch.object(bulk, 'CHUNK_SIZE', 2):
+            result = bulk.sync_memberships(
+                dict([(name, {'members': ['jan', 'piet', 'klaas']})
+                      for name in ['editors', 'viewers', 'interns']]))
+            self.assertEquals(9, result.added)
+            result = bulk.sync_memberships(
+                {'editors': {'members': ['jan']},
+                 'viewers': {'members': []}})
+        self.assertEquals((result.added, result.removed), (0, 5))
+        self.assertEquals(3, UserGroup.objects.count())
+        self.assertListEqual(['jan'], self.members('editors'))
+
+    def test_single_invalidation(self):
+        before = epoch.current()
+        bulk.sync_memberships({'editors': {'members': ['piet', 'klaas']},
+                               'viewers': {'members': ['jan']}})
+        self.assertEquals(before + 1, epoch.current())
+
+    def test_permission_mappers(self):
+        desired = [{'user_group': 'editors',
+                    'data_set': 'Noord',
+                    'permission_group': 'editors'},
+                   {'user_group': 'editors',
+                    'data_set': 'Zuid'}]
+        result = bulk.sync_permission_mappers(desired)
+        self.assertEquals(result.added, 1)
+        self.assertSetEqual(set(['Zuid']), result.unknown)
+        result = bulk.sync_permission_mappers(desired)
+        self.assertEquals((result.added, result.removed), (0, 0))
+        result = bulk.sync_permission_mappers(
+            [{'user_group': 'editors', 'data_set': 'Noord',
+              'valid_until': '2030-01-01T00:00:00'}])
+        self.assertEquals((result.added, result.removed), (1, 1))
+        self.assertEquals(1, PermissionMapper.objects.count())
+
+    def test_command(self):
+        json_file = tempfile.NamedTemporaryFile(suffix='.json')
+        json_file.write(json.dumps(
+                {'user_groups': {'editors': {'members': ['jan']}},
+                 'permission_mappers': [{'user_group': 'editors',
+                                         'data_set': 'Noord'}]}))
+        json_file.flush()
+        with patch('sys.stdout'):
+            call_command('sync_security', json_file.name)
+        self.assertListEqual(['jan'], self.members('editors'))
+        self.assertEquals(1, PermissionMapper.objects.count())
+
+
+class TransferTest(TestCase):
+
+    def setUp(self):
+        self.jan = User.objects.create(username='jan')
+        self.piet = User.objects.create(username='piet')
+        self.group = Group.objects.create(name='editors')
+        noord = DataSet.objects.create(name='Noord', is_public=True)
+        DataSet.objects.create(name='Noord-Oost', parent=noord)
+        self.editors = UserGroup.objects.create(name='editors')
+        self.editors.members.add(self.jan, self.piet)
+        self.editors.managers.add(self.jan)
+        self.interns = UserGroup.objects.create(name='interns')
+        self.editors.member_groups.add(self.interns)
+        PermissionMapper.objects.create(
+            name='edit', user_group=self.editors, data_set=noord,
+            permission_group=self.group)
+
+    def round_trip(self, format):
+        output = StringIO()
+        self.assertEquals(9, transfer.export(output, format=format))
+        PermissionMapper.objects.all().delete()
+        UserGroup.objects.all().delete()
+        DataSet.objects.all().delete()
+        importer = transfer.import_records(
+            transfer.read(StringIO(output.getvalue()), format=format))
+        self.assertEquals(2, importer.created['dataset'])
+        self.assertEquals(2, importer.created['member'])
+        editors = UserGroup.objects.get(name='editors')
+        self.assertListEqual(
+            ['jan', 'piet'],
+            sorted(editors.members.values_list('username', flat=True)))
+        self.assertListEqual(
+            ['jan'], list(editors.managers.values_list('username',
+                                                       flat=True)))
+        self.assertListEqual(
+            ['interns'], list(editors.member_groups.values_list('name',
+                                                                flat=True)))
+        self.assertEquals(
+            'Noord', DataSet.objects.get(name='Noord-Oost').parent.name)
+        self.assertListEqual(
+            ['Noord'], list(DataSet.objects.filter(
+                    is_public=True).values_list('name', flat=True)))
+        mapper = PermissionMapper.objects.get()
+        self.assertEquals((mapper.name, mapper.user_group,
+                           mapper.data_set.name, mapper.permission_group),
+                          ('edit', editors, 'Noord', self.group))
+
+    def test_json_lines(self):
+        self.round_trip(transfer.JSON_LINES)
+
+    def test_csv(self):
+        self.round_trip(transfer.CSV)
+
+    def test_import_twice(self):
+        output = StringIO()
+        transfer.export(output)
+        importer = transfer.import_records(
+            transfer.read(StringIO(output.getvalue())))
+        self.assertEquals(0, sum(importer.created.values()))
+        self.assertEquals(1, PermissionMapper.objects.count())
+
+    def test_import_twice_without_user_group(self):
+        PermissionMapper.objects.create(name='everybody',
+                                        permission_group=self.group)
+        output = StringIO()
+        transfer.export(output)
+        importer = transfer.import_records(
+            transfer.read(StringIO(output.getvalue())))
+        self.assertEquals(0, importer.created['permissionmapper'])
+        self.assertEquals(2, PermissionMapper.objects.count())
+
+    def test_unknown_user(self):
+        importer = transfer.import_records(
+            [('member', {'user_group': 'editors', 'user': 'nobody'})])
+        self.assertSetEqual(set(['nobody']), importer.unknown)
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def write(self, records):
+        self.batches.append(records)
+
+
+class AuditLogTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='jan')
+        self.sink = ListSink()
+
+    def test_batches(self):
+        log = audit.AuditLog(self.sink, batch_size=2, interval=0.01)
+        with patch.object(log, '_start_worker'):
+            for data_set_id in range(3):
+                log.record(self.user, [data_set_id])
+        log._start_worker()
+        log.close(timeout=5)
+        self.assertListEqual([2, 1], [len(batch)
+                                      for batch in self.sink.batches])
+        record = self.sink.batches[0][0]
+        self.assertEquals(('jan', '0', True), (
+                record['username'], record['data_set_ids'], record['allowed']))
+
+    def test_formatted_by_worker(self):
+        log = audit.AuditLog(self.sink)
+        log._start_worker = lambda: None
+        data_set_ids = frozenset([3, 1])
+        log.record(self.user, data_set_ids)
+        # Queued as it is, the request doesn't wait for the formatting.
+        self.assertIs(data_set_ids, log._queue.queue[0]['data_set_ids'])
+        log.flush()
+        self.assertEquals('1,3', self.sink.batches[0][0]['data_set_ids'])
+
+    def test_drop_when_full(self):
+        log = audit.AuditLog(self.sink, max_size=2)
+        log._start_worker = lambda: None
+        for data_set_id in range(3):
+            log.record(self.user, [data_set_id])
+        log.flush()
+        self.assertEquals(1, log.dropped)
+        self.assertEquals(2, len(self.sink.batches[0]))
+
+    def test_database_sink(self):
+        log = audit.AuditLog(audit.DatabaseSink())
+        log._start_worker = lambda: None
+        log.record(self.user, [3, 1], model='testcontent.content',
+                   perm='testcontent.change_content', allowed=False)
+        log.record(AnonymousUser(), [])
+        log.flush()
+        self.assertListEqual(
+            [('jan', '1,3', False), ('', '', True)],
+            list(AccessLog.objects.order_by('id').values_list(
+                    'username', 'data_set_ids', 'allowed')))
+
+    def test_file_sink(self):
+        log_file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+        audit.FileSink(log_file.name).write(
+            [{'timestamp': timezone.now(), 'username': 'jan'}])
+        self.assertEquals('jan', json.loads(log_file.read())['username'])
+
+    def test_disabled(self):
+        self.assertEquals(None, audit.audit_log())
+
+
+class WarmupTest(TestCase):
+
+    def setUp(self):
+        self.user_group = UserGroup.objects.create(name='editors')
+        self.data_set = DataSet.objects.create(name='Noord')
+        PermissionMapper.objects.create(user_group=self.user_group,
+                                        data_set=self.data_set)
+        self.users = []
+        for days in range(3):
+            user = User.objects.create(
+                username='user%s' % days,
+                last_login=timezone.now() - datetime.timedelta(days=days))
+            self.user_group.members.add(user)
+            self.users.append(user)
+        User.objects.create(username='inactive', is_active=False)
+        self.patcher = patch.object(middleware.user_snapshots, 'max_size', 10)
+        self.patcher.start()
+        middleware.user_snapshots.clear()
+
+    def tearDown(self):
+        middleware.user_snapshots.clear()
+        snapshot.forget_preloaded()
+        self.patcher.stop()
+
+    def test_most_recent_users(self):
+        statistics = warmup.warm_up(max_users=2)
+        self.assertEquals(2, statistics['users'])
+        self.assertEquals(2, len(middleware.user_snapshots))
+        access = middleware.user_snapshots.get(self.users[0].id)
+        self.assertSetEqual(set([self.data_set.id]), access.data_set_ids)
+        self.assertEquals(None, middleware.user_snapshots.get(
+                self.users[2].id))
+
+    def test_budgets(self):
+        self.assertEquals(0, warmup.warm_up(seconds=-1)['users'])
+        statistics = warmup.warm_up(max_bytes=0)
+        self.assertEquals(0, statistics['user_groups'])
+        self.assertEquals(0, statistics['users'])
+        self.assertEquals(0, statistics['bytes'])
+        # Room for the user groups and one snapshot.
+        max_bytes = warmup.warm_up(max_users=1)['bytes']
+        middleware.user_snapshots.clear()
+        self.assertEquals(1, warmup.warm_up(max_bytes=max_bytes)['users'])
+
+    def test_preloaded_user_groups(self):
+        self.assertEquals(1, warmup.warm_up(max_users=0)['user_groups'])
+        with self.assertNumQueries(1):
+            # Only the user groups of the user.
+            access = snapshot.resolve(user=self.users[2])
+        self.assertSetEqual(set([self.data_set.id]), access.data_set_ids)
+        epoch.bump()
+        with self.assertNumQueries(4):
+            snapshot.resolve(user=self.users[2])
+
+    def test_cached_middleware(self):
+        warmup.warm_up()
+        request = RequestFactory().get('/')
+        request.user = self.users[1]
+        with self.assertNumQueries(0):
+            SecurityMiddleware().process_request(request)
+        self.assertSetEqual(set([self.data_set.id]),
+                            request.allowed_data_set_ids)
+
+
+class CountingProvider(providers.PolicyProvider):
+    cache_timeout = 60
+
+    def __init__(self, user_group_ids=(), data_set_ids=()):
+        super(CountingProvider, self).__init__()
+        self.user_group_ids = user_group_ids
+        self.data_set_ids = data_set_ids
+        self.calls = 0
+
+    def cache_key(self, request):
+        return request.META.get('REMOTE_ADDR')
+
+    def access(self, request):
+        self.calls += 1
+        return self.user_group_ids, self.data_set_ids
+
+
+class PolicyProviderTest(TestCase):
+
+    def setUp(self):
+        self.outer = UserGroup.objects.create(name='outer')
+        self.inner = UserGroup.objects.create(name='inner')
+        self.outer.member_groups.add(self.inner)
+        self.data_set = DataSet.objects.create(name='Noord')
+        self.extra_data_set = DataSet.objects.create(name='Zuid')
+        PermissionMapper.objects.create(user_group=self.outer,
+                                        data_set=self.data_set)
+        self.middleware = SecurityMiddleware()
+
+    def request(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        return request
+
+    def test_merged(self):
+        self.middleware.providers = [
+            CountingProvider(user_group_ids=[self.inner.id]),
+            CountingProvider(data_set_ids=[self.extra_data_set.id])]
+        request = self.request()
+        self.middleware.process_request(request)
+        self.assertSetEqual(set([self.inner.id, self.outer.id]),
+                            request.user_group_ids)
+        self.assertSetEqual(set([self.data_set.id, self.extra_data_set.id]),
+                            request.allowed_data_set_ids)
+
+    def test_cached(self):
+        provider = CountingProvider(user_group_ids=[self.inner.id])
+        self.middleware.providers = [provider]
+        for i in range(3):
+            self.middleware.process_request(self.request())
+        self.assertEquals(1, provider.calls)
+        epoch.bump()
+        self.middleware.process_request(self.request())
+        self.assertEquals(2, provider.calls)
+
+    def test_configured(self):
+        with self.settings(LIZARD_SECURITY_POLICY_PROVIDERS=[
+                'lizard_security.providers.PolicyProvider']):
+            self.assertEquals(1, len(providers.configured_providers()))
+
+
 class FilteredGeoManagerTest(TestCase):
 
     def setUp(self):
@@ -471,6 +2104,103 @@ class FilteredGeoManagerTest(TestCase):
         self.assertEqual(len(GeoContent.objects.all()), 2)
 
 
+class ExtentTest(TestCase):
+
+    def setUp(self):
+        self.near = DataSet.objects.create(name='near')
+        self.far = DataSet.objects.create(name='far')
+        extents.track(GeoContent)
+        # Forget the extents of earlier tests.
+        epoch.bump(extents._epoch_name(GeoContent))
+
+    def tearDown(self):
+        extents.untrack(GeoContent)
+
+    def save(self, data_set, x, y):
+        extents.object_saved(
+            sender=GeoContent,
+            instance=GeoContent(data_set=data_set,
+                                geometry=Point(x, y, srid=4326)))
+
+    def set_extent(self, data_set, box):
+        DataSetExtent.objects.create(
+            content_type=ContentType.objects.get_for_model(GeoContent),
+            data_set=data_set, xmin=box[0], ymin=box[1], xmax=box[2],
+            ymax=box[3])
+        epoch.bump(extents._epoch_name(GeoContent))
+
+    def test_grow_on_save(self):
+        self.save(self.near, 1, 2)
+        self.assertEquals((1, 2, 1, 2),
+                          extents.extents(GeoContent)[self.near.id])
+        self.save(self.near, 3, 0)
+        self.assertEquals((1, 0, 3, 2),
+                          extents.extents(GeoContent)[self.near.id])
+        with self.assertNumQueries(0):
+            self.save(self.near, 2, 1)
+        self.assertNotIn(self.far.id, extents.extents(GeoContent))
+
+    def test_delete_inside_extent(self):
+        self.set_extent(self.near, (0, 0, 4, 4))
+        extents.extents(GeoContent)
+        with self.assertNumQueries(0):
+            extents.object_deleted(
+                sender=GeoContent,
+                instance=GeoContent(data_set=self.near,
+                                    geometry=Point(2, 2, srid=4326)))
+
+    def test_prune(self):
+        self.set_extent(self.near, (0, 0, 1, 1))
+        self.set_extent(self.far, (10, 10, 11, 11))
+        # Unknown extents can't be pruned.
+        self.assertListEqual(
+            [self.near.id, 12345],
+            extents.prune(GeoContent, (0.5, 0.5, 2, 2),
+                          [self.near.id, self.far.id, 12345]))
+
+    def test_in_bbox(self):
+        self.set_extent(self.near, (0, 0, 1, 1))
+        self.set_extent(self.far, (10, 10, 11, 11))
+        # Without an extent, say after an update().
+        unknown = DataSet.objects.create(name='unknown')
+        for data_set in (self.near, self.far, unknown, None):
+            GeoContent.objects.create(name=getattr(data_set, 'name', 'none'),
+                                      data_set=data_set)
+        with patch('lizard_security.manager.request') as request:
+            request.user = None
+            request.allowed_data_set_ids = set([self.near.id, self.far.id,
+                                                unknown.id])
+            # Only the data set pruning, the geometry lookup needs a
+            # spatial database.
+            with patch('lizard_security.extents.filter_bbox',
+                       lambda query_set, bbox, lookup: query_set):
+                self.assertListEqual(
+                    ['near', 'none', 'unknown'],
+                    sorted([content.name for content in
+                            GeoContent.objects.in_bbox((0, 0, 2, 2))]))
+
+    def test_rebuild_untracked_model(self):
+        self.assertRaises(CommandError, call_command, 'rebuild_extents',
+                          'testcontent.Content')
+
+    def test_label(self):
+        # The same label format as for the filter strategies.
+        self.assertIn('testcontent.geocontent', extents.tracked)
+
+    def test_savepoint(self):
+        # The fallback of atomic() for Django < 1.6 keeps the caller's
+        # changes when the block fails.
+        DataSet.objects.create(name='kept')
+        try:
+            with extents._savepoint():
+                DataSet.objects.create(name='undone')
+                raise IntegrityError()
+        except IntegrityError:
+            pass
+        self.assertTrue(DataSet.objects.filter(name='kept').exists())
+        self.assertFalse(DataSet.objects.filter(name='undone').exists())
+
+
 class ForeignKeyTest(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -0,0 +1,331 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Streaming export and import of the security configuration: data sets, user
+groups (with their nesting, members and managers) and permission mappers.
+
+Unlike ``dumpdata``/``loaddata``, nothing is loaded into memory as a whole.
+Rows are read from the database in primary key ordered chunks and written
+out one record per line; on import, records are buffered per chunk and
+inserted with ``bulk_create()``. Memory use stays constant, even with
+millions of memberships.
+
+Objects are referenced by natural keys instead of ids, so the configuration
+can be moved between environments: data sets, user groups and permission
+groups by name, users by username. Users and permission groups must already
+exist in the target environment; records referring to unknown ones are
+skipped and reported.
+
+Two formats are supported: JSON lines (one JSON object per line, with a
+``type`` key) and CSV (the record type in the first column, followed by the
+fields in the order of ``RECORD_FIELDS``).
+
+"""
+import csv
+import json
+
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.db.models import Count
+from django.db.models import Q
+
+from lizard_security import epoch
+from lizard_security import replicas
+from lizard_security.bulk import _moment
+from lizard_security.bulk import atomic
+from lizard_security.models import DataSet
+from lizard_security.models import PermissionMapper
+from lizard_security.models import UserGroup
+
+# Lookups use two lists of ids per chunk: stay below SQLite's limit of 999
+# query parameters.
+CHUNK_SIZE = 400
+
+JSON_LINES = 'jsonl'
+CSV = 'csv'
+
+RECORD_FIELDS = {
+    'dataset': ['name', 'parent', 'is_public'],
+    'usergroup': ['name'],
+    'member_group': ['user_group', 'member_group'],
+    'member': ['user_group', 'user'],
+    'manager': ['user_group', 'user'],
+    'permissionmapper': ['name', 'user_group', 'data_set',
+                         'permission_group', 'valid_from', 'valid_until'],
+    }
+
+
+def _chunked(query_set, fields):
+    """Yield ``values_list()`` rows of a query set, in chunks by id.
+
+    Keyset pagination on the primary key keeps every query cheap and never
+    holds more than one chunk in memory.
+
+    """
+    last_id = 0
+    while True:
+        rows = list(query_set.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', *fields)[:CHUNK_SIZE])
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:]
+        last_id = rows[-1][0]
+
+
+def _isoformat(moment):
+    if moment is None:
+        return None
+    return moment.isoformat()
+
+
+def records():
+    """Yield the security configuration as ``(type, dict)`` records.
+
+    Records are ordered so that everything is defined before it is
+    referenced: data sets parents first, user groups before their
+    memberships.
+
+    """
+    # Data sets are few; parents go first.
+    data_sets = DataSet.objects.annotate(
+        num_ancestors=Count('ancestor_links')).order_by(
+        'num_ancestors', 'id').values_list(
+        'name', 'parent__name', 'is_public', 'num_ancestors')
+    for (name, parent, is_public, num_ancestors) in data_sets.iterator():
+        yield ('dataset', {'name': name, 'parent': parent,
+                           'is_public': bool(is_public)})
+    for (name, ) in _chunked(UserGroup.objects.all(), ['name']):
+        yield ('usergroup', {'name': name})
+    through = UserGroup.member_groups.through
+    for (user_group, member_group) in _chunked(
+            through.objects.all(),
+            ['from_usergroup__name', 'to_usergroup__name']):
+        yield ('member_group', {'user_group': user_group,
+                                'member_group': member_group})
+    for (record_type, field_name) in (('member', 'members'),
+                                      ('manager', 'managers')):
+        through = getattr(UserGroup, field_name).through
+        for (user_group, user) in _chunked(
+                through.objects.all(), ['usergroup__name', 'user__username']):
+            yield (record_type, {'user_group': user_group, 'user': user})
+    for row in _chunked(PermissionMapper.objects.all(),
+                        ['name', 'user_group__name', 'data_set__name',
+                         'permission_group__name', 'valid_from',
+                         'valid_until']):
+        record = dict(zip(RECORD_FIELDS['permissionmapper'], row))
+        record['valid_from'] = _isoformat(record['valid_from'])
+        record['valid_until'] = _isoformat(record['valid_until'])
+        yield ('permissionmapper', record)
+
+
+def _csv_value(value):
+    """Return the value for a CSV column: booleans become '1' or ''."""
+    if value is True:
+        return '1'
+    return (value or u'').encode('utf-8')
+
+
+def export(output, format=JSON_LINES):
+    """Write all records to the file-like ``output``. Return the count."""
+    count = 0
+    if format == CSV:
+        writer = csv.writer(output)
+    for (record_type, record) in records():
+        if format == CSV:
+            writer.writerow(
+                [record_type] +
+                [_csv_value(record[field])
+                 for field in RECORD_FIELDS[record_type]])
+        else:
+            record['type'] = record_type
+            output.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+
+def read(input, format=JSON_LINES):
+    """Yield ``(type, dict)`` records from the file-like ``input``."""
+    if format == CSV:
+        for row in csv.reader(input):
+            if not row:
+                continue
+            record_type = row[0]
+            values = [(value.decode('utf-8') or None) for value in row[1:]]
+            yield (record_type,
+                   dict(zip(RECORD_FIELDS[record_type], values)))
+    else:
+        for line in input:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield (record.pop('type'), record)
+
+
+class Importer(object):
+    """Insert records in chunks, resolving natural keys per chunk.
+
+    Data sets and user groups are created with ``save()`` so that their
+    closure tables are maintained; there are relatively few of them. Every
+    name is only looked up once: existing objects with the same natural key
+    are re-used, so importing twice doesn't duplicate anything.
+
+    """
+
+    def __init__(self):
+        self.created = dict((record_type, 0) for record_type in RECORD_FIELDS)
+        self.unknown = set()
+        self._buffer = []
+        self._buffer_type = None
+        self._data_set_ids = dict(
+            DataSet.objects.values_list('name', 'id'))
+        self._user_group_ids = dict(
+            UserGroup.objects.order_by('-id').values_list('name', 'id'))
+
+    def add(self, record_type, record):
+        if record_type not in RECORD_FIELDS:
+            raise ValueError("Unknown record type %r" % record_type)
+        if record_type != self._buffer_type or len(
+                self._buffer) >= CHUNK_SIZE:
+            self.flush()
+            self._buffer_type = record_type
+        self._buffer.append(record)
+
+    def flush(self):
+        if self._buffer:
+            getattr(self, '_import_' + self._buffer_type)(self._buffer)
+        self._buffer = []
+
+    def _user_group_id(self, name):
+        user_group_id = self._user_group_ids.get(name)
+        if user_group_id is None:
+            self.unknown.add(name)
+        return user_group_id
+
+    def _import_dataset(self, records):
+        for record in records:
+            if record['name'] in self._data_set_ids:
+                continue
+            parent_id = None
+            if record.get('parent'):
+                parent_id = self._data_set_ids.get(record['parent'])
+                if parent_id is None:
+                    self.unknown.add(record['parent'])
+            data_set = DataSet(name=record['name'], parent_id=parent_id,
+                               is_public=bool(record.get('is_public')))
+            data_set.save()
+            self._data_set_ids[data_set.name] = data_set.id
+            self.created['dataset'] += 1
+
+    def _import_usergroup(self, records):
+        for record in records:
+            if record['name'] in self._user_group_ids:
+                continue
+            user_group = UserGroup.objects.create(name=record['name'])
+            self._user_group_ids[user_group.name] = user_group.id
+            self.created['usergroup'] += 1
+
+    def _import_member_group(self, records):
+        for record in records:
+            parent_id = self._user_group_id(record['user_group'])
+            child_id = self._user_group_id(record['member_group'])
+            if parent_id is None or child_id is None:
+                continue
+            parent = UserGroup.objects.get(pk=parent_id)
+            if not parent.member_groups.filter(pk=child_id).exists():
+                parent.member_groups.add(child_id)
+                self.created['member_group'] += 1
+
+    def _import_users(self, record_type, field_name, records):
+        through = getattr(UserGroup, field_name).through
+        usernames = set([record['user'] for record in records])
+        user_ids = dict(User.objects.filter(
+                username__in=usernames).values_list('username', 'id'))
+        self.unknown.update(usernames - set(user_ids))
+        wanted = set()
+        for record in records:
+            user_group_id = self._user_group_id(record['user_group'])
+            if user_group_id is None or record['user'] not in user_ids:
+                continue
+            wanted.add((user_group_id, user_ids[record['user']]))
+        existing = set(through.objects.filter(
+                usergroup__in=set([pair[0] for pair in wanted]),
+                user__in=set([pair[1] for pair in wanted])).values_list(
+                'usergroup', 'user'))
+        new_pairs = wanted - existing
+        through.objects.bulk_create(
+            [through(usergroup_id=pair[0], user_id=pair[1])
+             for pair in new_pairs])
+        self.created[record_type] += len(new_pairs)
+
+    def _import_member(self, records):
+        self._import_users('member', 'members', records)
+
+    def _import_manager(self, records):
+        self._import_users('manager', 'managers', records)
+
+    def _import_permissionmapper(self, records):
+        group_names = set([record['permission_group'] for record in records
+                           if record.get('permission_group')])
+        group_ids = dict(Group.objects.filter(
+                name__in=group_names).values_list('name', 'id'))
+        self.unknown.update(group_names - set(group_ids))
+        wanted = {}
+        for record in records:
+            user_group_id = data_set_id = group_id = None
+            if record.get('user_group'):
+                user_group_id = self._user_group_id(record['user_group'])
+                if user_group_id is None:
+                    continue
+            if record.get('data_set'):
+                data_set_id = self._data_set_ids.get(record['data_set'])
+                if data_set_id is None:
+                    self.unknown.add(record['data_set'])
+                    continue
+            if record.get('permission_group'):
+                group_id = group_ids.get(record['permission_group'])
+                if group_id is None:
+                    continue
+            key = (user_group_id, data_set_id, group_id,
+                   _moment(record.get('valid_from')),
+                   _moment(record.get('valid_until')))
+            wanted[key] = record.get('name') or ''
+        user_group_ids = set([wanted_key[0] for wanted_key in wanted])
+        user_group_query = Q(user_group__in=user_group_ids - set([None]))
+        if None in user_group_ids:
+            # An IN list never matches NULL.
+            user_group_query |= Q(user_group__isnull=True)
+        existing = set(PermissionMapper.objects.filter(
+                user_group_query).values_list(
+                'user_group', 'data_set', 'permission_group', 'valid_from',
+                'valid_until'))
+        new_keys = set(wanted) - existing
+        PermissionMapper.objects.bulk_create(
+            [PermissionMapper(name=wanted[new_key],
+                              user_group_id=new_key[0],
+                              data_set_id=new_key[1],
+                              permission_group_id=new_key[2],
+                              valid_from=new_key[3],
+                              valid_until=new_key[4])
+             for new_key in new_keys])
+        self.created['permissionmapper'] += len(new_keys)
+
+
+def import_records(records):
+    """Import ``(type, dict)`` records in one transaction.
+
+    Returns the ``Importer``, with counts of created objects per type and
+    the names of unknown referenced objects.
+
+    """
+    # The replica might not have the latest changes to compare with.
+    with replicas.primary():
+        importer = Importer()
+        with epoch.coalesced():
+            with atomic():
+                for (record_type, record) in records:
+                    importer.add(record_type, record)
+                importer.flush()
+            epoch.bump()
+            replicas.security_written()
+    return importer
@@ -1,11 +1,17 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 from django.conf.urls import include
 from django.conf.urls import patterns
+from django.conf.urls import url
 from django.contrib import admin
 
+import lizard_security.views
+
 admin.autodiscover()
 
 urlpatterns = patterns(
     '',
+    url(r'^authorize/$',
+        lizard_security.views.authorize,
+        name='lizard_security_authorize'),
     (r'^admin/', include(admin.site.urls)),
     )
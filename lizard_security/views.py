@@ -1,3 +1,159 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Views for services outside Django that need lizard-security's decisions.
 
-# Create your views here.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.db.models import get_model
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
+
+from lizard_security import epoch
+from lizard_security.backends import VIEW_PERMISSION
+from lizard_security.backends import data_set_ids_by_object
+from lizard_security.backends import data_set_permissions
+from lizard_security.middleware import ALLOWED_DATA_SET_IDS
+from lizard_security.models import data_sets_field
+from lizard_security.models import null_data_set_is_public
+
+EPOCH_HEADER = 'X-Lizard-Security-Epoch'
+
+
+def _data_set_ids(model_checks):
+    """Return dict of (model label, object id) to the object's data sets.
+
+    One query per model. Objects that don't exist are left out; objects
+    without a data set have ``[None]``, see ``object_data_set_ids()``.
+
+    """
+    result = {}
+    for (label, ids) in model_checks.items():
+        model = get_model(*label.split('.', 1))
+        for (object_id, data_set_ids) in data_set_ids_by_object(
+                model._base_manager.filter(pk__in=ids)).items():
+            result[(label, object_id)] = data_set_ids
+    return result
+
+
+def _parse_checks(body):
+    """Return the checks as a list of tuples.
+
+    The tuples are ``(model label, object id, data set id, perm)``, with
+    either the first two or the data set id set to None. Raises ValueError
+    for invalid input.
+
+    """
+    checks = json.loads(body)['checks']
+    if not isinstance(checks, list):
+        raise ValueError("'checks' should be a list")
+    max_checks = getattr(settings, 'LIZARD_SECURITY_AUTHORIZE_MAX_CHECKS',
+                         1000)
+    if len(checks) > max_checks:
+        raise ValueError("More than %s checks" % max_checks)
+    parsed = []
+    for check in checks:
+        perm = check.get('perm') or VIEW_PERMISSION
+        if '.' not in perm:
+            raise ValueError("Invalid permission %r" % perm)
+        if 'model' in check:
+            label = check['model'].lower()
+            if '.' not in label:
+                raise ValueError("Invalid model %r" % check['model'])
+            model = get_model(*label.split('.', 1))
+            if model is None or (
+                'data_set' not in model._meta.get_all_field_names() and
+                data_sets_field(model) is None):
+                raise ValueError("Not a secured model: %r" % check['model'])
+            parsed.append((label, int(check['id']), None, perm))
+        else:
+            data_set_id = check['data_set']
+            if data_set_id is not None:
+                data_set_id = int(data_set_id)
+            parsed.append((None, None, data_set_id, perm))
+    return parsed
+
+
+@csrf_exempt
+def authorize(request):
+    """Answer a batch of permission checks for the current user or token.
+
+    POST a JSON object like this::
+
+        {"checks": [
+            {"model": "testcontent.content", "id": 3,
+             "perm": "testcontent.change_content"},
+            {"data_set": 5}]}
+
+    A check is about either an object of a secured model or a data set
+    (``null`` for objects without one). ``perm`` defaults to the implicit
+    view permission. The answer has one boolean per check, in order::
+
+        {"epoch": 1402000000000, "results": [true, false]}
+
+    The user and token are taken from the request as set up by the
+    middleware, so put ``TokenMiddleware`` in place for token clients. All
+    checks are answered from the request's access sets plus one query for
+    the permissions per data set and one per model for object lookups. At
+    most ``LIZARD_SECURITY_AUTHORIZE_MAX_CHECKS`` (default 1000) checks are
+    answered per request, more is a bad request.
+
+    The ``X-Lizard-Security-Epoch`` header tells clients when cached
+    decisions may have become stale. The response also has an ``ETag``:
+    send it back as ``If-None-Match`` to get a ``304 Not Modified`` when
+    the answer is still the same.
+
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        checks = _parse_checks(request.body)
+    except (ValueError, KeyError, TypeError, AttributeError), e:
+        return HttpResponseBadRequest("Invalid checks: %s" % e)
+    current_epoch = epoch.current()
+    model_checks = {}
+    for (label, object_id, data_set_id, perm) in checks:
+        if label is not None:
+            model_checks.setdefault(label, set()).add(object_id)
+    object_data_sets = _data_set_ids(model_checks)
+    user = request.user
+    allowed_data_set_ids = getattr(request, ALLOWED_DATA_SET_IDS, None) or ()
+    permissions = data_set_permissions(request)
+
+    def allowed(data_set_id, perm):
+        if perm == VIEW_PERMISSION:
+            # Objects without a data set are visible to everyone, unless
+            # configured otherwise.
+            if data_set_id is None:
+                return null_data_set_is_public()
+            return data_set_id in allowed_data_set_ids
+        return perm in permissions.get(data_set_id, ())
+
+    results = []
+    for (label, object_id, data_set_id, perm) in checks:
+        if label is None:
+            data_set_ids = [data_set_id]
+        elif (label, object_id) in object_data_sets:
+            data_set_ids = object_data_sets[(label, object_id)]
+        else:
+            results.append(False)
+            continue
+        if user.is_superuser or user.has_perm(perm):
+            results.append(True)
+        else:
+            # Objects with several data sets: any of them will do.
+            results.append(any([allowed(data_set_id, perm)
+                                for data_set_id in data_set_ids]))
+    content = json.dumps({'epoch': current_epoch, 'results': results})
+    etag = '"%s"' % hashlib.sha1(content).hexdigest()
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    response[EPOCH_HEADER] = str(current_epoch)
+    return response
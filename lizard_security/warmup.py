@@ -0,0 +1,155 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+# -*- coding: utf-8 -*-
+"""
+Warming up the caches of a freshly started process, so that its first
+requests don't all pay for resolving permissions.
+
+``warm_up()`` loads:
+
+- the security epoch, the public data sets and the content types (used for
+  permission lookups throughout Django),
+
+- the data sets of every user group, from the permission mappers. Resolving
+  access snapshots takes them from memory from then on, until the security
+  epoch changes (see ``snapshot.preload_user_group_data_set_ids()``),
+
+- the access snapshots of the most recently logged in users, into
+  ``SecurityMiddleware``'s user cache. This needs
+  ``LIZARD_SECURITY_USER_CACHE_SIZE``. Resolving them also interns their
+  access profiles and warms the database's caches for the permission mapper
+  queries.
+
+Call ``warm_up()`` from your ``wsgi.py`` to warm up when the application is
+loaded. Alternatively, set ``LIZARD_SECURITY_WARMUP`` to ``'background'`` to
+start it in a thread when ``SecurityMiddleware`` is created (on the first
+request), or to ``'sync'`` to let that first request wait for it.
+
+The work is limited by ``LIZARD_SECURITY_WARMUP_SECONDS`` (default 10),
+``LIZARD_SECURITY_WARMUP_BYTES`` (approximate size of the loaded snapshots,
+default 10MB) and ``LIZARD_SECURITY_WARMUP_USERS`` (default: the size of
+the user cache). Whatever budget runs out first ends the warm-up.
+
+"""
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import get_models
+
+from lizard_security import epoch
+from lizard_security import profiles
+from lizard_security import snapshot
+from lizard_security.middleware import user_snapshots
+
+BACKGROUND = 'background'
+SYNC = 'sync'
+
+logger = logging.getLogger(__name__)
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def _snapshot_size(access):
+    """Return the approximate memory use of a snapshot's sets, in bytes."""
+    size = 0
+    for ids in (access.user_group_ids, access.data_set_ids):
+        size += sys.getsizeof(ids) + sum(
+            [sys.getsizeof(some_id) for some_id in ids])
+    return size
+
+
+def _mapping_size(mapping):
+    """Return the approximate memory use of the preloaded data sets."""
+    return sys.getsizeof(mapping) + sum(
+        [sys.getsizeof(data_set_ids) for data_set_ids in mapping.values()])
+
+
+def warm_up(seconds=None, max_bytes=None, max_users=None):
+    """Fill the caches within the budgets; return a dict with statistics.
+
+    Arguments that aren't given are taken from the settings.
+
+    """
+    if seconds is None:
+        seconds = getattr(settings, 'LIZARD_SECURITY_WARMUP_SECONDS', 10)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'LIZARD_SECURITY_WARMUP_BYTES',
+                            10 * 1024 * 1024)
+    if max_users is None:
+        max_users = getattr(settings, 'LIZARD_SECURITY_WARMUP_USERS',
+                            user_snapshots.max_size)
+    # The user cache evicts anything beyond its size anyway.
+    max_users = min(max_users, user_snapshots.max_size)
+    start = time.time()
+    deadline = start + seconds
+    current_epoch = epoch.current()
+    snapshot.public_data_set_ids(current_epoch)
+    ContentType.objects.get_for_models(*get_models())
+    size = 0
+    mapping = snapshot.preload_user_group_data_set_ids(current_epoch)
+    if _mapping_size(mapping) > max_bytes:
+        snapshot.forget_preloaded()
+        mapping = {}
+    else:
+        size += _mapping_size(mapping)
+    users = 0
+    if max_users > 0:
+        for user in User.objects.filter(
+                is_active=True, last_login__isnull=False).order_by(
+                '-last_login')[:max_users].iterator():
+            if time.time() > deadline:
+                break
+            access = snapshot.resolve(user=user)._replace(user=None)
+            access_size = _snapshot_size(access)
+            if size + access_size > max_bytes:
+                break
+            user_snapshots.set(user.id, access)
+            profiles.intern_profile(access.user_group_ids,
+                                    access.data_set_ids)
+            size += access_size
+            users += 1
+    statistics = {'user_groups': len(mapping),
+                  'users': users,
+                  'bytes': size,
+                  'seconds': time.time() - start}
+    logger.info("Warmed up security caches: %(user_groups)s user groups, "
+                "%(users)s users, %(bytes)s bytes, %(seconds).2f seconds.",
+                statistics)
+    return statistics
+
+
+def _warm_up_in_thread():
+    try:
+        warm_up()
+    except Exception:
+        # A failed warm-up only means a slower start.
+        logger.exception("Warming up the security caches failed")
+    finally:
+        # Threads get their own database connection.
+        connection.close()
+
+
+def start_configured():
+    """Warm up as configured by ``LIZARD_SECURITY_WARMUP``, once per process.
+    """
+    global _started
+    mode = getattr(settings, 'LIZARD_SECURITY_WARMUP', None)
+    if mode not in (BACKGROUND, SYNC):
+        return
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+    if mode == SYNC:
+        warm_up()
+        return
+    thread = threading.Thread(target=_warm_up_in_thread,
+                              name='lizard-security-warmup')
+    thread.daemon = True
+    thread.start()